@@ -0,0 +1,83 @@
+"""Card detection time of the transformers pipeline (full-resolution preprocessing, text
+query encoded on every call) versus CardDetector, one photo at a time and batched, e.g.
+
+    python benchmarks/bench_detection.py --photos "photos/*.jpg"
+
+Uploaded photos are stored under their content hash in .cache/images/, next to the card crops,
+so point --photos at a folder of table photos rather than at the image store.
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+
+from PIL import Image
+from transformers import pipeline
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detection import CARD_LABELS, DETECTOR_CHECKPOINT, CardDetector
+from benchmarks.bench_precision import detection_agreement
+
+
+def timed(fn, photos, repeats):
+    # Photos are reopened on every call, as the bot does for every message
+    latencies, predictions = [], None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predictions = fn([Image.open(path) for path in photos])
+        latencies.append(time.perf_counter() - start)
+    return latencies, predictions
+
+
+def summary(latencies, num_photos):
+    return {
+        'mean_seconds_per_photo': statistics.mean(latencies) / num_photos,
+        'p50_seconds_per_photo': statistics.median(latencies) / num_photos,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--photos', required=True, help="glob of table photos")
+    parser.add_argument('--limit', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    photos = sorted(glob.glob(args.photos))[:args.limit]
+    if len(photos) == 0:
+        sys.exit(f"No photos match {args.photos}")
+
+    baseline = pipeline(model=DETECTOR_CHECKPOINT, task="zero-shot-object-detection")
+    detector = CardDetector.load(DETECTOR_CHECKPOINT)
+    # Warm up both models before timing
+    baseline(Image.open(photos[0]), candidate_labels=CARD_LABELS)
+    detector(Image.open(photos[0]), candidate_labels=CARD_LABELS)
+
+    baseline_latencies, reference = timed(
+        lambda images: [baseline(image, candidate_labels=CARD_LABELS) for image in images], photos, args.repeats)
+    single_latencies, single = timed(
+        lambda images: [detector(image, candidate_labels=CARD_LABELS) for image in images], photos, args.repeats)
+    batched_latencies, batched = timed(
+        lambda images: detector(images, candidate_labels=CARD_LABELS), photos, args.repeats)
+
+    report = {
+        'photos': len(photos),
+        'pipeline': summary(baseline_latencies, len(photos)),
+        'card_detector': dict(summary(single_latencies, len(photos)), agreement=statistics.mean(
+            detection_agreement(predictions, ref) for predictions, ref in zip(single, reference))),
+        'card_detector_batched': dict(summary(batched_latencies, len(photos)), agreement=statistics.mean(
+            detection_agreement(predictions, ref) for predictions, ref in zip(batched, reference))),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(report, fd, indent=2)
+
+
+if __name__ == '__main__':
+    main()
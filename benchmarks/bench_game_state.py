@@ -0,0 +1,127 @@
+"""Hand operations on the YAML game state files versus GameStateStore, for hands of 6, 50 and
+500 cards with description fields and embeddings of realistic size, e.g.
+
+    python benchmarks/bench_game_state.py --repeats 20
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game_state import GameStateStore
+
+
+def random_text(rng, length):
+    return "".join(rng.choice(string.ascii_lowercase + "     ") for _ in range(length))
+
+
+def synthetic_card(rng, idx):
+    # Field sizes of a card added with /add: five captions, a three question QnA session and
+    # 512 dimensional embeddings
+    return f"{idx:016x}", {
+        'image_path': f".cache/images/2024-01-01_00-00-00_card-{idx}-of-6.jpg",
+        'captions': {'captions': random_text(rng, 600), 'models': ['Git-Large', 'BLIP-LARGE', 'BLIP-BASE', 'VIT-GPT2', 'BLIP-2']},
+        'interpretation': random_text(rng, 1500),
+        'association': random_text(rng, 1200),
+        'clue': random_text(rng, 20),
+        'qna_session': random_text(rng, 900),
+        'pre_qna_interpretation': random_text(rng, 1500),
+        'image_embedding': [round(rng.uniform(-0.1, 0.1), 6) for _ in range(512)],
+        'description_embedding': [round(rng.uniform(-0.1, 0.1), 6) for _ in range(512)],
+    }
+
+
+def yaml_load(path):
+    with open(path, 'r') as fd:
+        return yaml.safe_load(fd)
+
+
+def yaml_dump(path, game_state):
+    with open(path, 'w') as fd:
+        yaml.dump(game_state, fd, default_flow_style=False, sort_keys=False)
+
+
+def timed(fn, repeats):
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return {'mean_ms': 1000 * statistics.mean(latencies), 'p50_ms': 1000 * statistics.median(latencies)}
+
+
+def benchmark_yaml(folder, cards, extra_card, repeats):
+    path = os.path.join(folder, "user.yaml")
+    yaml_dump(path, {'my_cards': dict(cards)})
+    extra_hash, extra_info = extra_card
+
+    def add():
+        game_state = yaml_load(path)
+        game_state['my_cards'].update({extra_hash: extra_info})
+        yaml_dump(path, game_state)
+
+    def delete():
+        game_state = yaml_load(path)
+        game_state['my_cards'].pop(extra_hash, None)
+        yaml_dump(path, game_state)
+
+    def add_and_delete():
+        add()
+        delete()
+
+    return {
+        'list_hand': timed(lambda: yaml_load(path)['my_cards'], repeats),
+        'add_and_delete_card': timed(add_and_delete, repeats),
+        'file_bytes': os.path.getsize(path),
+    }
+
+
+def benchmark_store(folder, cards, extra_card, repeats):
+    path = os.path.join(folder, "game_state.db")
+    store = GameStateStore(path)
+    store.add_cards('user', dict(cards))
+    extra_hash, extra_info = extra_card
+
+    def add_and_delete():
+        store.add_cards('user', {extra_hash: extra_info})
+        store.remove_cards('user', [extra_hash])
+
+    return {
+        'list_hand': timed(lambda: store.get_hand('user'), repeats),
+        'list_hand_summary': timed(lambda: store.get_hand('user', summary=True), repeats),
+        'add_and_delete_card': timed(add_and_delete, repeats),
+        # Recent writes live in the write-ahead log until the next checkpoint
+        'file_bytes': sum(os.path.getsize(p) for p in [path, path + "-wal"] if os.path.exists(p)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cards', type=int, nargs='+', default=[6, 50, 500])
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    report = dict()
+    for num_cards in args.cards:
+        cards = [synthetic_card(rng, idx) for idx in range(num_cards)]
+        extra_card = synthetic_card(rng, num_cards)
+        with tempfile.TemporaryDirectory() as folder:
+            report[f"{num_cards}_cards"] = {
+                'yaml': benchmark_yaml(folder, cards, extra_card, args.repeats),
+                'sqlite': benchmark_store(folder, cards, extra_card, args.repeats),
+            }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""Accuracy versus latency of the precision modes (and backends) on a fixed set of card images.
+
+Captions of every precision are compared with the fp32 captions of the same card, detections
+with the fp32 boxes of the same photo. Pick the per-model settings for DIXITAI_PRECISION from
+the output, e.g.
+
+    python benchmarks/bench_precision.py --photos "photos/*.jpg"
+
+Without --cards the cards are the ones in the hands of .cache/game_state.db. The image store keeps
+photos and card crops side by side under their content hash, so a glob over .cache/images/??/*.jpg
+matches both. --same-inputs-as reruns on the cards and photos of an earlier --output report, so the
+rows of different hosts and backends compare the same inputs, and --markdown prints the table for
+the results below.
+
+This module is the measuring tool only, the accuracy-versus-latency report itself is not part of the
+repository yet: no run on a fixed card set has been recorded. Add the --markdown table here with
+the host, the report's card count and the command once it is measured. fp32 is the default for
+every model. BLIP-2 in bf16 is opt-in through DIXITAI_PRECISION as a conservative default, not a
+measured result: there are no numbers for or against it.
+"""
+import argparse
+import difflib
+import gc
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import captioning
+from detection import CARD_LABELS, load_detector
+from game_state import GameStateStore
+from model_registry import model_memory_bytes
+from precision import PRECISIONS, resolve_precision
+
+CAPTIONERS = {
+    'git_large': lambda precision, backend: captioning.CaptioningModel('git_large_coco', precision=precision, backend=backend),
+    'blip_large': lambda precision, backend: captioning.CaptioningModel('blip_large', precision=precision, backend=backend),
+    'blip_base': lambda precision, backend: captioning.CaptioningModel('blip_base', precision=precision, backend=backend),
+    'vit_gpt2': lambda precision, backend: captioning.CaptioningModel('vit_gpt2', precision=precision, backend=backend),
+    # BLIP-2 has no ONNX export
+    'blip2': lambda precision, backend: captioning.BLIP2Wrapper(name='blip2_t5', model_type='pretrain_flant5xl', precision=precision),
+}
+
+
+def box_iou(a, b):
+    ix = max(0, min(a['xmax'], b['xmax']) - max(a['xmin'], b['xmin']))
+    iy = max(0, min(a['ymax'], b['ymax']) - max(a['ymin'], b['ymin']))
+    intersection = ix * iy
+    area_a = (a['xmax'] - a['xmin']) * (a['ymax'] - a['ymin'])
+    area_b = (b['xmax'] - b['xmin']) * (b['ymax'] - b['ymin'])
+    return intersection / (area_a + area_b - intersection) if intersection > 0 else 0.0
+
+
+def detection_agreement(predictions, reference):
+    # Mean IoU of every reference box with its best match, missed boxes count as 0
+    if len(reference) == 0:
+        return 1.0 if len(predictions) == 0 else 0.0
+    return statistics.mean(
+        max([box_iou(ref['box'], pred['box']) for pred in predictions] or [0.0]) for ref in reference)
+
+
+def run_model(load_fn, call_fn, inputs, precision):
+    gc.collect()
+    start = time.perf_counter()
+    model = load_fn(precision)
+    load_seconds = time.perf_counter() - start
+    memory_bytes = model_memory_bytes(model)
+    # Warm-up, the first call pays for lazy initialisation
+    call_fn(model, inputs[0])
+    latencies = []
+    model_outputs = []
+    for item in inputs:
+        start = time.perf_counter()
+        model_outputs.append(call_fn(model, item))
+        latencies.append(time.perf_counter() - start)
+    del model
+    return model_outputs, {
+        'load_seconds': load_seconds,
+        'memory_mb': memory_bytes / 2**20,
+        'latency_mean': statistics.mean(latencies),
+        'latency_p50': statistics.median(latencies),
+    }
+
+
+def hand_card_paths(game_state_path):
+    # Files of the cards held in any hand, in the image store layout, each card once
+    if not os.path.exists(game_state_path):
+        return []
+    paths = GameStateStore(game_state_path).image_paths()
+    return sorted(path for path in set(paths) if os.path.exists(path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cards', default=None, help="glob of card crops for the captioners, the cards in the hands by default")
+    parser.add_argument('--game-state', default=".cache/game_state.db", help="game state database the hands are read from")
+    parser.add_argument('--photos', default=None, help="glob of table photos for the detector")
+    parser.add_argument('--same-inputs-as', default=None, help="JSON report of an earlier run to take the cards and photos from")
+    parser.add_argument('--limit', type=int, default=12)
+    parser.add_argument('--models', default=",".join(CAPTIONERS), help="comma separated captioner names")
+    parser.add_argument('--precisions', default=",".join(PRECISIONS))
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'])
+    parser.add_argument('--output', default=None, help="write the report as JSON")
+    parser.add_argument('--markdown', action='store_true', help="print the table as Markdown")
+    args = parser.parse_args()
+
+    precisions = [p for p in args.precisions.split(',') if resolve_precision(p) == p]
+    if 'fp32' not in precisions:
+        precisions.insert(0, 'fp32')
+    report = []
+
+    previous = None
+    if args.same_inputs_as is not None:
+        with open(args.same_inputs_as) as fd:
+            previous = json.load(fd)
+    if previous is not None:
+        card_paths = previous['cards']
+    elif args.cards is not None:
+        card_paths = sorted(glob.glob(args.cards))[:args.limit]
+    else:
+        card_paths = hand_card_paths(args.game_state)[:args.limit]
+    cards = [Image.open(p).convert('RGB') for p in card_paths]
+    if len(cards) > 0:
+        for name in args.models.split(','):
+            reference = None
+            for precision in precisions:
+                model_captions, row = run_model(
+                    lambda precision: CAPTIONERS[name](precision, args.backend),
+                    lambda model, image: model(image), cards, precision)
+                if reference is None:
+                    reference = model_captions
+                row.update({
+                    'model': name,
+                    'precision': precision,
+                    'agreement': statistics.mean(
+                        difflib.SequenceMatcher(None, caption, ref).ratio()
+                        for caption, ref in zip(model_captions, reference)),
+                })
+                report.append(row)
+
+    if previous is not None:
+        photo_paths = previous['photos']
+    else:
+        photo_paths = sorted(glob.glob(args.photos))[:args.limit] if args.photos else []
+    photos = [Image.open(p).convert('RGB') for p in photo_paths]
+    if len(photos) > 0:
+        reference = None
+        for precision in precisions:
+            predictions, row = run_model(
+                lambda precision: load_detector(precision, args.backend),
+                lambda detector, image: detector(image, candidate_labels=CARD_LABELS), photos, precision)
+            if reference is None:
+                reference = predictions
+            row.update({
+                'model': 'owlvit',
+                'precision': precision,
+                'agreement': statistics.mean(
+                    detection_agreement(pred, ref) for pred, ref in zip(predictions, reference)),
+            })
+            report.append(row)
+
+    print(f"{len(cards)} cards, {len(photos)} photos, {args.backend} backend")
+    if args.markdown:
+        print("| model | precision | agreement | mean s | p50 s | MB | load s |")
+        print("|---|---|---:|---:|---:|---:|---:|")
+        for row in report:
+            print(f"| {row['model']} | {row['precision']} | {row['agreement']:.3f} | {row['latency_mean']:.3f} "
+                  f"| {row['latency_p50']:.3f} | {row['memory_mb']:.0f} | {row['load_seconds']:.1f} |")
+    else:
+        print(f"{'model':<12}{'precision':<10}{'agreement':>10}{'mean s':>9}{'p50 s':>9}{'MB':>8}{'load s':>8}")
+        for row in report:
+            print(f"{row['model']:<12}{row['precision']:<10}{row['agreement']:>10.3f}{row['latency_mean']:>9.3f}"
+                  f"{row['latency_p50']:>9.3f}{row['memory_mb']:>8.0f}{row['load_seconds']:>8.1f}")
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump({'backend': args.backend, 'cards': card_paths, 'photos': photo_paths, 'results': report}, fd, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Time a handler spends saving a rated guess and the size of dixit_results.db: the previous
+INSERT and commit on a shared connection with the grid in every row, versus ResultsStore, e.g.
+
+    python benchmarks/bench_results.py --games 20000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from results import ResultsStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The table as it was before the grids moved to image_grids, without any index
+LEGACY_SCHEMA = """
+CREATE TABLE guesses_from_hand(
+    image_grid BLOB,
+    guessed_image TEXT,
+    final_answer TEXT,
+    score INTEGER,
+    clue TEXT,
+    clue_relations TEXT
+);
+"""
+
+
+def synthetic_guesses(num_games, num_grids, grid_bytes, seed=0):
+    # Guesses from the hand reuse the same few hand grids, so grids repeat across rows
+    rng = random.Random(seed)
+    grids = [rng.randbytes(grid_bytes) for _ in range(num_grids)]
+    for idx in range(num_games):
+        yield rng.choice(grids), {
+            'guessed_image': f"Image_{rng.randrange(6)}",
+            'final_answer': "Image_1 fits the clue best",
+            'score': rng.randrange(7),
+            'clue': f"clue {rng.randrange(num_games // 10 + 1)}",
+            'clue_relations': "relation " * 40,
+        }
+
+
+def db_bytes(path):
+    return sum(os.path.getsize(p) for p in [path, path + "-wal"] if os.path.exists(p))
+
+
+def latency_stats(latencies):
+    return {'mean_ms': 1000 * statistics.mean(latencies), 'p50_ms': 1000 * statistics.median(latencies),
+            'max_ms': 1000 * max(latencies)}
+
+
+def benchmark_legacy(folder, guesses):
+    path = os.path.join(folder, "legacy.db")
+    con = sqlite3.connect(path, check_same_thread=False)
+    con.executescript(LEGACY_SCHEMA)
+    latencies = []
+    for grid, row in guesses:
+        start = time.perf_counter()
+        con.execute("INSERT INTO guesses_from_hand VALUES(:image_grid, :guessed_image, :final_answer, :score, :clue, :clue_relations)",
+                    dict(row, image_grid=grid))
+        con.commit()
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    con.execute("SELECT COUNT(*) FROM guesses_from_hand WHERE clue = 'clue 1'").fetchone()
+    query_seconds = time.perf_counter() - start
+    con.close()
+    return {'save': latency_stats(latencies), 'total_seconds': sum(latencies),
+            'query_by_clue_ms': 1000 * query_seconds, 'db_bytes': db_bytes(path)}
+
+
+def benchmark_store(folder, guesses):
+    path = os.path.join(folder, "results.db")
+    store = ResultsStore(path, os.path.join(ROOT, "schema.sql"))
+    latencies = []
+    total_start = time.perf_counter()
+    for grid, row in guesses:
+        start = time.perf_counter()
+        store.put("guesses_from_hand", row, grid_bytes=grid)
+        latencies.append(time.perf_counter() - start)
+    store.flush()
+    total_seconds = time.perf_counter() - total_start
+    start = time.perf_counter()
+    store.query("SELECT COUNT(*) FROM guesses_from_hand WHERE clue = 'clue 1'")
+    query_seconds = time.perf_counter() - start
+    store.close()
+    return {'save': latency_stats(latencies), 'total_seconds': total_seconds,
+            'query_by_clue_ms': 1000 * query_seconds, 'db_bytes': db_bytes(path)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', type=int, default=5000)
+    parser.add_argument('--grids', type=int, default=50)
+    parser.add_argument('--grid-bytes', type=int, default=200_000)
+    args = parser.parse_args()
+
+    guesses = list(synthetic_guesses(args.games, args.grids, args.grid_bytes))
+    with tempfile.TemporaryDirectory() as folder:
+        report = {
+            'legacy': benchmark_legacy(folder, guesses),
+            'results_store': benchmark_store(folder, guesses),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Offline end-to-end latency of the bot pipeline: detection and cropping, captioning, clue
+generation and guessing for every table photo of a folder, with the OpenAI LLM replaced by a
+deterministic local stub of configurable latency. The first pass over the photos is the cold
+start (models load on first use), the following passes are warm. Prints a JSON report with
+p50/p95 per stage and per model and the peak RSS, e.g.
+
+    python benchmarks/end_to_end.py --photos "photos/*.jpg" --warm-runs 3 --output baseline.json
+    DIXITAI_PRECISION="git_large=int8" python benchmarks/end_to_end.py --photos ... --output int8.json
+    python benchmarks/end_to_end.py --photos ... --adaptive-captioning --caption-budget 8 --output adaptive.json
+"""
+import argparse
+import glob
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from langchain.llms.base import LLM
+from langchain.schema import Generation, LLMResult
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import captioning
+import preprocessing
+import prompts
+from detection import CARD_LABELS, load_detector
+from embedding import ClipEmbedder
+from image_store import ImageStore
+from model_registry import ModelRegistry, parse_model_config
+from utils import get_cards_from_image
+from workers import percentile
+
+from fake_openai import stub_completion
+
+
+class StubLLM(LLM):
+    """Stands in for langchain's OpenAI LLM: same constructor arguments, answers with the words
+    of fake_openai.stub_completion. Like one API request, a call with several prompts sleeps
+    latency plus token_latency per token of the longest answer once."""
+
+    model_name: str = "stub"
+    max_tokens: int = 256
+    request_timeout: float = None
+    streaming: bool = False
+    latency: float = 0.5
+    token_latency: float = 0.0
+    num_tokens: int = 60
+    # Dict whose 'timings' entry collects the call latencies, it changes between passes
+    recorder: dict = None
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        return self._generate([prompt], stop=stop, run_manager=run_manager).generations[0][0].text
+
+    def _generate(self, prompts, stop=None, run_manager=None, **kwargs):
+        start = time.perf_counter()
+        answers = [stub_completion(prompt, min(self.num_tokens, self.max_tokens)) for prompt in prompts]
+        time.sleep(self.latency + self.token_latency * max(len(tokens) for tokens in answers))
+        texts = [" " + " ".join(tokens) for tokens in answers]
+        if self.streaming and run_manager is not None:
+            for token in texts[0].split(" ")[1:]:
+                run_manager.on_llm_new_token(" " + token)
+        if self.recorder is not None and self.recorder.get('timings') is not None:
+            self.recorder['timings'].add(f"llm/{self.model_name}", time.perf_counter() - start)
+        return LLMResult(generations=[[Generation(text=text)] for text in texts])
+
+
+class Timings:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.samples[name].append(seconds)
+
+    @contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        yield
+        self.add(name, time.perf_counter() - start)
+
+    def report(self):
+        return {
+            name: {
+                'count': len(samples),
+                'p50_ms': 1000 * percentile(samples, 0.5),
+                'p95_ms': 1000 * percentile(samples, 0.95),
+                'total_s': sum(samples),
+            }
+            for name, samples in sorted(self.samples.items())
+        }
+
+
+class TimedModels:
+    """Wraps CaptioningModelsWrapper and times every call of every captioner. BLIP-2 answering
+    a QnA question and BLIP-2 on the reduced budget of adaptive captioning are timed apart."""
+
+    def __init__(self, models, timings):
+        self.models = models
+        self.timings = timings
+        self.model_names = models.model_names
+        self.adaptive = models.adaptive
+
+    def __getattr__(self, attr):
+        model = getattr(self.models, attr)
+
+        def timed(*args, **kwargs):
+            name = attr
+            if len(args) > 1 or 'question' in kwargs:
+                name += "_qna"
+            elif 'num_beams' in kwargs:
+                name += "_reduced"
+            with self.timings.measure(f"model/{name}"):
+                return model(*args, **kwargs)
+
+        return timed
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_photo(path, detector, models, image_store, timings, num_blip2_questions, captioned):
+    with timings.measure('end_to_end'):
+        image = Image.open(path)
+        with timings.measure('stage/detection'):
+            prediction = detector(image, candidate_labels=CARD_LABELS)
+        with timings.measure('stage/crop_and_grid'):
+            cards_dict = get_cards_from_image(prediction, image, image_store)
+        if len(cards_dict['images']) == 0:
+            return 0
+        # One preprocessing artifact per photo, like a bot request
+        cards = preprocessing.PreparedImages(cards_dict['images'])
+        with timings.measure('stage/captioning'):
+            captions = captioning.generate_captions(cards, models)
+        for card_captions in captions:
+            captioned.update(card_captions['models'])
+        with timings.measure('stage/clue'):
+            clue_dict = prompts.generate_clue_for_image(
+                cards[0], captioning.generate_captions, models,
+                num_blip2_questions=num_blip2_questions, captioning_results=captions[0], verbose=False)
+        with timings.measure('stage/guess'):
+            prompts.guess_image_by_clue(
+                cards, clue_dict['clue'], captioning.generate_captions, models, verbose=False)
+    return len(cards_dict['images'])
+
+
+def run_pass(photos, detector, models, image_store, timings, num_blip2_questions):
+    models = TimedModels(models, timings)
+    # Cards captioned by each model, adaptive captioning leaves some out
+    captioned = Counter()
+    start = time.perf_counter()
+    cards = [
+        run_photo(path, detector, models, image_store, timings, num_blip2_questions, captioned) for path in photos
+    ]
+    return {
+        'wall_s': time.perf_counter() - start,
+        'cards': sum(cards),
+        'captioned_cards': dict(captioned),
+        'photos_without_cards': sum(num_cards == 0 for num_cards in cards),
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--photos', required=True, help="glob of table photos")
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--warm-runs', type=int, default=2)
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="seconds per LLM call")
+    parser.add_argument('--llm-token-latency', type=float, default=0.0, help="extra seconds per generated token")
+    parser.add_argument('--llm-tokens', type=int, default=60)
+    parser.add_argument('--blip2-questions', type=int, default=3)
+    parser.add_argument('--precision', default=os.environ.get('DIXITAI_PRECISION'))
+    parser.add_argument('--backend', default=os.environ.get('DIXITAI_BACKEND'))
+    parser.add_argument('--adaptive-captioning', action='store_true', help="see captioning.AdaptiveCaptioning")
+    parser.add_argument('--caption-budget', type=float, default=captioning.FULL_COST)
+    parser.add_argument('--caption-agreement', type=float, default=0.9)
+    parser.add_argument('--output', default=None, help="write the report here instead of stdout")
+    args = parser.parse_args()
+
+    photos = sorted(glob.glob(args.photos))[:args.limit]
+    if len(photos) == 0:
+        sys.exit(f"No photos match {args.photos}")
+
+    # Every OpenAI LLM the chains create is a stub from here on
+    recorder = {'timings': None}
+    prompts.OpenAI = lambda **kwargs: StubLLM(
+        latency=args.llm_latency, token_latency=args.llm_token_latency, num_tokens=args.llm_tokens,
+        recorder=recorder, **kwargs)
+
+    precision = parse_model_config(args.precision)
+    backend = parse_model_config(args.backend)
+    registry = ModelRegistry()
+    registry.register('owlvit', lambda: load_detector(precision.get('owlvit'), backend.get('owlvit', 'torch')))
+    registry.register(
+        'clip_embedder', lambda: ClipEmbedder.load(detector=registry.get('owlvit')), depends_on='owlvit')
+    adaptive = None
+    if args.adaptive_captioning:
+        adaptive = captioning.AdaptiveCaptioning(
+            lambda texts: registry.get('clip_embedder').embed_texts(texts),
+            budget=args.caption_budget, agreement=args.caption_agreement)
+    models = captioning.CaptioningModelsWrapper(
+        registry=registry, precision=precision, backend=backend, adaptive=adaptive)
+
+    def detector(image, **kwargs):
+        return registry.get('owlvit')(image, **kwargs)
+
+    rss_at_start = peak_rss_bytes()
+    cold_timings, warm_timings = Timings(), Timings()
+    with tempfile.TemporaryDirectory() as folder:
+        image_store = ImageStore(os.path.join(folder, "images"), os.path.join(folder, "image_store.db"))
+        recorder['timings'] = cold_timings
+        cold = run_pass(photos, detector, models, image_store, cold_timings, args.blip2_questions)
+        # The warm passes share one set of samples, their percentiles cover all warm runs
+        recorder['timings'] = warm_timings
+        warm = [
+            run_pass(photos, detector, models, image_store, warm_timings, args.blip2_questions)
+            for _ in range(args.warm_runs)
+        ]
+
+    report = {
+        'config': {
+            'photos': len(photos),
+            'llm_latency_s': args.llm_latency,
+            'llm_token_latency_s': args.llm_token_latency,
+            'llm_tokens': args.llm_tokens,
+            'blip2_questions': args.blip2_questions,
+            'precision': precision,
+            'backend': backend,
+            'captioning': adaptive.config if adaptive is not None else {'mode': 'full'},
+        },
+        'rss_at_start_bytes': rss_at_start,
+        'model_loads': {
+            name: {'load_seconds': stats['load_seconds'], 'memory_bytes': stats['memory_bytes']}
+            for name, stats in registry.stats()['models'].items()
+        },
+        'cold': dict(cold, timings=cold_timings.report()),
+        'warm': {'runs': warm, 'timings': warm_timings.report()},
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as fd:
+            fd.write(text + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Local stand-in for the OpenAI completions API, for running the bot and the benchmarks without
+the real API. Answers are derived from the hash of the prompt, every request sleeps latency plus
+token_latency per token of its longest answer, whatever the number of prompts in it, e.g.
+
+    python benchmarks/fake_openai.py --port 8001 --latency 0.5
+    OPENAI_API_BASE=http://127.0.0.1:8001/v1 OPENAI_API_KEY=fake python dixitbot.py
+
+GET /stats returns the number of requests and prompts served so far.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "a quiet lantern floats over the sea while an old fox reads the map of forgotten stars "
+    "and the children follow a paper boat into the clouds under the sleeping moon").split()
+
+
+def stub_completion(prompt, num_tokens):
+    # Deterministic words for the prompt. Prompts asking for the final image name get an
+    # Image_<n> of the prompt, like the real model is asked to answer.
+    rng = random.Random(hashlib.sha256(prompt.encode()).hexdigest())
+    tokens = [rng.choice(WORDS) for _ in range(num_tokens)]
+    image_names = re.findall(r'Image_\d+', prompt)
+    if "final answer as the image name" in prompt and len(image_names) > 0:
+        tokens += ["so", "the", "answer", "is", rng.choice(image_names)]
+    return tokens
+
+
+class FakeOpenAI:
+    def __init__(self, latency=0.5, token_latency=0.0, num_tokens=60):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.num_tokens = num_tokens
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.prompts = 0
+
+    def complete(self, body):
+        prompts = body.get('prompt', "")
+        prompts = [prompts] if isinstance(prompts, str) else prompts
+        num_tokens = min(self.num_tokens, body.get('max_tokens') or self.num_tokens)
+        answers = [stub_completion(prompt, num_tokens) for prompt in prompts for _ in range(body.get('n') or 1)]
+        with self.lock:
+            self.requests += 1
+            self.prompts += len(prompts)
+        time.sleep(self.latency + self.token_latency * max(len(tokens) for tokens in answers))
+        return prompts, answers
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/stats":
+                self.send_error(404)
+                return
+            with fake.lock:
+                self.send_json({'requests': fake.requests, 'prompts': fake.prompts})
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith("/completions"):
+                self.send_error(404)
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+            prompts, answers = fake.complete(body)
+            model = body.get('model', "fake")
+            if body.get('stream'):
+                self.stream(model, answers[0])
+                return
+            self.send_json({
+                'id': f"cmpl-{time.time_ns()}",
+                'object': "text_completion",
+                'created': int(time.time()),
+                'model': model,
+                'choices': [
+                    {'text': " " + " ".join(tokens), 'index': idx, 'logprobs': None, 'finish_reason': "stop"}
+                    for idx, tokens in enumerate(answers)
+                ],
+                'usage': {
+                    'prompt_tokens': sum(len(prompt.split()) for prompt in prompts),
+                    'completion_tokens': sum(len(tokens) for tokens in answers),
+                    'total_tokens': sum(len(prompt.split()) for prompt in prompts) + sum(len(tokens) for tokens in answers),
+                },
+            })
+
+        def stream(self, model, tokens):
+            # Server-sent events, one token per chunk, as the API streams a single prompt
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for idx, token in enumerate(tokens):
+                chunk = {
+                    'id': "cmpl-stream", 'object': "text_completion", 'created': int(time.time()), 'model': model,
+                    'choices': [{'text': " " + token, 'index': 0, 'logprobs': None,
+                                 'finish_reason': "stop" if idx == len(tokens) - 1 else None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(port=8001, host="127.0.0.1", **kwargs):
+    # Serves from a daemon thread, returns the server and the FakeOpenAI with its request counts
+    fake = FakeOpenAI(**kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, fake
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.5, help="seconds per request")
+    parser.add_argument('--token-latency', type=float, default=0.0, help="extra seconds per token of the longest answer")
+    parser.add_argument('--tokens', type=int, default=60)
+    args = parser.parse_args()
+    server, _ = start_server(args.port, latency=args.latency, token_latency=args.token_latency, num_tokens=args.tokens)
+    print(f"Serving fake completions on http://127.0.0.1:{args.port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
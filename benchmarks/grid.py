@@ -0,0 +1,123 @@
+"""Crop-and-grid time of get_cards_from_image for 6 and 12 cards: the previous path (write the
+crops, reopen them, label every tile through a PIL -> numpy -> PIL copy, paste one by one)
+versus the in-memory grid with asynchronous card writes, e.g.
+
+    python benchmarks/grid.py --repeats 20
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_store import ImageStore
+from utils import build_image_grid, get_cards_from_image, grid_shape_for, wait_for_card_files
+
+CARD_SIZE = (420, 640)
+
+
+def synthetic_photo(num_cards, seed=0):
+    # A table photo with the cards laid out in rows, and the matching detector output
+    rng = np.random.default_rng(seed)
+    rows, cols = grid_shape_for(num_cards)
+    margin = 40
+    width, height = cols * (CARD_SIZE[0] + margin) + margin, rows * (CARD_SIZE[1] + margin) + margin
+    photo = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    prediction = []
+    for i in range(num_cards):
+        xmin = margin + (i % cols) * (CARD_SIZE[0] + margin)
+        ymin = margin + (i // cols) * (CARD_SIZE[1] + margin)
+        # Detected boxes differ by a few pixels, so the tiles need resizing
+        prediction.append({"score": 0.5, "label": "card", "box": {
+            "xmin": xmin, "ymin": ymin,
+            "xmax": xmin + CARD_SIZE[0] - int(rng.integers(0, 8)),
+            "ymax": ymin + CARD_SIZE[1] - int(rng.integers(0, 8))}})
+    return Image.fromarray(photo), prediction
+
+
+def legacy_build_image_grid(image_paths, border=0):
+    images = [Image.open(p) for p in image_paths]
+    grid_shape = grid_shape_for(len(images))
+    images = [img.resize(images[0].size) for img in images]
+    for i, img in enumerate(images):
+        img_copy = np.array(img).copy()
+        cv2.putText(img_copy, str(i), (img.size[0] // 2, img.size[1] // 2),
+                    cv2.FONT_HERSHEY_DUPLEX, 3, (0, 0, 255), 5)
+        images[i] = Image.fromarray(img_copy)
+    grid = Image.new('RGB', (
+        grid_shape[1] * images[0].size[0] + (grid_shape[1] - 1) * border,
+        grid_shape[0] * images[0].size[1] + (grid_shape[0] - 1) * border,
+    ))
+    for i, img in enumerate(images):
+        grid.paste(img, (
+            (i % grid_shape[1]) * (img.size[0] + border),
+            (i // grid_shape[1]) * (img.size[1] + border),
+        ))
+    return grid
+
+
+def legacy_get_cards_from_image(prediction, image_path):
+    image = Image.open(image_path)
+    prefix, ext = os.path.splitext(image_path)
+    images = [image.crop(tuple(pred["box"].values())) for pred in prediction]
+    paths = []
+    for i, im in enumerate(images):
+        paths.append(f"{prefix}_card-{i}-of-{len(images)}{ext}")
+        im.save(paths[-1])
+    return {'images': images, 'grid': legacy_build_image_grid(paths), 'card_paths': paths}
+
+
+def timed(fn, repeats, after=None):
+    # after runs outside the measured time, e.g. to wait for background writes between repeats
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        latencies.append(time.perf_counter() - start)
+        if after is not None:
+            after(result)
+    return {'mean_ms': 1000 * statistics.mean(latencies), 'p50_ms': 1000 * statistics.median(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cards', type=int, nargs='+', default=[6, 12])
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    report = dict()
+    with tempfile.TemporaryDirectory() as folder:
+        image_store = ImageStore(os.path.join(folder, "images"), os.path.join(folder, "image_store.db"))
+        for num_cards in args.cards:
+            photo, prediction = synthetic_photo(num_cards)
+            photo_path = os.path.join(folder, f"photo-{num_cards}.jpg")
+            photo.save(photo_path)
+
+            def in_memory():
+                # The request path ends once the grid is built, file writes finish in the background.
+                # Crops are stored by content hash, after the first repeat they are already there.
+                return get_cards_from_image(prediction, Image.open(photo_path), image_store)
+
+            in_memory_stats = timed(in_memory, args.repeats, after=wait_for_card_files)
+            report[f"{num_cards}_cards"] = {
+                'legacy': timed(lambda: legacy_get_cards_from_image(prediction, photo_path), args.repeats),
+                'in_memory': in_memory_stats,
+                'grid_only_legacy': timed(lambda: legacy_build_image_grid(
+                    [f"{os.path.splitext(photo_path)[0]}_card-{i}-of-{num_cards}.jpg" for i in range(num_cards)]),
+                    args.repeats),
+                'grid_only_in_memory': timed(lambda: build_image_grid(
+                    [photo.crop(tuple(pred["box"].values())) for pred in prediction]), args.repeats),
+            }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
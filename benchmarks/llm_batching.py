@@ -0,0 +1,75 @@
+"""HTTP round-trips and wall time of the clue relation step of /guess_hand against
+benchmarks/fake_openai.py: one client and one request per card on 4 threads as before, versus
+guess_image_by_clue sending the prompts of all cards in one request, e.g.
+
+    python benchmarks/llm_batching.py --cards 6 12 --latency 0.5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_openai import start_server
+
+
+def hand_descriptions(num_cards):
+    return [
+        {
+            'captions': {'captions': f"Git-Large: a card with a lantern number {idx}", 'models': ['Git-Large']},
+            'qna_session': "",
+            'interpretation': f"A quiet lantern floats over the sea, card {idx}.",
+            'pre_qna_interpretation': "",
+        }
+        for idx in range(num_cards)
+    ]
+
+
+def per_card_clue_relations(prompts_module, descriptions, clue):
+    # The previous path: a new client and chain per card, the cards on 4 threads
+    def relate(description):
+        llm = prompts_module.CompletionOpenAI(model_name='gpt-3.5-turbo-instruct', max_tokens=512, request_timeout=60)
+        chain = prompts_module.LLMChain(
+            llm=llm, prompt=prompts_module.get_clue_relation_chain(verbose=False).prompt, output_key="association")
+        return chain.predict(interpretation=description['interpretation'], clue=clue)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        return list(executor.map(relate, descriptions))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cards', type=int, nargs='+', default=[6, 12])
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--port', type=int, default=8001)
+    args = parser.parse_args()
+
+    _, fake = start_server(args.port, latency=args.latency)
+    os.environ['OPENAI_API_BASE'] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ.setdefault('OPENAI_API_KEY', "fake")
+    import prompts
+
+    def measure(fn):
+        requests_before = fake.requests
+        start = time.perf_counter()
+        fn()
+        return {'wall_s': time.perf_counter() - start, 'requests': fake.requests - requests_before}
+
+    report = dict()
+    for num_cards in args.cards:
+        descriptions = hand_descriptions(num_cards)
+        report[f"{num_cards}_cards"] = {
+            'per_card': measure(lambda: per_card_clue_relations(prompts, descriptions, "lost at sea")),
+            # Includes the final answer request
+            'batched': measure(lambda: prompts.guess_image_by_clue(
+                [f"card-{idx}.jpg" for idx in range(num_cards)], "lost at sea", None, None,
+                generated_descriptions=descriptions, verbose=False)),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
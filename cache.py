@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import langchain
+import numpy as np
+from langchain.cache import BaseCache
+from langchain.schema import Generation
+
+import tracing
+
+
+def image_content_hash(image):
+    # Hash of the decoded pixels, so the same card gives the same key whatever file it came from
+    array = np.ascontiguousarray(np.asarray(image))
+    digest = hashlib.sha256()
+    digest.update(f"{array.shape}{array.dtype}".encode())
+    digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def config_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+class CardCache:
+    """Per-card pipeline results (captions, QnA session, interpretations) keyed by
+    image content hash, stage name and the pipeline config that produced them."""
+
+    def __init__(self, path=".cache/card_cache.db", max_bytes=256 * 1024 * 1024):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS card_cache(
+                image_hash TEXT,
+                stage TEXT,
+                config TEXT,
+                value TEXT,
+                size INTEGER,
+                last_access REAL,
+                PRIMARY KEY(image_hash, stage, config)
+            );
+            CREATE INDEX IF NOT EXISTS card_cache_last_access ON card_cache(last_access);
+        """)
+        self.total_bytes = self.con.execute("SELECT COALESCE(SUM(size), 0) FROM card_cache").fetchone()[0]
+
+    def get(self, image_hash, stage, config):
+        key = config_key(config)
+        with self.lock:
+            row = self.con.execute(
+                "SELECT value FROM card_cache WHERE image_hash = ? AND stage = ? AND config = ?",
+                (image_hash, stage, key)).fetchone()
+            if row is None:
+                self.misses[stage] += 1
+                return None
+            self.hits[stage] += 1
+            self.con.execute(
+                "UPDATE card_cache SET last_access = ? WHERE image_hash = ? AND stage = ? AND config = ?",
+                (time.time(), image_hash, stage, key))
+            self.con.commit()
+        return json.loads(row[0])
+
+    def put(self, image_hash, stage, config, value):
+        key = config_key(config)
+        value = json.dumps(value)
+        with self.lock:
+            row = self.con.execute(
+                "SELECT size FROM card_cache WHERE image_hash = ? AND stage = ? AND config = ?",
+                (image_hash, stage, key)).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self.con.execute(
+                "INSERT OR REPLACE INTO card_cache VALUES(?, ?, ?, ?, ?, ?)",
+                (image_hash, stage, key, value, len(value), time.time()))
+            self.total_bytes += len(value)
+            self._evict()
+            self.con.commit()
+
+    def _evict(self):
+        # Drop least recently used entries until we fit into the size budget
+        while self.total_bytes > self.max_bytes:
+            row = self.con.execute(
+                "SELECT rowid, size FROM card_cache ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                self.total_bytes = 0
+                break
+            self.con.execute("DELETE FROM card_cache WHERE rowid = ?", (row[0],))
+            self.total_bytes -= row[1]
+
+    def stats(self):
+        with self.lock:
+            entries = self.con.execute("SELECT COUNT(*) FROM card_cache").fetchone()[0]
+            stages = sorted(set(self.hits) | set(self.misses))
+            return {
+                'entries': entries,
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'stages': {stage: {'hits': self.hits[stage], 'misses': self.misses[stage]} for stage in stages},
+            }
+
+
+class CompletionCache(BaseCache):
+    """LangChain LLM cache persisted in SQLite. The key is the rendered prompt together with
+    LangChain's llm_string, which covers the model name, max_tokens and sampling parameters."""
+
+    # A miss whose completion hasn't been stored after this long failed or was aborted
+    pending_timeout_seconds = 600
+
+    def __init__(self, path=".cache/completion_cache.db", max_entries=20000, ttl_seconds=7 * 24 * 3600):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS completion_cache(
+                key TEXT PRIMARY KEY,
+                generations TEXT,
+                latency REAL,
+                created_at REAL,
+                last_access REAL
+            );
+            CREATE INDEX IF NOT EXISTS completion_cache_last_access ON completion_cache(last_access);
+        """)
+
+    @contextmanager
+    def bypass(self):
+        # Completions requested inside this block always go to the API and are not stored
+        previous = getattr(self.local, 'bypass', False)
+        self.local.bypass = True
+        try:
+            yield
+        finally:
+            self.local.bypass = previous
+
+    def _pending(self):
+        # LangChain looks up and stores the completions of a call on the thread that made it
+        if not hasattr(self.local, 'pending'):
+            self.local.pending = dict()
+        return self.local.pending
+
+    def _key(self, prompt, llm_string):
+        return hashlib.sha256(f"{llm_string}\n{prompt}".encode()).hexdigest()
+
+    def lookup(self, prompt, llm_string):
+        if getattr(self.local, 'bypass', False):
+            return None
+        with tracing.span("llm_cache", size=len(prompt)) as lookup_span:
+            generations = self._lookup(prompt, llm_string)
+            lookup_span.set(cache='miss' if generations is None else 'hit')
+        return generations
+
+    def _lookup(self, prompt, llm_string):
+        key = self._key(prompt, llm_string)
+        now = time.time()
+        with self.lock:
+            row = self.con.execute(
+                "SELECT generations, latency, created_at FROM completion_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[2] > self.ttl_seconds:
+                self.con.execute("DELETE FROM completion_cache WHERE key = ?", (key,))
+                self.con.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                # Remember when the request went out to know how long a hit saves, update() is
+                # never called for a request that fails, its start time is dropped after a while
+                pending = self._pending()
+                started = time.monotonic()
+                for stale in [other for other, at in pending.items() if started - at > self.pending_timeout_seconds]:
+                    del pending[stale]
+                pending[key] = started
+                return None
+            self.hits += 1
+            self.saved_seconds += row[1]
+            self.con.execute("UPDATE completion_cache SET last_access = ? WHERE key = ?", (now, key))
+            self.con.commit()
+        return [Generation(**generation) for generation in json.loads(row[0])]
+
+    def update(self, prompt, llm_string, return_val):
+        if getattr(self.local, 'bypass', False):
+            return
+        key = self._key(prompt, llm_string)
+        generations = json.dumps([
+            {'text': generation.text, 'generation_info': generation.generation_info}
+            for generation in return_val
+        ])
+        now = time.time()
+        started = self._pending().pop(key, None)
+        with self.lock:
+            latency = time.monotonic() - started if started is not None else 0.0
+            self.con.execute(
+                "INSERT OR REPLACE INTO completion_cache VALUES(?, ?, ?, ?, ?)",
+                (key, generations, latency, now, now))
+            self._evict(now)
+            self.con.commit()
+
+    def _evict(self, now):
+        self.con.execute("DELETE FROM completion_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        self.con.execute(
+            "DELETE FROM completion_cache WHERE key IN ("
+            "SELECT key FROM completion_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,))
+
+    def clear(self, **kwargs):
+        with self.lock:
+            self.con.execute("DELETE FROM completion_cache")
+            self.con.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.con.execute("SELECT COUNT(*) FROM completion_cache").fetchone()[0]
+            return {
+                'entries': entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'saved_seconds': self.saved_seconds,
+            }
+
+
+def install_completion_cache(path=".cache/completion_cache.db", **kwargs):
+    completion_cache = CompletionCache(path, **kwargs)
+    langchain.llm_cache = completion_cache
+    return completion_cache
@@ -1,7 +1,17 @@
+import threading
+from collections import OrderedDict
+from importlib import metadata
+
 import torch
 from lavis.models import load_model_and_preprocess
 from PIL import Image
 
+import preprocessing
+import tracing
+from cache import image_content_hash
+from model_registry import ModelRegistry
+from precision import apply_precision
+
 from transformers import (
     AutoProcessor, AutoTokenizer, AutoImageProcessor, AutoModelForCausalLM,
     BlipForConditionalGeneration, VisionEncoderDecoderModel, ViTFeatureExtractor
@@ -9,11 +19,13 @@ from transformers import (
 
 
 class CaptioningModel:
-    def get_git_large_coco():
+    def get_git_large_coco(load_model=True):
         device = "cuda" if torch.cuda.is_available() else "cpu"
         git_processor_large = AutoProcessor.from_pretrained("microsoft/git-large-coco")
-        git_model_large = AutoModelForCausalLM.from_pretrained("microsoft/git-large-coco")
-        git_model_large.to(device)
+        git_model_large = None
+        if load_model:
+            git_model_large = AutoModelForCausalLM.from_pretrained("microsoft/git-large-coco")
+            git_model_large.to(device)
         return {
             'name': 'git_large',
             'model': git_model_large,
@@ -21,11 +33,13 @@ class CaptioningModel:
             'tokenizer': None,
         }
 
-    def get_git_base_coco():
+    def get_git_base_coco(load_model=True):
         device = "cuda" if torch.cuda.is_available() else "cpu"
         git_processor_large = AutoProcessor.from_pretrained("microsoft/git-base-coco")
-        git_model_base = AutoModelForCausalLM.from_pretrained("microsoft/git-base-coco")
-        git_model_base.to(device)
+        git_model_base = None
+        if load_model:
+            git_model_base = AutoModelForCausalLM.from_pretrained("microsoft/git-base-coco")
+            git_model_base.to(device)
         return {
             'name': 'git_base',
             'model': git_model_base,
@@ -33,11 +47,13 @@ class CaptioningModel:
             'tokenizer': None,
         }
 
-    def get_blip_base():
+    def get_blip_base(load_model=True):
         device = "cuda" if torch.cuda.is_available() else "cpu"
         blip_processor_base = AutoProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-        blip_model_base = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-        blip_model_base.to(device)
+        blip_model_base = None
+        if load_model:
+            blip_model_base = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
+            blip_model_base.to(device)
         return {
             'name': 'blip_base',
             'model': blip_model_base,
@@ -45,11 +61,13 @@ class CaptioningModel:
             'tokenizer': None,
         }
 
-    def get_blip_large():
+    def get_blip_large(load_model=True):
         device = "cuda" if torch.cuda.is_available() else "cpu"
         blip_processor_large = AutoProcessor.from_pretrained("Salesforce/blip-image-captioning-large")
-        blip_model_large = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-large")
-        blip_model_large.to(device)
+        blip_model_large = None
+        if load_model:
+            blip_model_large = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-large")
+            blip_model_large.to(device)
         return {
             'name': 'blip_large',
             'model': blip_model_large,
@@ -57,12 +75,14 @@ class CaptioningModel:
             'tokenizer': None,
         }
 
-    def get_vitgpt2():
+    def get_vitgpt2(load_model=True):
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        vitgpt_model = VisionEncoderDecoderModel.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
+        vitgpt_model = None
+        if load_model:
+            vitgpt_model = VisionEncoderDecoderModel.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
+            vitgpt_model.to(device)
         vitgpt_processor = ViTFeatureExtractor.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
         vitgpt_tokenizer = AutoTokenizer.from_pretrained("nlpconnect/vit-gpt2-image-captioning")
-        vitgpt_model.to(device)
         return {
             'name': 'vit_gpt2',
             'model': vitgpt_model,
@@ -70,27 +90,65 @@ class CaptioningModel:
             'tokenizer': vitgpt_tokenizer,
         }
 
-    def __init__(self, name="git_large_coco"):
+    def __init__(self, name="git_large_coco", max_batch_size=8, precision='fp32', backend='torch'):
+        self.max_batch_size = max_batch_size
+        load_model = True
+        if backend == 'onnx':
+            # onnxruntime is only needed by the ONNX backend
+            import onnx_backend
+            # The ONNX backend only needs the torch weights once, to export the model
+            load_model = not onnx_backend.is_exported(name)
         if name == 'git_large_coco':
-            self.model = CaptioningModel.get_git_large_coco()
+            self.model = CaptioningModel.get_git_large_coco(load_model)
         elif name == 'git_base_coco':
-            self.model = CaptioningModel.get_git_base_coco()
+            self.model = CaptioningModel.get_git_base_coco(load_model)
         elif name == 'blip_base':
-            self.model = CaptioningModel.get_blip_base()
+            self.model = CaptioningModel.get_blip_base(load_model)
         elif name == 'blip_large':
-            self.model = CaptioningModel.get_blip_large()
+            self.model = CaptioningModel.get_blip_large(load_model)
         elif name == 'vit_gpt2':
-            self.model = CaptioningModel.get_vitgpt2()
+            self.model = CaptioningModel.get_vitgpt2(load_model)
+
+        if backend == 'onnx':
+            self.model['model'] = onnx_backend.OnnxCaptioner.load(name, self.model['model'], precision)
+            self.dtype = torch.float32
+        else:
+            self.model['model'], self.dtype = apply_precision(self.model['model'], precision)
+
+    def __call__(self, images, max_batch_size=None):
+        # Accepts a single image or a list of images, returns a caption or a list of captions
+        single_image = not isinstance(images, (list, tuple))
+        if single_image:
+            images = [images]
+        max_batch_size = max_batch_size or self.max_batch_size
 
-    def __call__(self, image):
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        inputs = self.model['processor'](images=image, return_tensors="pt").to(device)
-        generated_ids = self.model['model'].generate(pixel_values=inputs.pixel_values, max_length=50)
         if self.model['tokenizer'] is not None:
-            generated_caption = self.model['tokenizer'].batch_decode(generated_ids, skip_special_tokens=True)[0]
+            decoder = self.model['tokenizer']
         else:
-            generated_caption = self.model['processor'].batch_decode(generated_ids, skip_special_tokens=True)[0]
-        return generated_caption
+            decoder = self.model['processor']
+
+        generated_captions = []
+        for start in range(0, len(images), max_batch_size):
+            # The processor resizes every card to the same resolution, so a batch is one padded forward pass.
+            # Prepared images share the tensors with the other models using the same resize and normalization.
+            batch = images[start:start + max_batch_size]
+            pixel_values = preprocessing.pixel_values(self.model['processor'], batch)
+            generated_ids = self.model['model'].generate(pixel_values=pixel_values.to(device, self.dtype), max_length=50)
+            generated_captions.extend(decoder.batch_decode(generated_ids, skip_special_tokens=True))
+
+        if single_image:
+            return generated_captions[0]
+        return generated_captions
+
+
+# BLIP2Wrapper._encode and _decode split Blip2T5.generate() of these lavis releases in two, compare
+# them with generate() of a new release before adding it here
+BLIP2_T5_LAVIS_VERSIONS = ('1.0.2',)
+
+
+def lavis_version():
+    return metadata.version('salesforce-lavis')
 
 
 class BLIP2Wrapper:
@@ -100,77 +158,309 @@ class BLIP2Wrapper:
     # blip2_opt                      pretrain_opt2.7b, caption_coco_opt2.7b, pretrain_opt6.7b, caption_coco_opt6.7b
     # blip2_t5                       pretrain_flant5xl, caption_coco_flant5xl, pretrain_flant5xxl
     # blip2                          pretrain, coco
-    def __init__(self, name, model_type):
+    # The image feature cache follows the generate() of the blip2_t5 models
+    def __init__(self, name, model_type, max_batch_size=8, precision='fp32', feature_cache_size=256):
         # loads BLIP-2 pre-trained model
         device = "cuda" if torch.cuda.is_available() else "cpu"
+        version = lavis_version()
+        if version not in BLIP2_T5_LAVIS_VERSIONS:
+            raise RuntimeError(
+                f"BLIP2Wrapper follows Blip2T5.generate() of salesforce-lavis {', '.join(BLIP2_T5_LAVIS_VERSIONS)}, "
+                f"found {version}")
+        self.max_batch_size = max_batch_size
+        # Concurrent per-card chains share one BLIP-2, run its generate() calls one at a time
+        self.lock = threading.Lock()
         self.model, self.vis_processors, _ = load_model_and_preprocess(
             name=name, model_type=model_type,
             is_eval=True, device=device)
+        self.model, self.dtype = apply_precision(self.model, precision)
+        # T5 input embeddings of the recently seen images by content hash (32 query tokens, 256 KB
+        # each in fp32), so a card goes through the vision tower once for its caption and questions
+        self.feature_cache_size = feature_cache_size
+        self.features = OrderedDict()
 
-    def __call__(self, image, question=None,
-                 max_length=72, num_beams=4, repetition_penalty=1.9):
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        image_ts = self.vis_processors["eval"](
-            image
-        ).unsqueeze(0).to(device)
-
-        if question is None:
-            caption = self.model.generate(
-                {
-                    "image": image_ts
-                },
-                use_nucleus_sampling=False,
-                max_length=max_length,
-                min_length=32,
-                num_beams=num_beams,
-                repetition_penalty=repetition_penalty,
-            )
-        else:
-            caption = self.model.generate(
-                {
-                    "image": image_ts,
-                    "prompt": f"Question: {question}? Answer:",
-                },
-                use_nucleus_sampling=False,
-                max_length=max_length,
-                min_length=32,
+    @torch.no_grad()
+    def _encode(self, image_ts):
+        # ViT, Q-Former and the projection into the T5 input space
+        model = self.model
+        with model.maybe_autocast():
+            image_embeds = model.ln_vision(model.visual_encoder(image_ts))
+        # lavis casts to fp32 here, the Q-Former weights are bf16 once the model is converted and
+        # maybe_autocast does nothing on CPU, so the hidden states follow the Q-Former's dtype
+        image_embeds = image_embeds.to(model.query_tokens.dtype)
+        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image_ts.device)
+        query_tokens = model.query_tokens.expand(image_embeds.shape[0], -1, -1)
+        query_output = model.Qformer.bert(
+            query_embeds=query_tokens,
+            encoder_hidden_states=image_embeds,
+            encoder_attention_mask=image_atts,
+            return_dict=True,
+        )
+        return model.t5_proj(query_output.last_hidden_state)
+
+    @torch.no_grad()
+    def _decode(self, inputs_t5, prompts, max_length, min_length, num_beams, repetition_penalty):
+        model = self.model
+        atts_t5 = torch.ones(inputs_t5.size()[:-1], dtype=torch.long).to(inputs_t5.device)
+        input_tokens = model.t5_tokenizer(prompts, padding="longest", return_tensors="pt").to(inputs_t5.device)
+        encoder_atts = torch.cat([atts_t5, input_tokens.attention_mask], dim=1)
+        with model.maybe_autocast(dtype=torch.bfloat16):
+            inputs_embeds = model.t5_model.encoder.embed_tokens(input_tokens.input_ids)
+            inputs_embeds = torch.cat([inputs_t5.to(inputs_embeds.dtype), inputs_embeds], dim=1)
+            outputs = model.t5_model.generate(
+                inputs_embeds=inputs_embeds,
+                attention_mask=encoder_atts,
+                do_sample=False,
                 num_beams=num_beams,
+                max_new_tokens=max_length,
+                min_length=min_length,
                 repetition_penalty=repetition_penalty,
             )
-        return caption[0]
+        return model.t5_tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    def image_features(self, images, max_batch_size=None):
+        """T5 input embeddings of every image, the images missing from the cache are encoded in
+        batches. The same image object or pixels given twice are encoded once."""
+        max_batch_size = max_batch_size or self.max_batch_size
+        hashes_by_id = dict()
+        hashes = []
+        for image in images:
+            if id(image) not in hashes_by_id:
+                hashes_by_id[id(image)] = image_content_hash(image)
+            hashes.append(hashes_by_id[id(image)])
+
+        features = dict()
+        with self.lock:
+            for image_hash in hashes:
+                if image_hash in self.features:
+                    self.features.move_to_end(image_hash)
+                    features[image_hash] = self.features[image_hash]
+        # Index of the first image of every missing hash
+        missing = dict()
+        for idx, image_hash in enumerate(hashes):
+            if image_hash not in features:
+                missing.setdefault(image_hash, idx)
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        missing_hashes = list(missing)
+        with tracing.span("blip2_vision", size=len(missing_hashes), cache='miss' if len(missing) > 0 else 'hit'):
+            for start in range(0, len(missing_hashes), max_batch_size):
+                batch = missing_hashes[start:start + max_batch_size]
+                image_ts = preprocessing.pixel_values(
+                    self.vis_processors["eval"], preprocessing.select(images, [missing[image_hash] for image_hash in batch])
+                ).to(device, self.dtype)
+                with self.lock:
+                    inputs_t5 = self._encode(image_ts)
+                    for image_hash, image_features in zip(batch, inputs_t5):
+                        features[image_hash] = image_features
+                        self.features[image_hash] = image_features
+                    while len(self.features) > self.feature_cache_size:
+                        self.features.popitem(last=False)
+        return [features[image_hash] for image_hash in hashes]
+
+    def __call__(self, images, question=None,
+                 max_length=72, num_beams=4, repetition_penalty=1.9,
+                 max_batch_size=None, min_length=32):
+        # `question` is either one question for all images or a list with a question per image
+        single_image = not isinstance(images, (list, tuple))
+        if single_image:
+            images = [images]
+        if question is not None and not isinstance(question, (list, tuple)):
+            question = [question] * len(images)
+        max_batch_size = max_batch_size or self.max_batch_size
+
+        captions = []
+        for start in range(0, len(images), max_batch_size):
+            batch = images[start:start + max_batch_size]
+            # Only the T5 decode runs for images already captioned or asked about
+            inputs_t5 = torch.stack(self.image_features(batch, max_batch_size))
+            if question is None:
+                prompts = [self.model.prompt] * len(batch)
+            else:
+                prompts = [f"Question: {q}? Answer:" for q in question[start:start + max_batch_size]]
+            with self.lock:
+                captions.extend(self._decode(
+                    inputs_t5, prompts, max_length=max_length, min_length=min_length,
+                    num_beams=num_beams, repetition_penalty=repetition_penalty))
+
+        if single_image:
+            return captions[0]
+        return captions
+
+
+# (attribute on CaptioningModelsWrapper, name shown to the LLM)
+CAPTIONERS = [
+    ('git_large', 'Git-Large'),
+    ('blip_large', 'BLIP-LARGE'),
+    ('blip_base', 'BLIP-BASE'),
+    ('vit_gpt2', 'VIT-GPT2'),
+    ('blip2', 'BLIP-2'),
+]
+
+# Rough cost of captioning one card relative to vit_gpt2, BLIP-2 beam search dominates
+CAPTIONER_COSTS = {
+    'vit_gpt2': 1,
+    'blip_base': 1,
+    'blip_large': 2,
+    'git_large': 2,
+    'blip2': 8,
+}
+FULL_COST = sum(CAPTIONER_COSTS.values())
+
+# Adaptive captioning: the cheap models caption every card, their agreement decides the rest
+CHEAP_CAPTIONERS = ('vit_gpt2', 'blip_base')
+# (cost, generate() arguments) of the models that still run on cards the cheap models agree on
+REDUCED_CAPTIONERS = {
+    'blip2': (3, {'num_beams': 1, 'max_length': 40, 'min_length': 16}),
+}
+
+
+class AdaptiveCaptioning:
+    """Per-card captioning budget. The cheap models caption every card; when their captions agree
+    (mean pairwise cosine similarity of their text embeddings of at least `agreement`), the
+    mid-size models are skipped and BLIP-2 decodes greedily and shorter. The other models run in
+    order of cost while the cost of the card stays within `budget`."""
+
+    def __init__(self, embed_texts, budget=FULL_COST, agreement=0.9):
+        # embed_texts maps a list of texts to L2-normalized embeddings, e.g. ClipEmbedder.embed_texts
+        self.embed_texts = embed_texts
+        self.budget = budget
+        self.agreement = agreement
+
+    @property
+    def config(self):
+        return {'mode': 'adaptive', 'budget': self.budget, 'agreement': self.agreement}
+
+    def agreement_scores(self, captions):
+        # captions holds the list of cheap captions of every card, embedded in one call
+        embeddings = self.embed_texts([caption for card_captions in captions for caption in card_captions])
+        scores = []
+        start = 0
+        for card_captions in captions:
+            count = len(card_captions)
+            card_embeddings = embeddings[start:start + count]
+            start += count
+            if count < 2:
+                scores.append(0.0)
+                continue
+            similarities = card_embeddings @ card_embeddings.T
+            scores.append(float((similarities.sum() - similarities.trace()) / (count * (count - 1))))
+        return scores
 
 
 class CaptioningModelsWrapper:
-    def __init__(self):
-        self.blip2 = BLIP2Wrapper(name='blip2_t5', model_type='pretrain_flant5xl')
-        self.git_large = CaptioningModel('git_large_coco')
-        self.blip_large = CaptioningModel('blip_large')
-        self.blip_base = CaptioningModel('blip_base')
-        self.vit_gpt2 = CaptioningModel('vit_gpt2')
+    # Models are loaded by the registry on first use, not when the wrapper is created
+    def __init__(self, max_batch_size=8, registry=None, precision=None, backend=None, adaptive=None):
+        # precision maps a model name to 'fp32', 'int8' or 'bf16', fp32 by default.
+        # backend maps a model name to 'torch' or 'onnx', BLIP-2 always runs on torch.
+        # adaptive is an AdaptiveCaptioning, without it every model captions every card.
+        self.adaptive = adaptive
+        precision = precision or dict()
+        backend = backend or dict()
+        # The captions depend on them, they are part of the card cache key
+        self.precision = dict(precision)
+        self.backend = dict(backend)
+        self.registry = registry if registry is not None else ModelRegistry()
+        self.registry.register('blip2', lambda: BLIP2Wrapper(
+            name='blip2_t5', model_type='pretrain_flant5xl', max_batch_size=max_batch_size,
+            precision=precision.get('blip2')))
+        self.registry.register('git_large', lambda: CaptioningModel(
+            'git_large_coco', max_batch_size=max_batch_size, precision=precision.get('git_large'),
+            backend=backend.get('git_large', 'torch')))
+        self.registry.register('blip_large', lambda: CaptioningModel(
+            'blip_large', max_batch_size=max_batch_size, precision=precision.get('blip_large'),
+            backend=backend.get('blip_large', 'torch')))
+        self.registry.register('blip_base', lambda: CaptioningModel(
+            'blip_base', max_batch_size=max_batch_size, precision=precision.get('blip_base'),
+            backend=backend.get('blip_base', 'torch')))
+        self.registry.register('vit_gpt2', lambda: CaptioningModel(
+            'vit_gpt2', max_batch_size=max_batch_size, precision=precision.get('vit_gpt2'),
+            backend=backend.get('vit_gpt2', 'torch')))
+        self.model_names = [model_name for _, model_name in CAPTIONERS]
+
+    @property
+    def blip2(self):
+        return self.registry.get('blip2')
+
+    @property
+    def git_large(self):
+        return self.registry.get('git_large')
+
+    @property
+    def blip_large(self):
+        return self.registry.get('blip_large')
 
+    @property
+    def blip_base(self):
+        return self.registry.get('blip_base')
 
-def generate_captions(image, models):
-    captions, model_names = [], []
+    @property
+    def vit_gpt2(self):
+        return self.registry.get('vit_gpt2')
 
-    git_large_coco_cap = models.git_large(image)
-    captions.append(f"Git-Large: {git_large_coco_cap.strip()}")
-    model_names.append("Git-Large")
 
-    blip_large_cap = models.blip_large(image)
-    captions.append(f"BLIP-LARGE: {blip_large_cap.strip()}")
-    model_names.append("BLIP-LARGE")
+def _caption_with(models, attr, images, image_idxs, captions, max_batch_size, **kwargs):
+    if len(image_idxs) == 0:
+        return
+    with tracing.span(f"caption/{attr}", size=len(image_idxs), **kwargs):
+        model_captions = getattr(models, attr)(
+            preprocessing.select(images, image_idxs), max_batch_size=max_batch_size, **kwargs)
+    for idx, caption in zip(image_idxs, model_captions):
+        captions[idx][attr] = caption.strip()
 
-    blip_base_cap = models.blip_base(image)
-    captions.append(f"BLIP-BASE: {blip_base_cap.strip()}")
-    model_names.append("BLIP-BASE")
 
-    vit_gpt2_cap = models.vit_gpt2(image)
-    captions.append(f"VIT-GPT2: {vit_gpt2_cap.strip()}")
-    model_names.append("VIT-GPT2")
+def generate_captions(images, models, max_batch_size=None):
+    # Accepts a single image or a list of images. Every model captions the whole list in batches,
+    # so a table of N cards costs one batched generate() per model instead of N.
+    single_image = not isinstance(images, (list, tuple))
+    if single_image:
+        images = [images]
+    # Models with the same resize and normalization share the pixel tensors of a card
+    images = preprocessing.prepare(images)
 
-    blip2_cap = models.blip2(image)
-    captions.append(f"BLIP-2: {blip2_cap.strip()}")
-    model_names.append("BLIP-2")
-        
+    # Captions of every card by model attribute, models skipped for a card have none
+    captions = [dict() for _ in images]
+    reduced = [[] for _ in images]
+    all_idxs = list(range(len(images)))
+    adaptive = getattr(models, 'adaptive', None)
+    if adaptive is None:
+        for attr, _ in CAPTIONERS:
+            _caption_with(models, attr, images, all_idxs, captions, max_batch_size)
+    else:
+        for attr in CHEAP_CAPTIONERS:
+            _caption_with(models, attr, images, all_idxs, captions, max_batch_size)
+        with tracing.span("caption/consensus", size=len(images)) as consensus_span:
+            scores = adaptive.agreement_scores([[captions[idx][attr] for attr in CHEAP_CAPTIONERS] for idx in all_idxs])
+            agreed = [score >= adaptive.agreement for score in scores]
+            consensus_span.set(agreed=sum(agreed))
+        spent = [sum(CAPTIONER_COSTS[attr] for attr in CHEAP_CAPTIONERS)] * len(images)
+        expensive = sorted(
+            (attr for attr, _ in CAPTIONERS if attr not in CHEAP_CAPTIONERS), key=lambda attr: CAPTIONER_COSTS[attr])
+        for attr in expensive:
+            full_idxs, reduced_idxs = [], []
+            reduced_cost, reduced_kwargs = REDUCED_CAPTIONERS.get(attr, (None, dict()))
+            for idx in all_idxs:
+                if not agreed[idx] and spent[idx] + CAPTIONER_COSTS[attr] <= adaptive.budget:
+                    full_idxs.append(idx)
+                    spent[idx] += CAPTIONER_COSTS[attr]
+                elif agreed[idx] and reduced_cost is not None and spent[idx] + reduced_cost <= adaptive.budget:
+                    reduced_idxs.append(idx)
+                    reduced[idx].append(attr)
+                    spent[idx] += reduced_cost
+            _caption_with(models, attr, images, full_idxs, captions, max_batch_size)
+            _caption_with(models, attr, images, reduced_idxs, captions, max_batch_size, **reduced_kwargs)
 
-    return {"captions": '\n'.join(captions), "models": model_names, }
\ No newline at end of file
+    names = dict(CAPTIONERS)
+    results = []
+    for idx, image_captions in enumerate(captions):
+        ran = [attr for attr, _ in CAPTIONERS if attr in image_captions]
+        results.append({
+            "captions": '\n'.join(f"{names[attr]}: {image_captions[attr]}" for attr in ran),
+            "models": [names[attr] for attr in ran],
+            # Which models were left out or ran on a smaller budget for this card
+            "skipped": [names[attr] for attr, _ in CAPTIONERS if attr not in image_captions],
+            "reduced": [names[attr] for attr in reduced[idx]],
+        })
+    if single_image:
+        return results[0]
+    return results
@@ -0,0 +1,123 @@
+import queue
+import threading
+import time
+
+_END = object()
+
+
+class StagedPipeline:
+    """Pushes items through a chain of stages. Every stage has its own worker threads and
+    stages are connected by bounded queues, so stage 2 works on item k while stage 1 is
+    already busy with item k+1, and a fast stage can't run more than queue_size items ahead.
+    The first exception of any stage (e.g. JobCancelled raised by a progress callback) stops the
+    feeding, the items already queued pass through untouched, and run() raises that exception."""
+
+    def __init__(self, stages, queue_size=1):
+        # stages: list of (name, fn, num_workers) or (name, fn, num_workers, batch_size). A stage with
+        # a batch size gets up to that many queued items at once as a list and returns their results.
+        self.batch_sizes = {stage[0]: stage[3] if len(stage) > 3 else None for stage in stages}
+        self.stages = [stage[:3] for stage in stages]
+        self.queue_size = queue_size
+        self.busy = {name: 0.0 for name, _, _ in self.stages}
+        self.items = {name: 0 for name, _, _ in self.stages}
+        self.wall_time = 0.0
+        self.lock = threading.Lock()
+
+    def _worker(self, name, fn, in_queue, out_queue, workers_left, stop, errors):
+        while True:
+            entry = in_queue.get()
+            if entry is _END:
+                # Let the sibling workers see the end marker too, the last one forwards it downstream
+                in_queue.put(_END)
+                with self.lock:
+                    workers_left[name] -= 1
+                    last_worker = workers_left[name] == 0
+                if last_worker:
+                    out_queue.put(_END)
+                return
+
+            entries = [entry]
+            batch_size = self.batch_sizes[name]
+            while batch_size is not None and len(entries) < batch_size:
+                try:
+                    entry = in_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is _END:
+                    in_queue.put(_END)
+                    break
+                entries.append(entry)
+
+            items = [item for _, item in entries]
+            if not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    items = fn(items) if batch_size is not None else [fn(items[0])]
+                except Exception as e:
+                    with self.lock:
+                        errors.append(e)
+                    stop.set()
+                with self.lock:
+                    self.busy[name] += time.perf_counter() - start
+                    self.items[name] += len(entries)
+            for (idx, _), item in zip(entries, items):
+                out_queue.put((idx, item))
+
+    def run(self, items):
+        # The queues around a batched stage hold a whole batch
+        queue_sizes = [self.queue_size] * len(self.stages)
+        for stage_idx, (name, _, _) in enumerate(self.stages):
+            for queue_idx in (stage_idx, stage_idx + 1):
+                if self.batch_sizes[name] is not None and queue_idx < len(queue_sizes):
+                    queue_sizes[queue_idx] = max(queue_sizes[queue_idx], self.batch_sizes[name])
+        queues = [queue.Queue(maxsize=size) for size in queue_sizes]
+        queues.append(queue.Queue())
+        workers_left = {name: num_workers for name, _, num_workers in self.stages}
+        stop = threading.Event()
+        errors = []
+
+        def feed():
+            for idx, item in enumerate(items):
+                if stop.is_set():
+                    break
+                queues[0].put((idx, item))
+            queues[0].put(_END)
+
+        start = time.perf_counter()
+        # Fed before the workers start, so a batched first stage finds its first batch queued
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        threads = []
+        for stage_idx, (name, fn, num_workers) in enumerate(self.stages):
+            for _ in range(num_workers):
+                thread = threading.Thread(
+                    target=self._worker, args=(name, fn, queues[stage_idx], queues[stage_idx + 1], workers_left, stop, errors),
+                    daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        results = dict()
+        while True:
+            entry = queues[-1].get()
+            if entry is _END:
+                break
+            idx, item = entry
+            results[idx] = item
+        for thread in [feeder] + threads:
+            thread.join()
+        self.wall_time += time.perf_counter() - start
+
+        if len(errors) > 0:
+            raise errors[0]
+        return [results[idx] for idx in range(len(results))]
+
+    def stats(self):
+        # Utilisation is the share of wall time the stage's workers spent doing work
+        return {
+            name: {
+                'items': self.items[name],
+                'busy_seconds': self.busy[name],
+                'utilisation': self.busy[name] / (self.wall_time * num_workers) if self.wall_time > 0 else 0.0,
+            }
+            for name, _, num_workers in self.stages
+        }
@@ -0,0 +1,124 @@
+import torch
+from PIL import Image
+from transformers import OwlViTForObjectDetection, OwlViTProcessor
+from transformers.models.owlvit.modeling_owlvit import OwlViTObjectDetectionOutput
+
+import tracing
+from precision import apply_precision
+
+DETECTOR_CHECKPOINT = "google/owlvit-base-patch32"
+CARD_LABELS = ["playing card with picture on it"]
+
+
+class CardDetector:
+    """OWL-ViT zero-shot detector with the text queries encoded once. Photos are downscaled to
+    the model's input resolution before preprocessing, boxes come back in the coordinates of
+    the full-resolution original. Same call signature and output as the transformers pipeline.
+    text_features and predict run the model, onnx_backend.OnnxCardDetector runs them on ONNX Runtime."""
+
+    def __init__(self, model, processor, labels=CARD_LABELS, threshold=0.1):
+        self.model = model
+        self.processor = processor
+        self.threshold = threshold
+        self.detect_size = (processor.image_processor.size['height'], processor.image_processor.size['width'])
+        self.query_embeds = dict()
+        self.encode_labels(labels)
+
+    @staticmethod
+    def load(checkpoint=DETECTOR_CHECKPOINT, precision=None):
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model = OwlViTForObjectDetection.from_pretrained(checkpoint)
+        model.to(device)
+        model, _ = apply_precision(model.eval(), precision)
+        return CardDetector(model, OwlViTProcessor.from_pretrained(checkpoint))
+
+    @property
+    def device(self):
+        return self.model.owlvit.logit_scale.device
+
+    @property
+    def dtype(self):
+        return self.model.owlvit.logit_scale.dtype
+
+    def encode_labels(self, labels):
+        key = tuple(labels)
+        if key not in self.query_embeds:
+            self.query_embeds[key] = self.text_features(self.processor(text=[list(labels)], return_tensors="pt"))
+        return self.query_embeds[key]
+
+    @torch.no_grad()
+    def text_features(self, inputs):
+        return self.model.owlvit.get_text_features(
+            input_ids=inputs['input_ids'].to(self.device),
+            attention_mask=inputs['attention_mask'].to(self.device))[None]
+
+    @torch.no_grad()
+    def predict(self, pixel_values, query_embeds):
+        # Returns the logits and boxes of the queries for every image, as float32 tensors on the CPU
+        feature_map = self.model.image_embedder(pixel_values=pixel_values.to(self.device, self.dtype))[0]
+        batch_size, height, width, hidden_size = feature_map.shape
+        image_feats = feature_map.reshape(batch_size, height * width, hidden_size)
+        query_embeds = query_embeds.expand(batch_size, -1, -1)
+        query_mask = torch.ones(query_embeds.shape[:2], dtype=torch.bool, device=self.device)
+        logits, _ = self.model.class_predictor(image_feats, query_embeds, query_mask)
+        pred_boxes = self.model.box_predictor(image_feats, feature_map)
+        return logits.float().cpu(), pred_boxes.float().cpu()
+
+    def downscale(self, image):
+        # JPEGs from disk can be decoded directly at a reduced scale
+        if getattr(image, 'format', None) == 'JPEG' and getattr(image, 'filename', ''):
+            image = Image.open(image.filename)
+            image.draft('RGB', self.detect_size[::-1])
+        return image.convert('RGB').resize(self.detect_size[::-1], Image.BILINEAR, reducing_gap=3.0)
+
+    def __call__(self, images, candidate_labels=None, threshold=None):
+        # A single photo gives a list of detections, a list of photos a list of lists
+        single_image = not isinstance(images, (list, tuple))
+        if single_image:
+            images = [images]
+        candidate_labels = candidate_labels or CARD_LABELS
+        threshold = self.threshold if threshold is None else threshold
+
+        # Children of the caller's detection span
+        with tracing.span("detection/preprocess", size=len(images)):
+            small_images = [self.downscale(image) for image in images]
+            pixel_values = self.processor(images=small_images, return_tensors="pt")['pixel_values']
+
+        query_embeds = self.encode_labels(candidate_labels)
+        with tracing.span("detection/model", size=len(images)):
+            logits, pred_boxes = self.predict(pixel_values, query_embeds)
+
+        # Boxes are relative to the image, so scaling by the original size maps them back
+        outputs = OwlViTObjectDetectionOutput(logits=logits, pred_boxes=pred_boxes)
+        target_sizes = torch.tensor([image.size[::-1] for image in images])
+        results = self.processor.post_process_object_detection(
+            outputs=outputs, threshold=threshold, target_sizes=target_sizes)
+
+        predictions = []
+        for result in results:
+            image_predictions = [
+                {
+                    "score": score.item(),
+                    "label": candidate_labels[label.item()],
+                    "box": {
+                        "xmin": int(box[0].item()),
+                        "ymin": int(box[1].item()),
+                        "xmax": int(box[2].item()),
+                        "ymax": int(box[3].item()),
+                    },
+                }
+                for score, label, box in zip(result["scores"], result["labels"], result["boxes"])
+            ]
+            predictions.append(sorted(image_predictions, key=lambda prediction: prediction["score"], reverse=True))
+
+        if single_image:
+            return predictions[0]
+        return predictions
+
+
+def load_detector(precision=None, backend='torch'):
+    if backend == 'onnx':
+        # onnxruntime is only needed by the ONNX backend
+        from onnx_backend import OnnxCardDetector
+        return OnnxCardDetector.load(DETECTOR_CHECKPOINT, precision=precision)
+    return CardDetector.load(DETECTOR_CHECKPOINT, precision=precision)
@@ -3,72 +3,310 @@ import yaml
 import logging
 import telebot
 from telebot import types
-from transformers import pipeline
 from PIL import Image
 import captioning
+import preprocessing
 from prompts import (
     generate_clue_for_image,
+    generate_clues_for_images,
     guess_image_by_clue,
 )
-import numpy as np
-from utils import download_image_from_message_to_cache, get_cards_from_image, reset_game_state, get_game_state_path, build_image_grid
+from cache import CardCache, install_completion_cache
+from model_registry import ModelRegistry, parse_model_config
+from detection import CARD_LABELS, load_detector
+from embedding import ClipEmbedder, HandIndex, card_embeddings
+from game_state import GameStateStore
+from image_store import ImageStore
+from results import ResultsStore, grid_hash
+from sessions import ExpiringStore, SessionStore
+from status import StatusMessage
+from workers import JobCancelled, JobScheduler, current_job
+import tracing
+from utils import download_image_from_message_to_cache, get_cards_from_image, wait_for_card_files, HandGrid
 from datetime import datetime
 import random
 import imagehash
-import sqlite3
 import io
 import re
 import uuid
 import glob
+import contextlib
+import concurrent.futures
+import time
 
 
 class DixitBot:
     def __init__(self, token):
         self.token = token
         self.bot = telebot.TeleBot(token)
-        self.captioning_models = captioning.CaptioningModelsWrapper()
-        self.detector = pipeline(model="google/owlvit-base-patch32", task="zero-shot-object-detection")
-        self.clue_from_hand = None
-        self.game_state = None
-        self.game_state_path = None
-        self.added_cards_dict = None
-        self.added_cards_image_path = None
-        self.cache_path_clue = None
-        self.cache_path_guess = None
-        self.clue = None
-        self.images_clue = None
-        self.images_guess = None
-        self.grid = None
-        self.result_dict = None
-        self.result_dict_hand = None
-        self.true_image = None
+        memory_budget_gb = os.environ.get('DIXITAI_MODEL_MEMORY_GB')
+        self.registry = ModelRegistry(
+            memory_budget_bytes=int(float(memory_budget_gb) * 2**30) if memory_budget_gb else None)
+        # e.g. DIXITAI_PRECISION="git_large=int8,owlvit=int8", see benchmarks/bench_precision.py
+        precision = parse_model_config(os.environ.get('DIXITAI_PRECISION'))
+        # e.g. DIXITAI_BACKEND="git_large=onnx,blip_base=onnx,owlvit=onnx"
+        backend = parse_model_config(os.environ.get('DIXITAI_BACKEND'))
+        self.registry.register('owlvit', lambda: load_detector(precision.get('owlvit'), backend.get('owlvit', 'torch')))
+        # DIXITAI_CAPTIONING=adaptive skips or shortens the expensive captioners on cards the cheap
+        # ones agree on, DIXITAI_CAPTION_BUDGET caps the cost per card (all five models cost 14)
+        adaptive = None
+        if os.environ.get('DIXITAI_CAPTIONING', 'full') == 'adaptive':
+            adaptive = captioning.AdaptiveCaptioning(
+                lambda texts: self.registry.get('clip_embedder').embed_texts(texts),
+                budget=float(os.environ.get('DIXITAI_CAPTION_BUDGET', captioning.FULL_COST)),
+                agreement=float(os.environ.get('DIXITAI_CAPTION_AGREEMENT', 0.9)))
+        self.captioning_models = captioning.CaptioningModelsWrapper(
+            registry=self.registry, precision=precision, backend=backend, adaptive=adaptive)
+        # Shares the OWL-ViT backbone of the torch detector, so it loads and unloads with it
+        self.registry.register(
+            'clip_embedder', lambda: ClipEmbedder.load(detector=self.detector), depends_on='owlvit')
+        self.card_cache = CardCache(".cache/card_cache.db")
+        self.completion_cache = install_completion_cache(".cache/completion_cache.db")
         self.IMAGE_FOLDER = ".cache/images/"
+        # Photos and card crops by content hash, unreferenced ones are evicted beyond the quota
+        self.images = ImageStore(
+            self.IMAGE_FOLDER, ".cache/image_store.db",
+            max_bytes=int(float(os.environ.get('DIXITAI_IMAGE_CACHE_GB', 2)) * 2**30),
+            min_age_seconds=int(os.environ.get('DIXITAI_SESSION_TTL_SECONDS', 3600)))
         self.GAME_STATE_FOLDER = ".cache/game_state/"
+        self.game_states = GameStateStore(".cache/game_state.db", images=self.images)
         self.OUTPUT_LOGS = ".cache/output_logs/"
-        self.con = sqlite3.connect("dixit_results.db", check_same_thread=False)
-        with open('schema.sql') as f:
-            self.con.executescript(f.read())
-        self.cur = self.con.cursor()
+        # Fast guess mode: LLM reasoning only for the FAST_GUESS_TOP_K cards closest to the clue
+        # by image-text similarity, none at all when the best card leads by FAST_GUESS_MARGIN
+        self.FAST_GUESS_TOP_K = 3
+        self.FAST_GUESS_MARGIN = 0.05
+        # /guess_hand re-ranks only this many closest hand cards with the LLM, 0 or 1 answers with the
+        # closest card of the hand index without any LLM call
+        self.HAND_RERANK_TOP_K = 2
+        # State of the interactions in progress, per chat and user. Requests run as jobs on the
+        # worker pool, one at a time per user so a user's requests never interleave
+        session_ttl_seconds = int(os.environ.get('DIXITAI_SESSION_TTL_SECONDS', 3600))
+        self.sessions = SessionStore(ttl_seconds=session_ttl_seconds)
+        # Hand indexes and grids of the users, rebuilt from the game state after the session TTL
+        self.hand_indexes = ExpiringStore(ttl_seconds=session_ttl_seconds)
+        self.hand_grids = ExpiringStore(ttl_seconds=session_ttl_seconds)
+        self.jobs = JobScheduler(num_workers=int(os.environ.get('DIXITAI_WORKERS', 4)))
+        # Lower runs first: quick hand and rating commands, then guessing, then clue generation and /add
+        self.JOB_PRIORITIES = {
+            'guess_card_on_table': 1,
+            'check_images_guess': 1,
+            'guess_card_from_hand': 1,
+            'generate_clue_for_cards': 2,
+            'check_images_clue': 2,
+            'add_cards_to_hand': 3,
+            'check_adding_cards': 3,
+        }
+        # Telegram rate-limits message edits, progress updates closer together are skipped
+        self.STATUS_EDIT_INTERVAL = 1.0
+        self.EXPIRED_MESSAGE = "This request has expired, please send the photo with your command again."
+        # Rated results are committed in batches by a background writer, the handlers wait for the
+        # commit of their row before confirming it, up to RESULT_SAVE_TIMEOUT seconds
+        self.results = ResultsStore("dixit_results.db", "schema.sql")
+        self.RESULT_SAVE_TIMEOUT = 30
+
+    @property
+    def detector(self):
+        return self.registry.get('owlvit')
+
+    def detect_cards(self, image):
+        with tracing.span("detection", size=image.size[0] * image.size[1]) as detection_span:
+            prediction = self.detector(image, candidate_labels=CARD_LABELS)
+            detection_span.set(cards=len(prediction))
+        return prediction
 
     def start(self):
         self.bot.polling()
 
+    def dispatch(self, update, handler):
+        # update is a message or a callback query, both carry the user the request belongs to
+        message = update.message if isinstance(update, types.CallbackQuery) else update
+
+        def run():
+            job = current_job()
+            try:
+                # Root span of the request, the steps of the handler are its children
+                with tracing.span(f"request/{handler.__name__}", queued_seconds=job.started_at - job.submitted_at):
+                    handler(update)
+            except JobCancelled:
+                self.bot.reply_to(message, "Cancelled.")
+                raise
+            except Exception as e:
+                self.bot.reply_to(message, str(e))
+                raise
+
+        priority = self.JOB_PRIORITIES.get(handler.__name__, 0)
+        job = self.jobs.submit(update.from_user.id, run, name=handler.__name__, priority=priority)
+        ahead = self.jobs.position(job)
+        if priority > 0 and ahead > 0:
+            self.bot.reply_to(message, f"Queued behind {ahead} other requests, /cancel to drop it.")
+        return job
+
+    def start_status(self, chat_id, text):
+        # Status message of the current job, its progress reports and streamed text edit it in place
+        return StatusMessage(self.bot, chat_id, text, job=current_job(), min_interval=self.STATUS_EDIT_INTERVAL)
+
+    def save_result(self, chat_id, table, row, saved_text, grid_bytes=None):
+        future = self.results.put(table, row, grid_bytes=grid_bytes)
+        try:
+            future.result(timeout=self.RESULT_SAVE_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            self.bot.send_message(chat_id, "This experience is queued for saving, the database is slow to commit it.")
+            return
+        except Exception as e:
+            logging.log(logging.ERROR, f"Couldn't save a row of {table}: {e!r}")
+            self.bot.send_message(chat_id, f"Couldn't save this experience: {e}")
+            return
+        self.bot.send_message(chat_id, saved_text)
+
+    def cancel_jobs(self, message):
+        logging.log(logging.INFO, f"Received [cancel] request from {message.from_user.username}.")
+        dropped, running = self.jobs.cancel(message.from_user.id)
+        if dropped == 0 and running is None:
+            self.bot.reply_to(message, "Nothing to cancel.")
+            return
+        response_text = f"Cancelled {dropped} queued requests."
+        if running is not None:
+            response_text += " The running one stops after its current step."
+        self.bot.reply_to(message, response_text)
+
+    def show_job_stats(self, message):
+        logging.log(logging.INFO, f"Received [jobs] request from {message.from_user.username}.")
+        stats = self.jobs.stats()
+
+        def seconds(value):
+            return "-" if value is None else f"{value:0.1f}s"
+
+        response_text = (
+            f"Workers: {stats['workers']}, running: {len(stats['running'])}, queued: {stats['pending']} "
+            f"(by priority {stats['pending_by_priority']}), oldest queued {stats['oldest_pending_seconds']:0.1f}s\n")
+        for name, elapsed in stats['running']:
+            response_text += f"running {name} for {elapsed:0.1f}s\n"
+        for name, job_stats in stats['jobs'].items():
+            response_text += (
+                f"{name}: {job_stats['done']} done, {job_stats['failed']} failed, {job_stats['cancelled']} cancelled, "
+                f"wait p50 {seconds(job_stats['wait_p50'])} p95 {seconds(job_stats['wait_p95'])}, "
+                f"run p50 {seconds(job_stats['run_p50'])} p95 {seconds(job_stats['run_p95'])}\n")
+        self.bot.reply_to(message, response_text)
+
     def send_welcome(self, message):
         logging.log(logging.INFO, f"Received [help] request from {message.from_user.username}.")
         self.bot.reply_to(message, ("I am Dixit Bot, here to play some good association with you. Im newbie, so please don't be rough :3"
                                     "To work properly, i need two things: photo of your dixit cards and a command."
                                     "Photo should have all of cards on it. Once you uploaded photo, send a command with it: /clue or /guess *Here goes your clue to guess*. "
+                                    "Use /clue fresh to get a new clue instead of a remembered one. "
                                     "You can also add cards to your hand via /add + photo of cards. "
                                     "Command /guess_hand + clue will choose a card that suits given clue the most"
                                     "Command /del + card_index will delete card from your hand"
+                                    "Command /cancel stops your running and queued requests. "
                                     "After this, you can check how cards were detected and thus start playing. This is first version, so my guessing can take some time... But we will improve!"))
 
+    def show_model_stats(self, message):
+        logging.log(logging.INFO, f"Received [models] request from {message.from_user.username}.")
+        stats = self.registry.stats()
+        budget = stats['memory_budget_bytes']
+        response_text = (
+            f"Loaded models use {stats['loaded_bytes'] / 2**20:0.0f} MB"
+            + (f" of {budget / 2**20:0.0f} MB budget" if budget is not None else "") + "\n")
+        for name, model_stats in stats['models'].items():
+            if model_stats['load_seconds'] is None:
+                response_text += f"{name}: not loaded yet\n"
+                continue
+            response_text += (
+                f"{name}: {'loaded' if model_stats['loaded'] else 'unloaded'}, "
+                f"{model_stats['memory_bytes'] / 2**20:0.0f} MB, "
+                f"last load {model_stats['load_seconds']:0.1f} seconds, loaded {model_stats['load_count']} times\n")
+        self.bot.reply_to(message, response_text)
+
+    def show_guess_stats(self, message):
+        logging.log(logging.INFO, f"Received [guess_stats] request from {message.from_user.username}.")
+        rows = self.results.query(
+            "SELECT guessed_image, true_image, shortlist FROM guesses WHERE true_image IS NOT NULL")
+        if len(rows) == 0:
+            self.bot.reply_to(message, "No rated guesses yet.")
+            return
+        correct = sum(guessed_image == true_image for guessed_image, true_image, _ in rows)
+        response_text = f"Guessed {correct} of {len(rows)} cards right.\n"
+        shortlisted = [(true_image, shortlist.split(',')) for _, true_image, shortlist in rows if shortlist]
+        if len(shortlisted) > 0:
+            # How often the similarity shortlist kept the right card for the LLM
+            recall = sum(true_image in shortlist for true_image, shortlist in shortlisted) / len(shortlisted)
+            average_size = sum(len(shortlist) for _, shortlist in shortlisted) / len(shortlisted)
+            response_text += (
+                f"Fast mode shortlist contained the right card in {recall:.0%} of {len(shortlisted)} guesses "
+                f"(on average {average_size:.1f} cards shortlisted).")
+        self.bot.reply_to(message, response_text)
+
+    def show_cache_stats(self, message):
+        logging.log(logging.INFO, f"Received [cache_stats] request from {message.from_user.username}.")
+        stats = self.card_cache.stats()
+        response_text = f"Card cache: {stats['entries']} entries, {stats['bytes'] / 2**20:0.1f}/{stats['max_bytes'] / 2**20:0.0f} MB\n"
+        for stage, counters in stats['stages'].items():
+            response_text += f"{stage}: {counters['hits']} hits, {counters['misses']} misses\n"
+        stats = self.completion_cache.stats()
+        response_text += (
+            f"\nLLM completion cache: {stats['entries']} entries, {stats['hits']} hits, {stats['misses']} misses, "
+            f"saved {stats['hits']} API round-trips ({stats['saved_seconds']:0.1f} seconds)")
+        stats = self.images.stats()
+        response_text += (
+            f"\nImages: {stats['entries']} files ({stats['referenced']} in hands), "
+            f"{stats['bytes'] / 2**20:0.1f}/{stats['max_bytes'] / 2**20:0.0f} MB, {stats['evicted']} evicted")
+        self.bot.reply_to(message, response_text)
+
+    @staticmethod
+    def hand_owner(update):
+        # Hands are stored by username, like the YAML game state files were named
+        return str(update.from_user.username)
+
+    def get_hand_index(self, username, cards):
+        # Built once from the game state, then kept up to date by /add and /del
+        hand_index = self.hand_indexes.get(username)
+        if hand_index is None or hand_index.card_hashes != list(cards):
+            hand_index, updated = HandIndex.from_cards(cards, self.registry.get('clip_embedder'))
+            if updated:
+                self.game_states.add_cards(username, cards)
+            self.hand_indexes.put(username, hand_index)
+        return hand_index
+
+    def get_hand_grid(self, username, cards):
+        # Built once from the card files, then kept up to date by /add and /del
+        hand_grid = self.hand_grids.get(username)
+        if hand_grid is None or hand_grid.card_hashes != list(cards):
+            hand_grid = HandGrid.from_cards(cards)
+            self.hand_grids.put(username, hand_grid)
+        return hand_grid
+
+    def reset_state(self, message):
+        logging.log(logging.INFO, f"Received [reset] request from {message.from_user.username}.")
+        self.game_states.reset(self.hand_owner(message))
+        self.hand_indexes.pop(self.hand_owner(message))
+        self.hand_grids.pop(self.hand_owner(message))
+        self.sessions.pop(message.chat.id, message.from_user.id)
+        self.bot.reply_to(message, "Game is reset to initial state.")
+
+    def nuke_cache(self, message):
+        logging.log(logging.INFO, f"Received [nuke_cache] request from {message.from_user.username}.")
+        self.game_states.reset(self.hand_owner(message))
+        self.hand_indexes.pop(self.hand_owner(message))
+        self.hand_grids.pop(self.hand_owner(message))
+        self.sessions.pop(message.chat.id, message.from_user.id)
+        # Card files other hands still refer to are kept, so are the crops of the last session TTL,
+        # another user may be about to add them
+        removed = self.images.purge_unreferenced()
+        # Timestamp-named files from before the image store live directly in the folder
+        referenced = set(self.game_states.image_paths())
+        for path in glob.glob(os.path.join(self.IMAGE_FOLDER, "*.jpg")):
+            if path not in referenced:
+                os.remove(path)
+                removed += 1
+        self.bot.reply_to(message, f"Removed {removed} unused images and reset the game state to initial state.")
+
     def generate_clue_for_cards(self, message):
         logging.log(logging.INFO, f"Received [clue] request from {message.from_user.username}.")
-        cache_path_clue = download_image_from_message_to_cache(self.bot, message, image_folder=".cache/images/")
+        session = self.sessions.get(message.chat.id, message.from_user.id)
+        cache_path_clue = download_image_from_message_to_cache(self.bot, message, self.images)
         image = Image.open(cache_path_clue)
-        prediction = self.detector(image, candidate_labels=["playing card with picture on it"])
-        cards_dict = get_cards_from_image(prediction, cache_path_clue)
+        prediction = self.detect_cards(image)
+        cards_dict = get_cards_from_image(prediction, image, self.images)
         if cards_dict['grid'] == None:
             self.bot.send_message(message.chat.id, "Couldn't detect any card, please try uploading another image")
         else:
@@ -77,25 +315,25 @@ class DixitBot:
             no = types.InlineKeyboardButton("no", callback_data="clue_no")
             markup_clue.add(yes_clue, no)
             self.bot.send_photo(message.chat.id, cards_dict['grid'], reply_to_message_id=message.message_id, caption="Detected cards. Is it done properly?", reply_markup=markup_clue)
-            self.cache_path_clue = cache_path_clue
-            self.images_clue = cards_dict['images']
+            session.cache_path_clue = cache_path_clue
+            session.images_clue = cards_dict['images']
+            # "/clue fresh" skips cached completions to get a new clue for an already seen card
+            session.fresh_clue = message.caption[len('/clue'):].strip() == 'fresh'
+
 
     def add_cards_to_hand(self, message):
         logging.log(logging.INFO, f"Received [add images] request from {message.from_user.username}")
+        session = self.sessions.get(message.chat.id, message.from_user.id)
 
-        self.added_cards_image_path = download_image_from_message_to_cache(self.bot, message, image_folder=self.IMAGE_FOLDER)
+        session.added_cards_image_path = download_image_from_message_to_cache(self.bot, message, self.images)
     
-        self.game_state_path = get_game_state_path(self.bot, message, game_state_folder=self.GAME_STATE_FOLDER)
-        with open(self.game_state_path, 'r') as fd:
-            self.game_state = yaml.safe_load(fd)
-        
-        image = Image.open(self.added_cards_image_path)
+        image = Image.open(session.added_cards_image_path)
         start_detection = datetime.now()
-        prediction = self.detector(image, candidate_labels=["playing card with picture on it"])
-        self.added_cards_dict = get_cards_from_image(prediction, self.added_cards_image_path)
+        prediction = self.detect_cards(image)
+        session.added_cards_dict = get_cards_from_image(prediction, image, self.images)
         detection_time = (datetime.now() - start_detection).total_seconds()
 
-        if self.added_cards_dict['grid'] == None:
+        if session.added_cards_dict['grid'] == None:
             self.bot.send_message(message.chat.id, "Couldn't detect any card, please try uploading another image")
         else:
             markup_clue = types.InlineKeyboardMarkup(row_width=2)
@@ -103,37 +341,63 @@ class DixitBot:
             no_add = types.InlineKeyboardButton("no", callback_data="add_no")
             markup_clue.add(yes_add, no_add)
             reply_message = (
-                f"Found {len(self.added_cards_dict['images'])} cards in {detection_time:0.1f} seconds. ")
+                f"Found {len(session.added_cards_dict['images'])} cards in {detection_time:0.1f} seconds. ")
             
             self.bot.send_photo(
-                message.chat.id, self.added_cards_dict['grid'],
+                message.chat.id, session.added_cards_dict['grid'],
                 reply_to_message_id=message.message_id, caption=reply_message, reply_markup=markup_clue)
             
     def check_adding_cards(self, callback):
+        session = self.sessions.get(callback.message.chat.id, callback.from_user.id)
+        if session.added_cards_dict is None:
+            self.bot.send_message(callback.message.chat.id, self.EXPIRED_MESSAGE)
+            return
         if callback.data == 'add_yes':
-            self.bot.reply_to(callback.message, "Generating description and clues...")
+            status = self.start_status(callback.message.chat.id, "Generating description and clues...")
             clue_generation_start = datetime.now()
             descriptions = dict()
-            for idx, image in enumerate(self.added_cards_dict['images']):
+            added_cards = []
+            # The captioners, BLIP-2 and the embedder share the preprocessed cards of this request
+            cards = preprocessing.PreparedImages(session.added_cards_dict['images'])
+            clue_results, stage_stats = generate_clues_for_images(
+                cards, captioning.generate_captions, self.captioning_models,
+                cache=self.card_cache, progress=status.progress, verbose=False)
+            status.flush()
+            embeddings = card_embeddings(
+                self.registry.get('clip_embedder'), cards, [clue_result['clue'] for clue_result in clue_results])
+            for idx, image in enumerate(session.added_cards_dict['images']):
                 hash = str(imagehash.average_hash(image))
+                added_cards.append((hash, image))
                 descriptions.update({
-                    hash: {'image_path': self.added_cards_dict['card_paths'][idx],
-                            **generate_clue_for_image(image, captioning.generate_captions, self.captioning_models, verbose=False)
+                    hash: {'image_path': session.added_cards_dict['card_paths'][idx],
+                            **clue_results[idx],
+                            **embeddings[idx],
                         }
                 })
 
-            self.game_state["my_cards"].update(descriptions)
-            output_logs_path = os.path.join(".cache/output_logs/clues", f"{os.path.basename(self.added_cards_image_path).replace('.jpg', '')}.yaml")
+            # The hand refers to the card files by path, make sure they are written
+            wait_for_card_files(session.added_cards_dict)
+            username = self.hand_owner(callback)
+            self.game_states.add_cards(username, descriptions)
+            hand_index = self.hand_indexes.get(username)
+            if hand_index is not None:
+                for card_hash, card_info in descriptions.items():
+                    hand_index.add(card_hash, card_info['image_embedding'], card_info['description_embedding'])
+            hand_grid = self.hand_grids.get(username)
+            if hand_grid is not None:
+                # The new tiles come from the crops in memory, not the card files
+                for card_hash, image in added_cards:
+                    hand_grid.add(card_hash, image)
+            output_logs_path = os.path.join(".cache/output_logs/clues", f"{os.path.basename(session.added_cards_image_path).replace('.jpg', '')}.yaml")
             with open(output_logs_path, 'w') as fd:
                 yaml.dump(descriptions, fd, default_flow_style=False, sort_keys=False)
 
-            with open(self.game_state_path, 'w') as fd:
-                yaml.dump(self.game_state, fd, default_flow_style=False, sort_keys=False)
-
             clue_generation_time = (datetime.now() - clue_generation_start).total_seconds()
             self.bot.reply_to(callback.message, (
                 f"Generated descriptions in {clue_generation_time} seconds. "
-                f"Cards in hand: {len(self.game_state['my_cards'])} "
+                "Stage utilisation: " + ", ".join(
+                    f"{stage} {stats['utilisation']:.0%}" for stage, stats in stage_stats.items()) + ". "
+                f"Cards in hand: {self.game_states.count(username)} "
                 "You can see your hand using command /hand." ))
         else:
             self.bot.send_message(callback.message.chat.id, "Please retry taking photo of your cards")
@@ -142,47 +406,38 @@ class DixitBot:
         logging.log(logging.INFO, f"Received [remove card from hand] request from {message.from_user.username}")
         cards_to_delete = [int(x.strip()) for x in message.text.replace('/del', '').split(',')]
 
-        # Get game state
-        game_state_path = get_game_state_path(self.bot, message, game_state_folder=self.GAME_STATE_FOLDER)
-        with open(game_state_path, 'r') as fd:
-            game_state = yaml.safe_load(fd)
-    
-        # Remove cards from game state
-        retained_cards = dict()
-        for card_idx, (card_hash, card_info) in enumerate(game_state["my_cards"].items()):
-            if card_idx not in cards_to_delete:
-                retained_cards[card_hash] = card_info
-        game_state["my_cards"] = retained_cards
-
-        # Save game state (i.e. our hand)
-        with open(game_state_path, 'w') as fd:
-            yaml.dump(game_state, fd, default_flow_style=False, sort_keys=False)
+        # Remove cards from game state (i.e. our hand)
+        username = self.hand_owner(message)
+        removed_hashes = set(
+            card_hash for card_idx, card_hash in enumerate(self.game_states.hand_hashes(username))
+            if card_idx in cards_to_delete)
+        self.game_states.remove_cards(username, removed_hashes)
+        hand_index = self.hand_indexes.get(username)
+        if hand_index is not None:
+            hand_index.remove(removed_hashes)
+        hand_grid = self.hand_grids.get(username)
+        if hand_grid is not None:
+            hand_grid.remove(removed_hashes)
         self.bot.reply_to(message, "Done removing cards. You can see your new hand with command /hand.")
 
     def show_detailed_hand_clues(self, message):
         logging.log(logging.INFO, f"Received [hand] request from {message.from_user.username}.")
         # Get game state
-        game_state_path = get_game_state_path(self.bot, message, game_state_folder=self.GAME_STATE_FOLDER)
-        with open(game_state_path, 'r') as fd:
-            game_state = yaml.safe_load(fd)
+        my_cards = self.game_states.get_hand(self.hand_owner(message))
 
         # If no cards in hand, return
-        if game_state["my_cards"] is None or len(game_state["my_cards"]) == 0:
+        if len(my_cards) == 0:
             self.bot.reply_to(message, "Your hand is empty, there's no card in your hand.")
             return
         
-        # Build a grid of images
-        image_paths = []
-        for card_hash, card_info in game_state["my_cards"].items():
-            image_paths.append(card_info["image_path"])
-        grid = build_image_grid(image_paths)
+        grid = self.get_hand_grid(self.hand_owner(message), my_cards)
         # Send message
 
-        self.bot.send_photo(message.chat.id, grid, caption="Detailed descriptions below:",
+        self.bot.send_photo(message.chat.id, grid.jpeg_bytes, caption="Detailed descriptions below:",
                        reply_to_message_id=message.message_id)
 
         # Build a grid of images
-        for image_idx, (card_hash, card_info) in enumerate(game_state["my_cards"].items()):
+        for image_idx, (card_hash, card_info) in enumerate(my_cards.items()):
             cap_text = f"Card {image_idx}: {card_info['clue']}\n\n"
             cap_text += f"captions:\n{card_info['captions']}\n\n"
             cap_text += f"pre_qna_interpretation:\n{card_info['pre_qna_interpretation']}\n\n"
@@ -194,82 +449,82 @@ class DixitBot:
     def show_short_hand_clues(self, message):
         logging.log(logging.INFO, f"Received [hand] request from {message.from_user.username}.")
 
-        # Get game state
-        game_state_path = get_game_state_path(self.bot, message, game_state_folder=self.GAME_STATE_FOLDER)
-        with open(game_state_path, 'r') as fd:
-            game_state = yaml.safe_load(fd)
+        # Get game state, the clues are all this needs
+        my_cards = self.game_states.get_hand(self.hand_owner(message), summary=True)
 
         # If no cards in hand, return
-        if game_state["my_cards"] is None or len(game_state["my_cards"]) == 0:
+        if len(my_cards) == 0:
             self.bot.reply_to(message, "Your hand is empty, there's no card in your hand.")
             return
 
         # Display only "interpretation", "association", and "clue" for each card
         response_text = ""
-        for image_idx, (card_hash, card_info) in enumerate(game_state["my_cards"].items()):
+        for image_idx, (card_hash, card_info) in enumerate(my_cards.items()):
             response_text += f"Card {image_idx}: {card_info['clue'].strip()}\n"
         response_text += "\nTo get detailed explanation to the clues, please use command /hand_detailed."
 
-        # Build a grid of images
-        image_paths = []
-        for card_hash, card_info in game_state["my_cards"].items():
-            image_paths.append(card_info["image_path"])
-        grid = build_image_grid(image_paths)
+        grid = self.get_hand_grid(self.hand_owner(message), my_cards)
         # Send message
-        self.bot.send_photo(message.chat.id, grid, caption=response_text,
+        self.bot.send_photo(message.chat.id, grid.jpeg_bytes, caption=response_text,
                        reply_to_message_id=message.message_id)
         
     def guess_card_on_table(self, message):
         logging.log(logging.INFO, f"Received [guess] request from {message.from_user.username}.")
+        session = self.sessions.get(message.chat.id, message.from_user.id)
 
-        self.clue = message.caption[len('/guess'):].strip()
-        cache_path_guess = download_image_from_message_to_cache(self.bot, message, image_folder=".cache/images/")
+        session.clue = message.caption[len('/guess'):].strip()
+        cache_path_guess = download_image_from_message_to_cache(self.bot, message, self.images)
         image = Image.open(cache_path_guess)
-        prediction = self.detector(image, candidate_labels=["playing card with picture on it"])
-        cards_dict = get_cards_from_image(prediction, cache_path_guess)
-        self.grid, self.images_guess = cards_dict['grid'], cards_dict['images']
-        if self.grid == None:
+        prediction = self.detect_cards(image)
+        cards_dict = get_cards_from_image(prediction, image, self.images)
+        session.grid, session.images_guess = cards_dict['grid'], cards_dict['images']
+        if session.grid == None:
             self.bot.send_message(message.chat.id, "Couldn't detect any card, please try uploading another image")
         else:
             markup_guess = types.InlineKeyboardMarkup(row_width=2)
             yes_guess = types.InlineKeyboardButton("yes", callback_data="guess_yes")
             no = types.InlineKeyboardButton("no", callback_data="guess_no")
             markup_guess.add(yes_guess, no)
-            self.bot.send_photo(message.chat.id, self.grid, reply_to_message_id=message.message_id, caption="Detected cards. Is it done properly?", reply_markup=markup_guess)
-            self.cache_path_guess = cache_path_guess
+            self.bot.send_photo(message.chat.id, session.grid, reply_to_message_id=message.message_id, caption="Detected cards. Is it done properly?", reply_markup=markup_guess)
+            session.cache_path_guess = cache_path_guess
 
     def guess_card_from_hand(self, message):
         logging.log(logging.INFO, f"Received [get card from hand by clue] request from {message.from_user.username}")
-        self.clue_from_hand = message.text[len('/guess_hand'):].strip()
+        session = self.sessions.get(message.chat.id, message.from_user.id)
+        session.clue_from_hand = message.text[len('/guess_hand'):].strip()
 
         # Get game state
-        game_state_path = get_game_state_path(self.bot, message, game_state_folder=self.GAME_STATE_FOLDER)
-        with open(game_state_path, 'r') as fd:
-            self.game_state = yaml.safe_load(fd)
+        username = self.hand_owner(message)
+        my_cards = self.game_states.get_hand(username)
 
         # If no cards in hand, return
-        if self.game_state["my_cards"] is None or len(self.game_state["my_cards"]) == 0:
+        if len(my_cards) == 0:
             self.bot.reply_to(message, "Your hand is empty, there's no card in your hand.")
             return
         
-        images = [np.array(Image.open(card_info['image_path'])) for _, card_info in self.game_state["my_cards"].items()]
-        generated_descriptions = [card_info for _, card_info in self.game_state["my_cards"].items()]
-        # Generate descriptions and clues
+        generated_descriptions = [card_info for _, card_info in my_cards.items()]
+        image_paths = [card_info['image_path'] for card_info in generated_descriptions]
         guess_image_start = datetime.now()
-        self.result_dict_hand = guess_image_by_clue(images, self.clue_from_hand, captioning.generate_captions, self.captioning_models, generated_descriptions, verbose=False)
-
-        # Build a grid of images
-        image_paths = []
-        for card_hash, card_info in self.game_state["my_cards"].items():
-            image_paths.append(card_info["image_path"])
-        grid = build_image_grid(image_paths)
+        # Rank the hand against the clue with the precomputed card embeddings
+        hand_index = self.get_hand_index(username, my_cards)
+        clue_embedding = self.registry.get('clip_embedder').embed_texts([session.clue_from_hand])[0]
+        similarities = hand_index.search(clue_embedding)
+        # LLM re-rank of the closest cards only, the descriptions were generated at /add time. A
+        # shortlist of one card (HAND_RERANK_TOP_K of 0 or 1, or a decisive margin) is the answer
+        session.result_dict_hand = guess_image_by_clue(
+            image_paths, session.clue_from_hand, captioning.generate_captions, self.captioning_models,
+            generated_descriptions, cache=self.card_cache, similarities=similarities,
+            top_k=self.HAND_RERANK_TOP_K, decisive_margin=self.FAST_GUESS_MARGIN, verbose=False)
+
+        # The grid is kept for persist_guess_from_hand, the hand may change before the points come in
+        session.hand_grid_bytes = self.get_hand_grid(username, my_cards).jpeg_bytes
 
         guess_image_time = (datetime.now() - guess_image_start).total_seconds()
-        final_response = f"Clue: {self.clue_from_hand}\nAnswer: " + self.result_dict_hand["final_answer"].strip() + "\n\n" + (
+        final_response = f"Clue: {session.clue_from_hand}\nAnswer: " + session.result_dict_hand["final_answer"].strip() + "\n\n" + (
             "-------------------\n"
             f"Guessed the card (from hand) matching given clue in {guess_image_time} seconds. ")
         self.bot.send_photo(
-            message.chat.id, grid, reply_to_message_id=message.message_id,
+            message.chat.id, session.hand_grid_bytes, reply_to_message_id=message.message_id,
             caption=final_response)
         
         points_markup = types.InlineKeyboardMarkup(row_width=2)
@@ -278,89 +533,108 @@ class DixitBot:
         self.bot.send_message(message.chat.id, "How many points did you obtain?", reply_markup=points_markup)
 
     def check_images_guess(self, callback):
+        session = self.sessions.get(callback.message.chat.id, callback.from_user.id)
+        if session.images_guess is None:
+            self.bot.send_message(callback.message.chat.id, self.EXPIRED_MESSAGE)
+            return
         if callback.data == "guess_yes":
-            self.bot.send_message(callback.message.chat.id, "Begun guessing")
+            status = self.start_status(callback.message.chat.id, "Begun guessing")
             image_guessing_start = datetime.now()
-            self.result_dict = guess_image_by_clue(self.images_guess, self.clue, captioning.generate_captions, self.captioning_models, verbose=False)
+            session.result_dict = guess_image_by_clue(
+                preprocessing.PreparedImages(session.images_guess), session.clue, captioning.generate_captions, self.captioning_models, cache=self.card_cache,
+                embedder=self.registry.get('clip_embedder'), top_k=self.FAST_GUESS_TOP_K,
+                decisive_margin=self.FAST_GUESS_MARGIN, progress=status.progress, stream=status.stream, verbose=False)
             image_guessing_time = (datetime.now() - image_guessing_start).total_seconds()
-            self.bot.send_message(callback.message.chat.id, f"Guessed card {self.result_dict['final_answer']} \nfor clue: {self.clue} \nin {image_guessing_time} seconds.")
+            status.flush()
+            self.bot.send_message(callback.message.chat.id, f"Guessed card {session.result_dict['final_answer']} \nfor clue: {session.clue} \nin {image_guessing_time} seconds{status.timing_text()}.")
             guesses_markup = types.InlineKeyboardMarkup(row_width=2)
-            for i in range(len(self.images_guess)):
+            for i in range(len(session.images_guess)):
                 guesses_markup.add(types.InlineKeyboardButton(f"Image_{i}", callback_data=f"Image_{i}"))
             self.bot.send_message(callback.message.chat.id, "Which image was right to guess?", reply_markup=guesses_markup)
         elif callback.data == "guess_no":
             self.bot.send_message(callback.message.chat.id, "Please retry taking photo of your cards")
 
     def points_guess(self, callback):
-        self.true_image = callback.data
+        session = self.sessions.get(callback.message.chat.id, callback.from_user.id)
+        if session.result_dict is None:
+            self.bot.send_message(callback.message.chat.id, self.EXPIRED_MESSAGE)
+            return
+        session.true_image = callback.data
         points_markup = types.InlineKeyboardMarkup(row_width=2)
         for i in range(7):
             points_markup.add(types.InlineKeyboardButton(f"{i}", callback_data=f"_guess{i}"))
         self.bot.send_message(callback.message.chat.id, "How many points did you obtain?", reply_markup=points_markup)
 
     def persist_guess_from_hand(self, callback):
-        stream = io.BytesIO()
-        image_paths = []
-        for _, card_info in self.game_state["my_cards"].items():
-            image_paths.append(card_info["image_path"])
-        grid = build_image_grid(image_paths)
-        grid.save(stream, format="JPEG")
-        grid_bytes = stream.getvalue()
-
+        session = self.sessions.get(callback.message.chat.id, callback.from_user.id)
+        if session.result_dict_hand is None:
+            self.bot.send_message(callback.message.chat.id, self.EXPIRED_MESSAGE)
+            return
+        grid_bytes = session.hand_grid_bytes
         persist_dict = {}
         points_dict = {f"from_hand{i}" : i for i in range(7)}
         points = points_dict[callback.data]
 
         clue_relation = ""
-        for reasoning in self.result_dict_hand['per_image_reasoning']:
+        for reasoning in session.result_dict_hand['per_image_reasoning']:
             for key, value in reasoning.items():
                 if key == 'clue_relation':
                     clue_relation += value
         persist_dict["clue_relations"] = clue_relation
         persist_dict["score"] = points
-        persist_dict["image_grid"] = grid_bytes
-        persist_dict["final_answer"] = self.result_dict_hand["final_answer"]
-        persist_dict["guessed_image"] = re.search(r'Image_\d+', self.result_dict_hand["final_answer"]).group()
-        persist_dict["clue"] = self.clue_from_hand
-        self.cur.execute("INSERT INTO guesses_from_hand VALUES(:image_grid, :guessed_image, :final_answer, :score, :clue, :clue_relations)", persist_dict)
-        self.con.commit()
-        self.bot.send_message(callback.message.chat.id, "Successfully saved this experience.")
+        persist_dict["final_answer"] = session.result_dict_hand["final_answer"]
+        persist_dict["guessed_image"] = re.search(r'Image_\d+', session.result_dict_hand["final_answer"]).group()
+        persist_dict["clue"] = session.clue_from_hand
+        self.save_result(
+            callback.message.chat.id, "guesses_from_hand", persist_dict, "Successfully saved this experience.",
+            grid_bytes=grid_bytes)
 
     def persist_guess(self, callback):
+        session = self.sessions.get(callback.message.chat.id, callback.from_user.id)
+        if session.result_dict is None:
+            self.bot.send_message(callback.message.chat.id, self.EXPIRED_MESSAGE)
+            return
         stream = io.BytesIO()
-        self.grid.save(stream, format="JPEG")
+        session.grid.save(stream, format="JPEG")
         grid_bytes = stream.getvalue()
         persist_dict = {}
         points_dict = {f"_guess{i}" : i for i in range(7)}
         points = points_dict[callback.data]
         clue_relation = ""
-        for reasoning in self.result_dict['per_image_reasoning']:
+        for reasoning in session.result_dict['per_image_reasoning']:
             for key, value in reasoning.items():
                 if key == 'clue_relation':
                     clue_relation += value
         persist_dict["clue_relations"] = clue_relation
-        persist_dict["true_image"] = self.true_image
+        persist_dict["true_image"] = session.true_image
         persist_dict["score"] = points
-        persist_dict["image_grid"] = grid_bytes
-        persist_dict["final_answer"] = self.result_dict["final_answer"]
-        persist_dict["guessed_image"] = re.search(r'Image_\d+', self.result_dict["final_answer"]).group()
-        persist_dict["clue"] = self.clue
-        output_logs_path = os.path.join(".cache/output_logs/guesses", f"{os.path.basename(self.cache_path_guess).replace('.jpg', '')}.yaml")
+        persist_dict["grid_hash"] = grid_hash(grid_bytes)
+        persist_dict["final_answer"] = session.result_dict["final_answer"]
+        persist_dict["guessed_image"] = re.search(r'Image_\d+', session.result_dict["final_answer"]).group()
+        persist_dict["clue"] = session.clue
+        persist_dict["shortlist"] = ",".join(f"Image_{idx}" for idx in session.result_dict["shortlist"])
+        output_logs_path = os.path.join(".cache/output_logs/guesses", f"{os.path.basename(session.cache_path_guess).replace('.jpg', '')}.yaml")
         with open(output_logs_path, 'w') as fd:
             yaml.dump(persist_dict, fd, default_flow_style=False, sort_keys=False)
-        self.cur.execute("INSERT INTO guesses VALUES(:image_grid, :guessed_image, :true_image, :final_answer, :score, :clue, :clue_relations)", persist_dict)
-        self.con.commit()
-        self.bot.send_message(callback.message.chat.id, "Successfully saved this experience. You may now proceed to guessing the card by clue")
+        self.save_result(
+            callback.message.chat.id, "guesses", persist_dict,
+            "Successfully saved this experience. You may now proceed to guessing the card by clue", grid_bytes=grid_bytes)
 
     def check_images_clue(self, callback):
+        session = self.sessions.get(callback.message.chat.id, callback.from_user.id)
+        if session.images_clue is None:
+            self.bot.send_message(callback.message.chat.id, self.EXPIRED_MESSAGE)
+            return
         if callback.data == "clue_yes":
-            self.bot.send_message(callback.message.chat.id, "Begun generating clue:")
+            status = self.start_status(callback.message.chat.id, "Begun generating clue:")
             clue_generation_start = datetime.now()
-            image_number = random.randint(0, len(self.images_clue))
-            self.image_for_clue = self.images_clue[image_number]
-            self.clue_dict = generate_clue_for_image(self.image_for_clue, captioning.generate_captions, self.captioning_models, verbose=False)
+            image_number = random.randint(0, len(session.images_clue))
+            session.image_for_clue = session.images_clue[image_number]
+            with self.completion_cache.bypass() if session.fresh_clue else contextlib.nullcontext():
+                session.clue_dict = generate_clue_for_image(session.image_for_clue, captioning.generate_captions, self.captioning_models, cache=self.card_cache, progress=status.progress, stream=status.stream, verbose=False)
             clue_generation_time = (datetime.now() - clue_generation_start).total_seconds()
-            self.bot.send_message(callback.message.chat.id, f"For chosen card {image_number} Was generated clue: {self.clue_dict['clue']} in {clue_generation_time} seconds.")
+            status.flush()
+            self.bot.send_message(callback.message.chat.id, f"For chosen card {image_number} Was generated clue: {session.clue_dict['clue']} in {clue_generation_time} seconds{status.timing_text()}.")
             points_markup = types.InlineKeyboardMarkup(row_width=2)
             for i in range(7):
                 points_markup.add(types.InlineKeyboardButton(f"{i}", callback_data=f"{i}"))
@@ -369,17 +643,21 @@ class DixitBot:
             self.bot.send_message(callback.message.chat.id, "Please retry taking photo of your cards")
 
     def persist_clue(self, callback):
+        session = self.sessions.get(callback.message.chat.id, callback.from_user.id)
+        if session.clue_dict is None:
+            self.bot.send_message(callback.message.chat.id, self.EXPIRED_MESSAGE)
+            return
         points_dict = {f"{i}" : i for i in range(7)}
         points = points_dict[callback.data]
-        self.clue_dict['image_hash'] = str(imagehash.average_hash(self.image_for_clue))
-        self.clue_dict['score'] = points
-        self.clue_dict["captions"] = self.clue_dict["captions"]["captions"]
-        output_logs_path = os.path.join(".cache/output_logs/clues", f"{os.path.basename(self.cache_path_clue).replace('.jpg', '')}.yaml")
+        session.clue_dict['image_hash'] = str(imagehash.average_hash(session.image_for_clue))
+        session.clue_dict['score'] = points
+        session.clue_dict["captions"] = session.clue_dict["captions"]["captions"]
+        output_logs_path = os.path.join(".cache/output_logs/clues", f"{os.path.basename(session.cache_path_clue).replace('.jpg', '')}.yaml")
         with open(output_logs_path, 'w') as fd:
-            yaml.dump(self.clue_dict, fd, default_flow_style=False, sort_keys=False)
-        self.cur.execute("INSERT INTO generated_clues VALUES(:image_hash, :captions, :interpretation, :association, :clue, :score, :qna_session, :pre_qna_interpretation)", self.clue_dict)
-        self.con.commit()
-        self.bot.send_message(callback.message.chat.id, "Successfully saved this experience. You may now proceed to generating a clue")
+            yaml.dump(session.clue_dict, fd, default_flow_style=False, sort_keys=False)
+        self.save_result(
+            callback.message.chat.id, "generated_clues", session.clue_dict,
+            "Successfully saved this experience. You may now proceed to generating a clue")
 
 
 def main():
@@ -390,7 +668,14 @@ def main():
 
     os.makedirs(bot.IMAGE_FOLDER, exist_ok=True)
     os.makedirs(bot.GAME_STATE_FOLDER, exist_ok=True)
+    # Game states of the YAML storage are imported once, the files are kept as .yaml.migrated
+    bot.game_states.migrate_yaml(bot.GAME_STATE_FOLDER)
+    bot.images.sync_references(bot.game_states.image_paths())
     os.makedirs(bot.OUTPUT_LOGS, exist_ok=True)
+    # Spans of every request go to a JSONL file per day, DIXITAI_TRACE_DIR="" turns that off
+    tracing.configure(os.environ.get('DIXITAI_TRACE_DIR', ".cache/traces/"))
+    if os.environ.get('DIXITAI_METRICS_PORT'):
+        tracing.serve_metrics(int(os.environ['DIXITAI_METRICS_PORT']))
 
     @bot.bot.message_handler(commands=['help'])
     def send_welcome_wrapper(message):
@@ -398,85 +683,96 @@ def main():
 
     @bot.bot.message_handler(func=lambda m: str(m.caption).startswith("/clue"), content_types=['photo', 'text'])
     def generate_clue_for_cards_wrapper(message):
-        try:
-            bot.generate_clue_for_cards(message)
-        except Exception as e:
-            bot.bot.reply_to(message, e)
+        bot.dispatch(message, bot.generate_clue_for_cards)
 
     @bot.bot.message_handler(func=lambda m: str(m.caption).startswith("/guess"), content_types=['photo', 'text'])
     def guess_card_on_table_wrapper(message):
-        try:    
-            bot.guess_card_on_table(message)
-        except Exception as e:
-            bot.bot.reply_to(message, e)
+        bot.dispatch(message, bot.guess_card_on_table)
 
     @bot.bot.message_handler(func=lambda m: str(m.caption).startswith("/add"), content_types=['photo', 'text'])
     def add_cards_to_hand_wrapper(message): 
-        bot.add_cards_to_hand(message)
+        bot.dispatch(message, bot.add_cards_to_hand)
 
     @bot.bot.message_handler(commands=['guess_hand'])
     def guess_from_hand_wrapper(message):
-        bot.guess_card_from_hand(message)
+        bot.dispatch(message, bot.guess_card_from_hand)
 
     @bot.bot.message_handler(commands=['del'])
     def delete_card_from_hand_wrapper(message):
-        bot.remove_card_from_hand(message)
+        bot.dispatch(message, bot.remove_card_from_hand)
 
     @bot.bot.message_handler(commands=['hand', 'status'])
     def get_hand_wrapper(message):
-        bot.show_short_hand_clues(message)
+        bot.dispatch(message, bot.show_short_hand_clues)
 
     @bot.bot.message_handler(commands=['hand_detailed', 'status_detailed'])
     def get_hand_detailed_wrapper(message):
-        try:
-            bot.show_detailed_hand_clues(message)
-        except Exception as e:
-            bot.bot.reply_to(message, e)
+        bot.dispatch(message, bot.show_detailed_hand_clues)
+
+    @bot.bot.message_handler(commands=['models'])
+    def model_stats_wrapper(message):
+        bot.show_model_stats(message)
+
+    @bot.bot.message_handler(commands=['guess_stats'])
+    def guess_stats_wrapper(message):
+        bot.show_guess_stats(message)
+
+    @bot.bot.message_handler(commands=['cache_stats'])
+    def cache_stats_wrapper(message):
+        bot.show_cache_stats(message)
+
+    @bot.bot.message_handler(commands=['cancel'])
+    def cancel_wrapper(message):
+        bot.cancel_jobs(message)
+
+    @bot.bot.message_handler(commands=['jobs'])
+    def job_stats_wrapper(message):
+        bot.show_job_stats(message)
 
     @bot.bot.message_handler(commands=['reset'])
-    def reset_state(message):
-        logging.log(logging.INFO, f"Received [reset] request from {message.from_user.username}.")    
-        reset_game_state(get_game_state_path(bot, message, game_state_folder=bot.GAME_STATE_FOLDER))
-        bot.reply_to(message, "Game is reset to initial state.")
+    def reset_state_wrapper(message):
+        bot.dispatch(message, bot.reset_state)
 
     @bot.bot.message_handler(commands=['nuke_cache'])
-    def nuke_cache(message):
-        logging.log(logging.INFO, f"Received [nuke_cache] request from {message.from_user.username}.")    
-        reset_game_state(get_game_state_path(bot, message, game_state_folder=bot.GAME_STATE_FOLDER))
-        files = glob.glob(os.path.join(bot.IMAGE_FOLDER, "*"))
-        for f in files:
-            os.remove(f)
-        bot.reply_to(message, "All cache is nuked and game state is reset to initial state.")
+    def nuke_cache_wrapper(message):
+        bot.dispatch(message, bot.nuke_cache)
 
     @bot.bot.callback_query_handler(func=lambda callback: callback.data.startswith('from_hand'))
     def persist_guess_from_hand_wrapper(callback):
-        bot.persist_guess_from_hand(callback)
+        bot.dispatch(callback, bot.persist_guess_from_hand)
 
     @bot.bot.callback_query_handler(func=lambda callback: callback.data.startswith('add'))
     def check_images_guess_wrapper(callback):
-        bot.check_adding_cards(callback)
+        bot.dispatch(callback, bot.check_adding_cards)
 
     @bot.bot.callback_query_handler(func=lambda callback: callback.data.startswith('guess'))
     def check_images_guess_wrapper(callback):
-        bot.check_images_guess(callback)
+        bot.dispatch(callback, bot.check_images_guess)
 
     @bot.bot.callback_query_handler(func=lambda callback: callback.data.startswith('Image_'))
     def points_guess_wrapper(callback):
-        bot.points_guess(callback)
+        bot.dispatch(callback, bot.points_guess)
 
     @bot.bot.callback_query_handler(func=lambda callback: callback.data.startswith('_guess'))
     def persist_guess_wrapper(callback):
-        bot.persist_guess(callback)
+        bot.dispatch(callback, bot.persist_guess)
 
     @bot.bot.callback_query_handler(func=lambda callback: callback.data.startswith('clue'))
     def check_images_clue_wrapper(callback):
-        bot.check_images_clue(callback)
+        bot.dispatch(callback, bot.check_images_clue)
 
     @bot.bot.callback_query_handler(func=lambda callback: True)
     def persist_clue_wrapper(callback):
-        bot.persist_clue(callback)
-
-    bot.start()
+        bot.dispatch(callback, bot.persist_clue)
+
+    # Models load in the background while the bot already answers, the first request needing
+    # a model that isn't loaded yet waits for it
+    bot.registry.preload_async()
+    try:
+        bot.start()
+    finally:
+        # Commit the results still queued
+        bot.results.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,137 @@
+import numpy as np
+import torch
+from PIL import Image
+from transformers import OwlViTForObjectDetection, OwlViTModel, OwlViTProcessor
+
+import preprocessing
+
+
+class ClipEmbedder:
+    """Image and text embeddings in the shared CLIP space of the OWL-ViT backbone."""
+
+    def __init__(self, model, processor):
+        self.model = model
+        self.processor = processor
+
+    @staticmethod
+    def load(checkpoint="google/owlvit-base-patch32", detector=None):
+        # Reuse the backbone of the torch detector instead of loading the weights twice
+        if isinstance(getattr(detector, 'model', None), OwlViTForObjectDetection):
+            return ClipEmbedder(detector.model.owlvit, detector.processor)
+        model = OwlViTModel.from_pretrained(checkpoint)
+        model.to("cuda" if torch.cuda.is_available() else "cpu")
+        return ClipEmbedder(model.eval(), OwlViTProcessor.from_pretrained(checkpoint))
+
+    @property
+    def device(self):
+        return self.model.logit_scale.device
+
+    @property
+    def dtype(self):
+        # logit_scale is a plain parameter, it follows bf16 conversion but not int8 quantization
+        return self.model.logit_scale.dtype
+
+    def embed_images(self, images):
+        pixel_values = preprocessing.pixel_values(self.processor, images)
+        with torch.no_grad():
+            features = self.model.get_image_features(pixel_values=pixel_values.to(self.device, self.dtype))
+        return normalize(features.float().cpu().numpy())
+
+    def embed_texts(self, texts):
+        # The OWL-ViT text tower reads at most 16 tokens
+        inputs = self.processor(text=list(texts), return_tensors="pt", truncation=True)
+        with torch.no_grad():
+            features = self.model.get_text_features(
+                input_ids=inputs['input_ids'].to(self.device),
+                attention_mask=inputs['attention_mask'].to(self.device))
+        return normalize(features.float().cpu().numpy())
+
+
+def normalize(embeddings):
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=-1, keepdims=True), 1e-8)
+
+
+def select_shortlist(similarities, top_k=None, decisive_margin=None):
+    """Indices of the cards worth the LLM reasoning, best first. A single card means the
+    similarity margin alone decided."""
+    ranking = [int(idx) for idx in np.argsort(-np.asarray(similarities))]
+    if decisive_margin is not None and len(ranking) > 1:
+        if similarities[ranking[0]] - similarities[ranking[1]] >= decisive_margin:
+            return ranking[:1]
+    if top_k is not None:
+        return ranking[:max(1, top_k)]
+    return ranking
+
+
+def card_embeddings(embedder, images, clues):
+    # The text tower reads at most 16 tokens, so the card's description is embedded
+    # through its generated clue, the short summary of the interpretation
+    image_embeddings = embedder.embed_images(images)
+    description_embeddings = embedder.embed_texts([clue.strip() for clue in clues])
+    return [
+        {
+            'image_embedding': [round(float(x), 6) for x in image_embedding],
+            'description_embedding': [round(float(x), 6) for x in description_embedding],
+        }
+        for image_embedding, description_embedding in zip(image_embeddings, description_embeddings)
+    ]
+
+
+class HandIndex:
+    """Card embeddings of one hand in hand order, for a vectorised search by clue."""
+
+    def __init__(self):
+        self.card_hashes = []
+        self.image_embeddings = None
+        self.description_embeddings = None
+
+    @staticmethod
+    def from_cards(cards, embedder=None):
+        # cards is the "my_cards" dict of a game state. Cards added before embeddings were stored
+        # get them computed here; returns the index and whether any card was updated.
+        missing = [card_hash for card_hash, card_info in cards.items() if 'image_embedding' not in card_info]
+        if len(missing) > 0 and embedder is not None:
+            images = [Image.open(cards[card_hash]['image_path']).convert('RGB') for card_hash in missing]
+            clues = [cards[card_hash]['clue'] for card_hash in missing]
+            for card_hash, embeddings in zip(missing, card_embeddings(embedder, images, clues)):
+                cards[card_hash].update(embeddings)
+
+        index = HandIndex()
+        for card_hash, card_info in cards.items():
+            index.add(card_hash, card_info['image_embedding'], card_info['description_embedding'])
+        return index, len(missing) > 0
+
+    def __len__(self):
+        return len(self.card_hashes)
+
+    def add(self, card_hash, image_embedding, description_embedding):
+        image_embedding = np.asarray(image_embedding, dtype=np.float32)[None, :]
+        description_embedding = np.asarray(description_embedding, dtype=np.float32)[None, :]
+        if card_hash in self.card_hashes:
+            # Re-adding a card keeps its position, like dict.update on the game state
+            idx = self.card_hashes.index(card_hash)
+            self.image_embeddings[idx] = image_embedding[0]
+            self.description_embeddings[idx] = description_embedding[0]
+        elif self.image_embeddings is None:
+            self.card_hashes.append(card_hash)
+            self.image_embeddings = image_embedding
+            self.description_embeddings = description_embedding
+        else:
+            self.card_hashes.append(card_hash)
+            self.image_embeddings = np.concatenate([self.image_embeddings, image_embedding])
+            self.description_embeddings = np.concatenate([self.description_embeddings, description_embedding])
+
+    def remove(self, card_hashes):
+        keep = [idx for idx, card_hash in enumerate(self.card_hashes) if card_hash not in card_hashes]
+        self.card_hashes = [self.card_hashes[idx] for idx in keep]
+        if self.image_embeddings is not None:
+            self.image_embeddings = self.image_embeddings[keep]
+            self.description_embeddings = self.description_embeddings[keep]
+
+    def search(self, text_embedding, image_weight=0.5):
+        # Similarity of every card in the hand to the clue, blending the card image and its description
+        if len(self.card_hashes) == 0:
+            return np.zeros(0, dtype=np.float32)
+        text_embedding = np.asarray(text_embedding, dtype=np.float32)
+        return (image_weight * (self.image_embeddings @ text_embedding)
+                + (1 - image_weight) * (self.description_embeddings @ text_embedding))
@@ -0,0 +1,157 @@
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import yaml
+
+import tracing
+
+# Text fields of a card as produced by generate_clue_for_image
+TEXT_FIELDS = ('clue', 'association', 'interpretation', 'pre_qna_interpretation', 'qna_session')
+
+
+class GameStateStore:
+    """Hands of all users, one row per card. Cards keep the order they were added in, which is
+    the order /hand shows them and /del refers to them by. With an ImageStore, every card holds
+    a reference on its image file."""
+
+    def __init__(self, path=".cache/game_state.db", images=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.images = images
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS hand_cards(
+                username TEXT,
+                card_hash TEXT,
+                ordinal INTEGER,
+                image_path TEXT,
+                captions TEXT,
+                clue TEXT,
+                association TEXT,
+                interpretation TEXT,
+                pre_qna_interpretation TEXT,
+                qna_session TEXT,
+                image_embedding BLOB,
+                description_embedding BLOB,
+                PRIMARY KEY(username, card_hash)
+            );
+            CREATE INDEX IF NOT EXISTS hand_cards_ordinal ON hand_cards(username, ordinal);
+        """)
+
+    @staticmethod
+    def _to_row(username, card_hash, ordinal, card_info):
+        def embedding(name):
+            value = card_info.get(name)
+            return None if value is None else np.asarray(value, dtype=np.float32).tobytes()
+
+        return (
+            username, card_hash, ordinal, card_info['image_path'], json.dumps(card_info.get('captions')),
+            *[card_info.get(field, "") for field in TEXT_FIELDS],
+            embedding('image_embedding'), embedding('description_embedding'),
+        )
+
+    @staticmethod
+    def _from_row(row):
+        card_hash, image_path, captions, *text, image_embedding, description_embedding = row
+        card_info = {'image_path': image_path, 'captions': json.loads(captions), **dict(zip(TEXT_FIELDS, text))}
+        # Cards without embeddings get them backfilled by HandIndex.from_cards
+        if image_embedding is not None:
+            card_info['image_embedding'] = np.frombuffer(image_embedding, dtype=np.float32).tolist()
+            card_info['description_embedding'] = np.frombuffer(description_embedding, dtype=np.float32).tolist()
+        return card_hash, card_info
+
+    def get_hand(self, username, summary=False):
+        # Same shape as the "my_cards" dict of the YAML game state. The summary only has the
+        # image path and clue of every card, enough for /hand and the hand grid.
+        if summary:
+            with self.lock:
+                rows = self.con.execute(
+                    "SELECT card_hash, image_path, clue FROM hand_cards WHERE username = ? ORDER BY ordinal",
+                    (username,)).fetchall()
+            return {card_hash: {'image_path': image_path, 'clue': clue} for card_hash, image_path, clue in rows}
+        with self.lock:
+            rows = self.con.execute(
+                "SELECT card_hash, image_path, captions, " + ", ".join(TEXT_FIELDS) + ", image_embedding, description_embedding "
+                "FROM hand_cards WHERE username = ? ORDER BY ordinal", (username,)).fetchall()
+        return dict(self._from_row(row) for row in rows)
+
+    def hand_hashes(self, username):
+        with self.lock:
+            rows = self.con.execute(
+                "SELECT card_hash FROM hand_cards WHERE username = ? ORDER BY ordinal", (username,)).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self, username):
+        with self.lock:
+            return self.con.execute("SELECT COUNT(*) FROM hand_cards WHERE username = ?", (username,)).fetchone()[0]
+
+    def add_cards(self, username, cards):
+        # Like dict.update on the hand: known cards are replaced in place, new ones go to the end
+        with tracing.span("db_write/game_state", size=len(cards)), self.lock:
+            next_ordinal = self.con.execute(
+                "SELECT COALESCE(MAX(ordinal) + 1, 0) FROM hand_cards WHERE username = ?", (username,)).fetchone()[0]
+            rows, replaced_paths = [], []
+            for card_hash, card_info in cards.items():
+                row = self.con.execute(
+                    "SELECT ordinal, image_path FROM hand_cards WHERE username = ? AND card_hash = ?",
+                    (username, card_hash)).fetchone()
+                if row is not None:
+                    ordinal = row[0]
+                    replaced_paths.append(row[1])
+                else:
+                    ordinal, next_ordinal = next_ordinal, next_ordinal + 1
+                rows.append(self._to_row(username, card_hash, ordinal, card_info))
+            self.con.executemany("INSERT OR REPLACE INTO hand_cards VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.con.commit()
+        if self.images is not None:
+            self.images.acquire([card_info['image_path'] for card_info in cards.values()])
+            self.images.release(replaced_paths)
+
+    def remove_cards(self, username, card_hashes):
+        with tracing.span("db_write/game_state", size=len(card_hashes)), self.lock:
+            removed_paths = []
+            for card_hash in card_hashes:
+                row = self.con.execute(
+                    "SELECT image_path FROM hand_cards WHERE username = ? AND card_hash = ?", (username, card_hash)).fetchone()
+                if row is not None:
+                    removed_paths.append(row[0])
+                    self.con.execute("DELETE FROM hand_cards WHERE username = ? AND card_hash = ?", (username, card_hash))
+            self.con.commit()
+        if self.images is not None:
+            self.images.release(removed_paths)
+
+    def reset(self, username):
+        with tracing.span("db_write/game_state"), self.lock:
+            removed_paths = [row[0] for row in self.con.execute(
+                "SELECT image_path FROM hand_cards WHERE username = ?", (username,))]
+            self.con.execute("DELETE FROM hand_cards WHERE username = ?", (username,))
+            self.con.commit()
+        if self.images is not None:
+            self.images.release(removed_paths)
+
+    def image_paths(self):
+        # Image path of every card in every hand, a path is there once per hand holding it
+        with self.lock:
+            return [row[0] for row in self.con.execute("SELECT image_path FROM hand_cards")]
+
+    def migrate_yaml(self, game_state_folder):
+        """Imports the <username>.yaml game states of the previous storage. Imported files are
+        renamed to .yaml.migrated, so running it again is a no-op."""
+        migrated = 0
+        for path in sorted(glob.glob(os.path.join(game_state_folder, "*.yaml"))):
+            username = os.path.splitext(os.path.basename(path))[0]
+            with open(path, 'r') as fd:
+                game_state = yaml.safe_load(fd) or dict()
+            cards = game_state.get("my_cards") or dict()
+            self.add_cards(username, cards)
+            os.rename(path, path + ".migrated")
+            migrated += 1
+            logging.log(logging.INFO, f"Migrated game state of {username}: {len(cards)} cards.")
+        return migrated
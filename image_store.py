@@ -0,0 +1,203 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cache import image_content_hash
+
+
+class ImageStore:
+    """Uploaded photos and card crops under .cache/images/, named by the hash of their content so
+    the same image is stored once. Cards in a hand hold a reference on their file. When the files
+    outgrow max_bytes, the least recently used unreferenced ones are deleted; files used in the
+    last min_age_seconds are kept too, they belong to requests still waiting for an answer."""
+
+    def __init__(self, folder=".cache/images/", index_path=".cache/image_store.db",
+                 max_bytes=2 * 1024 ** 3, min_age_seconds=3600):
+        os.makedirs(folder, exist_ok=True)
+        os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.min_age_seconds = min_age_seconds
+        self.evicted = 0
+        # Futures of the writes in progress by content hash, a second put of the image waits on it
+        self.pending = dict()
+        # Card files are written off the request path, readers wait on the returned futures
+        self.writer = ThreadPoolExecutor(max_workers=2)
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(index_path, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS images(
+                content_hash TEXT PRIMARY KEY,
+                path TEXT UNIQUE,
+                size INTEGER,
+                refcount INTEGER,
+                created_at REAL,
+                last_access REAL
+            );
+            CREATE INDEX IF NOT EXISTS images_last_access ON images(refcount, last_access);
+        """)
+        self.total_bytes = self.con.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+
+    def path_for(self, content_hash, ext=".jpg"):
+        # Two levels keep the directories small
+        return os.path.join(self.folder, content_hash[:2], content_hash + ext)
+
+    def _reserve(self, content_hash, ext):
+        """Returns the path of the image, whether the caller has to write it, and the future that
+        is done once the file is there."""
+        now = time.time()
+        with self.lock:
+            row = self.con.execute("SELECT path FROM images WHERE content_hash = ?", (content_hash,)).fetchone()
+            if row is not None:
+                self.con.execute("UPDATE images SET last_access = ? WHERE content_hash = ?", (now, content_hash))
+                self.con.commit()
+                saved = self.pending.get(content_hash)
+                if saved is None and not os.path.exists(row[0]):
+                    # A hand refers to the file but it is gone, it is written again with its count kept
+                    self.pending[content_hash] = Future()
+                    return row[0], True, self.pending[content_hash]
+                if saved is None:
+                    saved = Future()
+                    saved.set_result(row[0])
+                return row[0], False, saved
+            path = self.path_for(content_hash, ext)
+            self.con.execute("INSERT INTO images VALUES(?, ?, 0, 0, ?, ?)", (content_hash, path, now, now))
+            self.con.commit()
+            self.pending[content_hash] = Future()
+            return path, True, self.pending[content_hash]
+
+    def _write(self, content_hash, path, write):
+        saved = self.pending[content_hash]
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written under a temporary name, a reader never sees half a file
+            root, ext = os.path.splitext(path)
+            tmp_path = f"{root}.{threading.get_ident()}.tmp{ext}"
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            with self.lock:
+                self.con.execute("DELETE FROM images WHERE content_hash = ? AND refcount = 0", (content_hash,))
+                self.con.commit()
+                del self.pending[content_hash]
+            saved.set_exception(e)
+            raise
+        size = os.path.getsize(path)
+        with self.lock:
+            del self.pending[content_hash]
+            old_size = self.con.execute("SELECT size FROM images WHERE content_hash = ?", (content_hash,)).fetchone()[0]
+            self.con.execute("UPDATE images SET size = ? WHERE content_hash = ?", (size, content_hash))
+            self.total_bytes += size - old_size
+            self._evict(self.max_bytes)
+            self.con.commit()
+            if self.total_bytes > self.max_bytes:
+                logging.log(logging.WARNING, (
+                    f"Images use {self.total_bytes / 2**20:0.0f} MB of {self.max_bytes / 2**20:0.0f} MB, "
+                    f"the rest is in hands or in requests in progress."))
+        saved.set_result(path)
+        return path
+
+    def put_bytes(self, data, ext=".jpg"):
+        # Downloaded files are keyed by the hash of their bytes and written right away
+        content_hash = hashlib.sha256(data).hexdigest()
+        path, new, saved = self._reserve(content_hash, ext)
+        if new:
+            def write(tmp_path):
+                with open(tmp_path, 'wb') as fd:
+                    fd.write(data)
+            self._write(content_hash, path, write)
+        return saved.result()
+
+    def put_image(self, image, ext=".jpg"):
+        """Stores a PIL image, keyed by the hash of its pixels. Returns the path and a future that
+        is done once the file is written."""
+        content_hash = image_content_hash(image)
+        path, new, saved = self._reserve(content_hash, ext)
+        if new:
+            self.writer.submit(self._write, content_hash, path, image.save)
+        return path, saved
+
+    def acquire(self, paths):
+        self._add_references(paths, 1)
+
+    def release(self, paths):
+        self._add_references(paths, -1)
+
+    def _add_references(self, paths, delta):
+        # Files from before the store (not in the index) are never evicted and need no count
+        now = time.time()
+        with self.lock:
+            self.con.executemany(
+                "UPDATE images SET refcount = MAX(refcount + ?, 0), last_access = ? WHERE path = ?",
+                [(delta, now, path) for path in paths])
+            if delta > 0:
+                # A store path missing from the index was evicted while a request held it, the row
+                # comes back with the count so that writing the image again doesn't start from 0
+                rows = []
+                for path in paths:
+                    content_hash = self.content_hash_of(path)
+                    if content_hash is not None:
+                        rows.append((content_hash, path, delta, now, now))
+                self.con.executemany("INSERT OR IGNORE INTO images VALUES(?, ?, 0, ?, ?, ?)", rows)
+            self.con.commit()
+
+    def content_hash_of(self, path):
+        # The content hash of a path laid out by path_for, None for other files
+        content_hash, ext = os.path.splitext(os.path.basename(path))
+        if path == self.path_for(content_hash, ext):
+            return content_hash
+        return None
+
+    def sync_references(self, paths):
+        # Sets the counts from the image paths of all hands, e.g. after importing game states
+        with self.lock:
+            self.con.execute("UPDATE images SET refcount = 0")
+            self.con.executemany(
+                "UPDATE images SET refcount = ? WHERE path = ?", [(count, path) for path, count in Counter(paths).items()])
+            self.con.commit()
+
+    def _evict(self, max_bytes, min_age_seconds=None):
+        min_age_seconds = self.min_age_seconds if min_age_seconds is None else min_age_seconds
+        if self.total_bytes <= max_bytes:
+            return
+        rows = self.con.execute(
+            "SELECT content_hash, path, size FROM images WHERE refcount = 0 AND last_access < ? ORDER BY last_access",
+            (time.time() - min_age_seconds,)).fetchall()
+        for content_hash, path, size in rows:
+            if self.total_bytes <= max_bytes:
+                break
+            if content_hash in self.pending:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.con.execute("DELETE FROM images WHERE content_hash = ?", (content_hash,))
+            self.total_bytes -= size
+            self.evicted += 1
+
+    def purge_unreferenced(self):
+        # Deletes every file no hand refers to, except the ones of requests that may still add them
+        with self.lock:
+            evicted = self.evicted
+            self._evict(0)
+            self.con.commit()
+            return self.evicted - evicted
+
+    def stats(self):
+        with self.lock:
+            entries, referenced = self.con.execute(
+                "SELECT COUNT(*), COALESCE(SUM(refcount > 0), 0) FROM images").fetchone()
+            return {
+                'entries': entries,
+                'referenced': referenced,
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'evicted': self.evicted,
+            }
@@ -0,0 +1,193 @@
+import gc
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+
+def model_tensor_bytes(obj):
+    # Size of the weights and buffers of every torch module reachable from the wrapper object, by data pointer,
+    # and of the graphs of the ONNX Runtime sessions (listed in model_files), by path
+    modules, files, seen = [], [], set()
+
+    def collect(value, depth=0):
+        if id(value) in seen or depth > 2:
+            return
+        seen.add(id(value))
+        if isinstance(value, torch.nn.Module):
+            modules.append(value)
+        elif hasattr(value, 'model_files'):
+            files.extend(value.model_files)
+        elif isinstance(value, dict):
+            for item in value.values():
+                collect(item, depth + 1)
+        elif hasattr(value, '__dict__'):
+            for item in vars(value).values():
+                collect(item, depth + 1)
+
+    collect(obj)
+    tensors = dict()
+
+    def add(value):
+        if torch.is_tensor(value):
+            tensors[value.data_ptr()] = value.numel() * value.element_size()
+        elif isinstance(value, (tuple, list)):
+            # Dynamically quantized linear layers keep their int8 weights as packed (weight, bias) tuples
+            for item in value:
+                add(item)
+
+    for module in modules:
+        for value in module.state_dict(keep_vars=True).values():
+            add(value)
+    for path in files:
+        tensors[path] = os.path.getsize(path)
+    return tensors
+
+
+def model_memory_bytes(obj):
+    return sum(model_tensor_bytes(obj).values())
+
+
+def parse_model_config(text):
+    # "blip2=bf16,git_large=int8" -> {'blip2': 'bf16', 'git_large': 'int8'}
+    config = dict()
+    for item in (text or "").split(','):
+        if item.strip() == "":
+            continue
+        name, value = item.split('=')
+        config[name.strip()] = value.strip()
+    return config
+
+
+class ModelRegistry:
+    """Loads models on first use and keeps the loaded ones under a memory budget,
+    unloading the least recently used model when a new one doesn't fit. A model registered with
+    depends_on may share weights with that model: it is only charged for the weights it doesn't
+    share and is unloaded together with it."""
+
+    def __init__(self, memory_budget_bytes=None):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.loaders = dict()
+        self.models = OrderedDict()
+        self.memory = dict()
+        self.load_times = dict()
+        self.load_counts = dict()
+        self.lock = threading.Lock()
+        self.load_locks = dict()
+        self.dependencies = dict()
+
+    def register(self, name, loader, depends_on=None):
+        self.loaders[name] = loader
+        self.dependencies[name] = depends_on
+        self.load_locks[name] = threading.Lock()
+        self.load_counts[name] = 0
+
+    def get(self, name):
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                return self.models[name]
+
+        # Only one thread loads a given model, the others wait for it
+        with self.load_locks[name]:
+            with self.lock:
+                if name in self.models:
+                    self.models.move_to_end(name)
+                    return self.models[name]
+
+            start = time.perf_counter()
+            model = self.loaders[name]()
+            load_time = time.perf_counter() - start
+            tensors = model_tensor_bytes(model)
+            dependency = self.dependencies[name]
+            with self.lock:
+                shared = self.models.get(dependency)
+            if shared is not None:
+                shared_tensors = model_tensor_bytes(shared)
+                tensors = {ptr: size for ptr, size in tensors.items() if ptr not in shared_tensors}
+            memory = sum(tensors.values())
+            logging.log(logging.INFO, f"Loaded model [{name}] in {load_time:0.1f} seconds, {memory / 2**20:0.0f} MB.")
+
+            with self.lock:
+                self.models[name] = model
+                self.memory[name] = memory
+                self.load_times[name] = load_time
+                self.load_counts[name] += 1
+                self._evict(keep=name)
+        return model
+
+    def _evict(self, keep):
+        if self.memory_budget_bytes is None:
+            return
+        evicted = False
+        for name in list(self.models):
+            if sum(self.memory[loaded] for loaded in self.models) <= self.memory_budget_bytes:
+                break
+            # The model kept may hold the weights of its dependency, unloading that frees nothing
+            if name not in self.models or name == keep or name == self.dependencies[keep]:
+                continue
+            # Callers still holding the model keep it alive until they are done with it
+            for unloaded in self._remove(name):
+                logging.log(logging.INFO, f"Unloaded model [{unloaded}] to stay within the memory budget.")
+            evicted = True
+        if evicted:
+            gc.collect()
+
+    def _remove(self, name):
+        # Removes the model and the loaded models depending on it, returns their names
+        removed = []
+        if self.models.pop(name, None) is not None:
+            removed.append(name)
+        for dependent, dependency in self.dependencies.items():
+            if dependency == name and dependent in self.models:
+                removed.extend(self._remove(dependent))
+        return removed
+
+    def unload(self, name):
+        with self.lock:
+            self._remove(name)
+        gc.collect()
+
+    def preload(self, names=None):
+        # Stops once the budget is reached, loading more would only unload the models preloaded before
+        preloaded = []
+        for name in names or list(self.loaders):
+            with self.lock:
+                if name not in self.models and self.memory_budget_bytes is not None:
+                    loaded_bytes = sum(self.memory[loaded] for loaded in self.models)
+                    # The size of a model is only known once it has been loaded before
+                    expected = self.memory.get(name, 0)
+                    evicted = [other for other in preloaded if other not in self.models]
+                    if evicted or loaded_bytes >= self.memory_budget_bytes or loaded_bytes + expected > self.memory_budget_bytes:
+                        logging.log(logging.INFO, f"Stopped preloading at model [{name}], the memory budget is reached.")
+                        return preloaded
+            try:
+                self.get(name)
+                preloaded.append(name)
+            except Exception as e:
+                logging.log(logging.ERROR, f"Failed to preload model [{name}]: {e}")
+        return preloaded
+
+    def preload_async(self, names=None):
+        thread = threading.Thread(target=self.preload, args=(names,), daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self.lock:
+            return {
+                'memory_budget_bytes': self.memory_budget_bytes,
+                'loaded_bytes': sum(self.memory[name] for name in self.models),
+                'models': {
+                    name: {
+                        'loaded': name in self.models,
+                        'memory_bytes': self.memory.get(name),
+                        'load_seconds': self.load_times.get(name),
+                        'load_count': self.load_counts[name],
+                    }
+                    for name in self.loaders
+                },
+            }
@@ -0,0 +1,400 @@
+import inspect
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import onnxruntime as ort
+import torch
+import transformers
+from transformers import OwlViTForObjectDetection, OwlViTProcessor
+
+from detection import CARD_LABELS, DETECTOR_CHECKPOINT, CardDetector
+
+ONNX_FOLDER = ".cache/onnx/"
+OPSET_VERSION = 14
+# Bumped whenever the exported graphs change, older exports are redone
+EXPORT_VERSION = 2
+# The decoder wrappers pass past_key_values as tuples to the GIT, BLIP and GPT-2 modules of these
+# transformers releases, check the exported decoders against model.generate() before adding one
+TRANSFORMERS_VERSIONS = ('4.45',)
+
+
+def is_exported(name):
+    # meta.json is written last, so an interrupted export is redone
+    path = os.path.join(ONNX_FOLDER, name, "meta.json")
+    return os.path.exists(path) and read_meta(name).get('export_version') == EXPORT_VERSION
+
+
+def read_meta(name):
+    with open(os.path.join(ONNX_FOLDER, name, "meta.json")) as fd:
+        return json.load(fd)
+
+
+def write_meta(name, meta):
+    with open(os.path.join(ONNX_FOLDER, name, "meta.json"), 'w') as fd:
+        json.dump(dict(meta, export_version=EXPORT_VERSION), fd)
+
+
+def export_folder(name):
+    # Quantized and optimized graphs of an earlier export would be loaded in place of the new ones
+    folder = os.path.join(ONNX_FOLDER, name)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    return folder
+
+
+def check_transformers_version():
+    version = '.'.join(transformers.__version__.split('.')[:2])
+    if version not in TRANSFORMERS_VERSIONS:
+        raise RuntimeError(
+            f"ONNX export is checked with transformers {', '.join(TRANSFORMERS_VERSIONS)}, found {transformers.__version__}")
+
+
+def export_onnx(module, args, path, **kwargs):
+    # The TorchScript exporter, the default of torch.onnx.export before torch 2.9
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    torch.onnx.export(module, args, path, opset_version=OPSET_VERSION, **kwargs)
+
+
+def model_path(name, part, precision='fp32'):
+    path = os.path.join(ONNX_FOLDER, name, f"{part}.onnx")
+    if precision == 'int8':
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        int8_path = os.path.join(ONNX_FOLDER, name, f"{part}.int8.onnx")
+        if not os.path.exists(int8_path):
+            quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+        return int8_path
+    if precision not in (None, 'fp32'):
+        logging.log(logging.WARNING, f"ONNX backend has no {precision} mode on CPU, using fp32 for [{name}].")
+    return path
+
+
+def create_session(path):
+    options = ort.SessionOptions()
+    # The first start runs all graph optimisations and saves the result, later starts load it as is
+    optimized_path = path.replace('.onnx', '.optimized.onnx')
+    if os.path.exists(optimized_path):
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        path = optimized_path
+    else:
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.optimized_model_filepath = optimized_path
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def past_names(num_layers, prefix):
+    return [f"{prefix}_{kind}_{layer}" for layer in range(num_layers) for kind in ('key', 'value')]
+
+
+def _pairs(past):
+    # Flat (key 0, value 0, key 1, ...) -> past_key_values tuple, None before the first token
+    if len(past) == 0:
+        return None
+    return tuple((past[idx], past[idx + 1]) for idx in range(0, len(past), 2))
+
+
+def _flat(past_key_values):
+    return tuple(tensor for layer in past_key_values for tensor in layer)
+
+
+class _GitEncoder(torch.nn.Module):
+    # The image tokens of GIT attend to each other only, never to the text, so their keys and values
+    # in every layer are computed here once and start the past of the decoder
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        git = self.model.git
+        visual_features = git.image_encoder(pixel_values, return_dict=False)[0]
+        hidden_states = git.visual_projection(visual_features)
+        past_key_values = git.encoder(hidden_states, use_cache=True, return_dict=False)[1]
+        return _flat(past_key_values)
+
+
+class _GitDecoder(torch.nn.Module):
+    # One new token per call, attending to the image tokens and the text before it in the past
+    past_from_encoder = True
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        vision_config = model.config.vision_config
+        self.num_image_tokens = (vision_config.image_size // vision_config.patch_size) ** 2 + 1
+
+    def forward(self, input_ids, *past):
+        git = self.model.git
+        # Text positions count from the first text token
+        embedding_output = git.embeddings(
+            input_ids=input_ids, past_key_values_length=past[0].shape[2] - self.num_image_tokens)
+        sequence_output, past_key_values = git.encoder(
+            embedding_output, past_key_values=_pairs(past), use_cache=True, return_dict=False)[:2]
+        return (self.model.output(sequence_output),) + _flat(past_key_values)
+
+
+class _BlipEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.vision_model(pixel_values=pixel_values, return_dict=False)[0]
+
+
+class _BlipDecoder(torch.nn.Module):
+    past_from_encoder = False
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, encoder_hidden_states, *past):
+        outputs = self.model.text_decoder(
+            input_ids=input_ids, encoder_hidden_states=encoder_hidden_states, past_key_values=_pairs(past),
+            use_cache=True, return_dict=False)
+        return (outputs[0],) + _flat(outputs[1])
+
+
+class _VisionEncoderDecoderEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        hidden_states = self.model.encoder(pixel_values=pixel_values, return_dict=False)[0]
+        # Only present when encoder and decoder hidden sizes differ
+        if getattr(self.model, 'enc_to_dec_proj', None) is not None:
+            hidden_states = self.model.enc_to_dec_proj(hidden_states)
+        return hidden_states
+
+
+class _VisionEncoderDecoderDecoder(torch.nn.Module):
+    past_from_encoder = False
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, encoder_hidden_states, *past):
+        outputs = self.model.decoder(
+            input_ids=input_ids, encoder_hidden_states=encoder_hidden_states, past_key_values=_pairs(past),
+            use_cache=True, return_dict=False)
+        return (outputs[0],) + _flat(outputs[1])
+
+
+def _split_captioner(model):
+    # Returns (encoder, decoder, image size, token ids) for the supported architectures
+    config = model.config
+    if config.model_type == 'git':
+        meta = {
+            'start_token_id': config.bos_token_id,
+            'eos_token_id': config.eos_token_id,
+            'pad_token_id': config.pad_token_id,
+        }
+        return _GitEncoder(model), _GitDecoder(model), config.vision_config.image_size, meta
+    if config.model_type == 'blip':
+        meta = {
+            'start_token_id': config.text_config.bos_token_id,
+            'eos_token_id': config.text_config.sep_token_id,
+            'pad_token_id': config.text_config.pad_token_id,
+        }
+        return _BlipEncoder(model), _BlipDecoder(model), config.vision_config.image_size, meta
+    if config.model_type == 'vision-encoder-decoder':
+        start_token_id = config.decoder_start_token_id
+        if start_token_id is None:
+            start_token_id = config.decoder.bos_token_id
+        eos_token_id = config.eos_token_id if config.eos_token_id is not None else config.decoder.eos_token_id
+        meta = {
+            'start_token_id': start_token_id,
+            'eos_token_id': eos_token_id,
+            'pad_token_id': config.pad_token_id if config.pad_token_id is not None else eos_token_id,
+        }
+        return (_VisionEncoderDecoderEncoder(model), _VisionEncoderDecoderDecoder(model),
+                config.encoder.image_size, meta)
+    raise ValueError(f"ONNX export is not supported for {config.model_type} models")
+
+
+def export_captioner(name, model):
+    """Exports the image encoder and a decoder running one token per call on the keys and values
+    of the tokens before it (past_* inputs, present_* outputs)."""
+    check_transformers_version()
+    logging.log(logging.INFO, f"Exporting [{name}] to ONNX.")
+    folder = export_folder(name)
+    encoder, decoder, image_size, meta = _split_captioner(model.cpu())
+    # torch.onnx.export puts the module back into its own mode afterwards, a wrapper left in training
+    # mode would turn the dropout of the model on
+    encoder, decoder = encoder.eval(), decoder.eval()
+    batch_axis = {0: 'batch'}
+    past_axes = {0: 'batch', 2: 'past_sequence'}
+
+    with torch.no_grad():
+        pixel_values = torch.randn(2, 3, image_size, image_size)
+        input_ids = torch.full((2, 1), meta['start_token_id'], dtype=torch.long)
+        if decoder.past_from_encoder:
+            past = encoder(pixel_values)
+            encoder_names = past_names(len(past) // 2, 'present')
+            encoder_inputs = ()
+        else:
+            encoder_hidden_states = encoder(pixel_values)
+            encoder_names = ['encoder_hidden_states']
+            encoder_inputs = (encoder_hidden_states,)
+            # The past of the start token, so the decoder is traced with a non-empty past
+            past = decoder(input_ids, encoder_hidden_states)[1:]
+        export_onnx(
+            encoder, (pixel_values,), os.path.join(folder, "encoder.onnx"),
+            input_names=['pixel_values'], output_names=encoder_names,
+            dynamic_axes={'pixel_values': batch_axis, **{name: past_axes for name in encoder_names}})
+
+        decoder_names = ['input_ids'] + encoder_names[:len(encoder_inputs)] + past_names(len(past) // 2, 'past')
+        present_names = past_names(len(past) // 2, 'present')
+        export_onnx(
+            decoder, (input_ids,) + encoder_inputs + tuple(past), os.path.join(folder, "decoder.onnx"),
+            input_names=decoder_names, output_names=['logits'] + present_names,
+            dynamic_axes={
+                'input_ids': batch_axis,
+                'encoder_hidden_states': batch_axis,
+                'logits': batch_axis,
+                **{name: past_axes for name in decoder_names[1 + len(encoder_inputs):] + present_names},
+            })
+
+    write_meta(name, meta)
+
+
+class OnnxCaptioner:
+    """Drop-in replacement for the `model` of a CaptioningModel, runs greedy decoding
+    with ONNX Runtime. Every step feeds the last token and the keys and values of the ones before."""
+
+    def __init__(self, encoder, decoder, meta, model_files=()):
+        self.encoder = encoder
+        self.decoder = decoder
+        self.meta = meta
+        # Read by the model registry, the sessions hold about the size of their graphs
+        self.model_files = list(model_files)
+        self.encoder_names = [output.name for output in encoder.get_outputs()]
+        self.past_inputs = [item for item in decoder.get_inputs() if item.name.startswith('past_')]
+
+    @staticmethod
+    def load(name, model=None, precision='fp32'):
+        if not is_exported(name):
+            export_captioner(name, model)
+        paths = [model_path(name, part, precision) for part in ("encoder", "decoder")]
+        return OnnxCaptioner(*[create_session(path) for path in paths], read_meta(name), paths)
+
+    def generate(self, pixel_values, max_length=50):
+        if torch.is_tensor(pixel_values):
+            pixel_values = pixel_values.cpu().numpy()
+        pixel_values = pixel_values.astype(np.float32)
+        batch_size = pixel_values.shape[0]
+
+        # The image is encoded once, every decoding step reuses the encoder output
+        encoder_outputs = dict(zip(self.encoder_names, self.encoder.run(None, {'pixel_values': pixel_values})))
+        inputs = {name: value for name, value in encoder_outputs.items() if not name.startswith('present_')}
+        for item in self.past_inputs:
+            # Nothing in the past before the start token, unless the encoder filled it
+            present = encoder_outputs.get(item.name.replace('past_', 'present_', 1))
+            inputs[item.name] = present if present is not None else np.zeros(
+                (batch_size, item.shape[1], 0, item.shape[3]), dtype=np.float32)
+
+        input_ids = np.full((batch_size, 1), self.meta['start_token_id'], dtype=np.int64)
+        finished = np.zeros(batch_size, dtype=bool)
+        for _ in range(max_length - 1):
+            # Only the last token goes through the decoder, the tokens before it are in the past
+            logits, *presents = self.decoder.run(None, dict(inputs, input_ids=input_ids[:, -1:]))
+            inputs.update((item.name, present) for item, present in zip(self.past_inputs, presents))
+            next_tokens = np.where(finished, self.meta['pad_token_id'], logits[:, -1, :].argmax(-1))
+            input_ids = np.concatenate([input_ids, next_tokens[:, None].astype(np.int64)], axis=1)
+            finished |= next_tokens == self.meta['eos_token_id']
+            if finished.all():
+                break
+        return input_ids
+
+
+class _OwlViTTextEmbedder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.owlvit.get_text_features(input_ids=input_ids, attention_mask=attention_mask)[None]
+
+
+class _OwlViTDetector(torch.nn.Module):
+    # CardDetector.predict, with the query embeddings of the labels as an input
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values, query_embeds):
+        feature_map = self.model.image_embedder(pixel_values=pixel_values)[0]
+        batch_size, height, width, hidden_size = feature_map.shape
+        image_feats = feature_map.reshape(batch_size, height * width, hidden_size)
+        query_embeds = query_embeds.expand(batch_size, -1, -1)
+        query_mask = torch.ones(query_embeds.shape[:2], dtype=torch.bool)
+        logits = self.model.class_predictor(image_feats, query_embeds, query_mask)[0]
+        return logits, self.model.box_predictor(image_feats, feature_map)
+
+
+def export_detector(name, model, processor):
+    logging.log(logging.INFO, f"Exporting [{name}] to ONNX.")
+    folder = export_folder(name)
+    model = model.cpu()
+    size = processor.image_processor.size
+    inputs = processor(text=[CARD_LABELS * 2], return_tensors="pt")
+    pixel_values = torch.randn(2, 3, size['height'], size['width'])
+    with torch.no_grad():
+        text_embedder = _OwlViTTextEmbedder(model).eval()
+        query_embeds = text_embedder(inputs['input_ids'], inputs['attention_mask'])
+        export_onnx(
+            text_embedder, (inputs['input_ids'], inputs['attention_mask']), os.path.join(folder, "text.onnx"),
+            input_names=['input_ids', 'attention_mask'], output_names=['query_embeds'],
+            dynamic_axes={
+                'input_ids': {0: 'queries', 1: 'sequence'},
+                'attention_mask': {0: 'queries', 1: 'sequence'},
+                'query_embeds': {1: 'queries'},
+            })
+        export_onnx(
+            _OwlViTDetector(model).eval(), (pixel_values, query_embeds), os.path.join(folder, "detector.onnx"),
+            input_names=['pixel_values', 'query_embeds'],
+            output_names=['logits', 'pred_boxes'],
+            dynamic_axes={
+                'pixel_values': {0: 'batch'},
+                'query_embeds': {1: 'queries'},
+                'logits': {0: 'batch', 2: 'queries'},
+                'pred_boxes': {0: 'batch'},
+            })
+    write_meta(name, {'checkpoint': model.name_or_path})
+
+
+class OnnxCardDetector(CardDetector):
+    """CardDetector running the text and image parts of OWL-ViT with ONNX Runtime, with the same
+    downscaling, batching and cache of query embeddings."""
+
+    def __init__(self, text_session, session, processor, threshold=0.1, model_files=()):
+        self.text_session = text_session
+        self.session = session
+        self.model_files = list(model_files)
+        super().__init__(None, processor, threshold=threshold)
+
+    @staticmethod
+    def load(checkpoint=DETECTOR_CHECKPOINT, precision='fp32', name='owlvit'):
+        processor = OwlViTProcessor.from_pretrained(checkpoint)
+        if not is_exported(name):
+            export_detector(name, OwlViTForObjectDetection.from_pretrained(checkpoint), processor)
+        paths = [model_path(name, part, precision) for part in ("text", "detector")]
+        return OnnxCardDetector(*[create_session(path) for path in paths], processor, model_files=paths)
+
+    def text_features(self, inputs):
+        return self.text_session.run(None, {
+            'input_ids': inputs['input_ids'].numpy().astype(np.int64),
+            'attention_mask': inputs['attention_mask'].numpy().astype(np.int64),
+        })[0]
+
+    def predict(self, pixel_values, query_embeds):
+        logits, pred_boxes = self.session.run(None, {
+            'pixel_values': pixel_values.numpy().astype(np.float32),
+            'query_embeds': query_embeds,
+        })
+        return torch.from_numpy(logits), torch.from_numpy(pred_boxes)
@@ -0,0 +1,39 @@
+import logging
+
+import torch
+
+PRECISIONS = ('fp32', 'int8', 'bf16')
+
+
+def cpu_supports_bf16():
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def resolve_precision(precision):
+    # Falls back to fp32 when the requested mode can't run on this host
+    precision = precision or 'fp32'
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+    if precision == 'int8' and torch.cuda.is_available():
+        logging.log(logging.WARNING, "Dynamic int8 quantization is CPU only, using fp32.")
+        return 'fp32'
+    if precision == 'bf16' and not torch.cuda.is_available() and not cpu_supports_bf16():
+        logging.log(logging.WARNING, "This CPU has no fast bfloat16 support, using fp32.")
+        return 'fp32'
+    return precision
+
+
+def apply_precision(model, precision):
+    """Returns the model converted to the given precision together with the dtype its
+    floating point inputs should have."""
+    precision = resolve_precision(precision)
+    if precision == 'int8':
+        # Weights of the linear layers are stored as int8, activations are quantized on the fly
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8), torch.float32
+    if precision == 'bf16':
+        return model.to(torch.bfloat16), torch.bfloat16
+    return model, torch.float32
+
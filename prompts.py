@@ -2,12 +2,124 @@ from langchain.chains import LLMChain, ConversationChain
 from langchain.prompts import PromptTemplate
 from langchain.chains.conversation.memory import ConversationBufferMemory
 from langchain.chains import SimpleSequentialChain, SequentialChain
-from langchain.llms import OpenAI
+from langchain.llms import OpenAI, OpenAIChat
+from langchain.callbacks.base import BaseCallbackHandler
 import numpy as np
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import preprocessing
+import tracing
+from cache import image_content_hash
+from card_pipeline import StagedPipeline
+from embedding import select_shortlist
 
 
-def get_image_interpretation_chain(model='gpt-3.5-turbo-instruct', verbose=True):
-    desc_llm = OpenAI(model_name=model, max_tokens=512)
+class StreamingText(BaseCallbackHandler):
+    """Collects the tokens of a streaming LLM and passes the labelled text so far to stream(text),
+    after the text of the previous step when there is one."""
+
+    # Errors raised by stream, e.g. a cancelled job, abort the LLM call instead of being logged
+    raise_error = True
+
+    def __init__(self, stream, label, previous=None):
+        self.stream = stream
+        self.label = label
+        self.previous = previous
+        self.text = ""
+
+    def render(self):
+        text = f"{self.label}: {self.text.strip()}"
+        if self.previous is not None and self.previous.text != "":
+            text = self.previous.render() + "\n\n" + text
+        return text
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.text += token
+        self.stream(self.render())
+
+
+class LLMSpans(BaseCallbackHandler):
+    """Traces every call of an LLM as an llm/<step> span with the token counts of the response.
+    Calls answered by the completion cache don't reach the callbacks, CompletionCache traces those."""
+
+    def __init__(self, step):
+        self.step = step
+        self.open = dict()
+
+    def on_llm_start(self, serialized, prompts, run_id=None, **kwargs):
+        self.open[run_id] = tracing.start_span(
+            f"llm/{self.step}", size=sum(len(prompt) for prompt in prompts), cache='miss')
+
+    def on_llm_end(self, response, run_id=None, **kwargs):
+        llm_span = self.open.pop(run_id, None)
+        if llm_span is None:
+            return
+        llm_output = response.llm_output or dict()
+        token_usage = llm_output.get('token_usage', dict())
+        llm_span.set(
+            model=llm_output.get('model_name'),
+            prompt_tokens=token_usage.get('prompt_tokens'),
+            completion_tokens=token_usage.get('completion_tokens'))
+        tracing.end_span(llm_span)
+
+    def on_llm_error(self, error, run_id=None, **kwargs):
+        llm_span = self.open.pop(run_id, None)
+        if llm_span is not None:
+            llm_span.set(error=type(error).__name__)
+            tracing.end_span(llm_span)
+
+
+class CompletionOpenAI(OpenAI):
+    """OpenAI LLM on the /completions endpoint, which takes the prompts of several cards in one
+    request. langchain 0.0.200 turns OpenAI(model_name="gpt-3.5-turbo...") into an OpenAIChat,
+    which takes a single prompt per call, gpt-3.5-turbo-instruct included."""
+
+    def __new__(cls, **data):
+        return object.__new__(cls)
+
+
+def is_chat_model(model):
+    # gpt-3.5-turbo-instruct is the only gpt-3.5-turbo model served on /completions
+    return model.startswith("gpt-4") or (model.startswith("gpt-3.5-turbo") and "instruct" not in model)
+
+
+_llm_clients = dict()
+_llm_clients_lock = threading.Lock()
+
+
+def _openai(model, step, callbacks=(), **kwargs):
+    # step names the chain step in the traces, e.g. "interpretation" or "clue_relation". Clients
+    # without per-call callbacks are created once and shared, the openai module keeps a pooled
+    # HTTP session per thread. Set OPENAI_API_BASE to use another server, e.g. benchmarks/fake_openai.py
+    llm_class = OpenAIChat if is_chat_model(model) else CompletionOpenAI
+    if len(callbacks) > 0:
+        return llm_class(model_name=model, callbacks=[LLMSpans(step), *callbacks], **kwargs)
+    key = (model, step, tuple(sorted(kwargs.items())))
+    with _llm_clients_lock:
+        client = _llm_clients.get(key)
+        if client is None:
+            client = llm_class(model_name=model, callbacks=[LLMSpans(step)], **kwargs)
+            _llm_clients[key] = client
+    return client
+
+
+def _apply(chain, inputs):
+    # The prompts of all cards go out in one request, chat models only take one prompt per call
+    if isinstance(chain.llm, OpenAIChat):
+        return [output for item in inputs for output in chain.apply([item])]
+    return chain.apply(inputs)
+
+
+def _streaming_llm(model, stream, label, previous=None, **kwargs):
+    # Plain OpenAI LLM when stream is None, otherwise one that reports its tokens as they arrive
+    if stream is None:
+        return _openai(model, label.lower(), **kwargs), None
+    handler = StreamingText(stream, label, previous)
+    return _openai(model, label.lower(), streaming=True, callbacks=[handler], **kwargs), handler
+
+
+def get_image_interpretation_chain(model='gpt-3.5-turbo-instruct', verbose=True, request_timeout=None):
+    desc_llm = _openai(model, "interpretation", max_tokens=512, request_timeout=request_timeout)
     desc_prompt = PromptTemplate(
         input_variables=["image_descriptions", "ai_models"],
         template=(
@@ -32,14 +144,19 @@ def talk_with_blip2(image_interpretation,
                     clue=None,
                     num_questions=2,
                     model='gpt-3.5-turbo-instruct',
-                    verbose=True):
+                    verbose=True,
+                    request_timeout=None):
+    def ask(question):
+        with tracing.span("blip2_question", size=len(question)):
+            return ask_blip2_fn(image, question)
+
     question_answering_log = []
     blip2_answer = "Only ask me questions that matters."
     if clue is not None:
         # Can we directly ask BLIP2 to explain the connection? believe in T5!
         direct_question = f"How does this image relate to the phrase {clue}"
         question_answering_log.append("Question: " + direct_question)
-        blip2_answer = ask_blip2_fn(image, direct_question)
+        blip2_answer = ask(direct_question)
         if verbose:
             print("Answer:", blip2_answer)
         question_answering_log.append("Answer: " + blip2_answer.strip())
@@ -47,7 +164,7 @@ def talk_with_blip2(image_interpretation,
     # Think about what we want to ask
     image_interpretation = image_interpretation.strip()
 
-    pre_llm = OpenAI(model_name=model, max_tokens=256)
+    pre_llm = _openai(model, "qna_plan", max_tokens=256, request_timeout=request_timeout)
     pre_prompt = PromptTemplate(
         input_variables=["image_interpretation"],
         template=(
@@ -62,7 +179,7 @@ def talk_with_blip2(image_interpretation,
     pre_results = pre_chain.predict(image_interpretation=image_interpretation)
     pre_results = pre_results.strip()
 
-    llm = OpenAI(model_name=model, max_tokens=512)
+    llm = _openai(model, "qna_question", max_tokens=512, request_timeout=request_timeout)
     prompt = PromptTemplate(
         input_variables=["blip2_answer", "chat_history"],
         template=(
@@ -101,7 +218,7 @@ def talk_with_blip2(image_interpretation,
         # filter it out:
         results = results[:results.find("Alice:")]
         question_answering_log.append("Question: " + results.strip())
-        blip2_answer = ask_blip2_fn(image, results.strip())
+        blip2_answer = ask(results.strip())
         if verbose:
             print("Answer:", blip2_answer)
         question_answering_log.append("Answer: " + blip2_answer.strip())
@@ -109,8 +226,8 @@ def talk_with_blip2(image_interpretation,
     return '\n'.join(question_answering_log)
 
 
-def get_post_qna_inpterpretation_chain(model='gpt-3.5-turbo-instruct', verbose=True):
-    desc_llm = OpenAI(model_name=model, max_tokens=512)
+def get_post_qna_inpterpretation_chain(model='gpt-3.5-turbo-instruct', verbose=True, request_timeout=None):
+    desc_llm = _openai(model, "post_qna_interpretation", max_tokens=512, request_timeout=request_timeout)
     desc_prompt = PromptTemplate(
         input_variables=[
             "captions", "qna_session", "ai_models"],
@@ -135,8 +252,25 @@ def get_post_qna_inpterpretation_chain(model='gpt-3.5-turbo-instruct', verbose=T
     return desc_chain
 
 
-def get_clue_chain(model='gpt-3.5-turbo-instruct', verbose=True):
-    association_llm = OpenAI(model_name=model, max_tokens=512)
+def get_clue_relation_chain(model='gpt-3.5-turbo-instruct', verbose=True, request_timeout=None):
+    clue_relation_llm = _openai(model, "clue_relation", max_tokens=512, request_timeout=request_timeout)
+    clue_relation_prompt = PromptTemplate(
+        input_variables=["interpretation", "clue"],
+        template=(
+            "Given an image with the following description:"
+            "\n"
+            "{interpretation}"
+            "\n"
+            'Explain how this image is associated with phrase "{clue}"? '
+            "Any movie, book, or historical facts you can think of?"))
+    clue_relation_chain = LLMChain(
+        llm=clue_relation_llm, prompt=clue_relation_prompt,
+        output_key="association", verbose=verbose)
+    return clue_relation_chain
+
+
+def get_clue_chain(model='gpt-3.5-turbo-instruct', verbose=True, stream=None):
+    association_llm, association_stream = _streaming_llm(model, stream, "Association", max_tokens=512)
     association_prompt = PromptTemplate(
         input_variables=["image_interpretation"],
         template=(
@@ -150,7 +284,7 @@ def get_clue_chain(model='gpt-3.5-turbo-instruct', verbose=True):
         llm=association_llm, prompt=association_prompt,
         output_key="association", verbose=verbose)
 
-    clue_llm = OpenAI(model_name=model, max_tokens=512)
+    clue_llm, _ = _streaming_llm(model, stream, "Clue", previous=association_stream, max_tokens=512)
     clue_prompt = PromptTemplate(
         input_variables=["association", "personality"],
         template=(
@@ -172,55 +306,161 @@ def get_clue_chain(model='gpt-3.5-turbo-instruct', verbose=True):
         verbose=verbose)
 
 
+def _cached(cache, image_hash, stage, config, compute_fn):
+    with tracing.span(stage) as stage_span:
+        if cache is None:
+            return compute_fn()
+        value = cache.get(image_hash, stage, config)
+        stage_span.set(cache='miss' if value is None else 'hit')
+        if value is None:
+            value = compute_fn()
+            cache.put(image_hash, stage, config, value)
+        return value
+
+
+def _cached_batch(cache, image_hashes, stage, config, compute_fn):
+    # compute_fn gets the indices of the cards missing from the cache and returns their values
+    # in the same order, so all misses of a stage go out in one batched call
+    with tracing.span(stage, size=len(image_hashes)) as stage_span:
+        values = [None] * len(image_hashes)
+        if cache is not None:
+            values = [cache.get(image_hash, stage, config) for image_hash in image_hashes]
+        missing = [idx for idx, value in enumerate(values) if value is None]
+        if cache is not None:
+            stage_span.set(cache='miss' if len(missing) > 0 else 'hit', cached=len(values) - len(missing))
+        if len(missing) > 0:
+            for idx, value in zip(missing, compute_fn(missing)):
+                values[idx] = value
+                if cache is not None:
+                    cache.put(image_hashes[idx], stage, config, value)
+        return values
+
+
+def _report(progress, text):
+    # progress is an optional callable taking a status line, it may raise to abort the work
+    if progress is not None:
+        progress(text)
+
+
+class _Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def increment(self, count=1):
+        with self.lock:
+            self.value += count
+            return self.value
+
+
+def captioning_config(models):
+    # Identifies the captions of a card in the cache, adaptive captioning may leave models out and
+    # int8, bf16 or ONNX models caption differently. The defaults (fp32 on torch) are left out, so
+    # the cache entries written before those settings existed stay valid.
+    config = {'models': getattr(models, 'model_names', None)}
+    adaptive = getattr(models, 'adaptive', None)
+    if adaptive is not None:
+        config['adaptive'] = adaptive.config
+    precision = {name: value for name, value in (getattr(models, 'precision', None) or dict()).items() if value != 'fp32'}
+    if len(precision) > 0:
+        config['precision'] = precision
+    backend = {name: value for name, value in (getattr(models, 'backend', None) or dict()).items() if value != 'torch'}
+    if len(backend) > 0:
+        config['backend'] = backend
+    return config
+
+
+def caption_images(images, generate_captions_fn, models, cache=None, image_hashes=None):
+    # Batched captioning that only runs the models on cards missing from the cache
+    with tracing.span("captioning", size=len(images)) as captioning_span:
+        config = captioning_config(models)
+        results = [None] * len(images)
+        if cache is not None:
+            if image_hashes is None:
+                image_hashes = [image_content_hash(image) for image in images]
+            results = [cache.get(image_hash, 'captions', config) for image_hash in image_hashes]
+
+        missing = [idx for idx, result in enumerate(results) if result is None]
+        if cache is not None:
+            captioning_span.set(cache='miss' if len(missing) > 0 else 'hit', cached=len(images) - len(missing))
+        if len(missing) > 0:
+            generated = generate_captions_fn(preprocessing.select(images, missing), models)
+            for idx, captioning_results in zip(missing, generated):
+                results[idx] = captioning_results
+                if cache is not None:
+                    cache.put(image_hashes[idx], 'captions', config, captioning_results)
+        return results
+
+
 def generate_clue_for_image(image,
                             generate_captions_fn,
                             models,
                             personality='generic',
                             openai_model='gpt-3.5-turbo-instruct',
                             num_blip2_questions=3,
+                            captioning_results=None,
+                            cache=None,
+                            progress=None,
+                            stream=None,
                             verbose=True):
     
-    captioning_results = generate_captions_fn(image, models)
+    image_hash = image_content_hash(image) if cache is not None else None
+
+    # Captions may be precomputed by a batched generate_captions call over several cards
+    if captioning_results is None:
+        captioning_results = caption_images(
+            [image], generate_captions_fn, models, cache=cache, image_hashes=[image_hash])[0]
+        _report(progress, "captioned the card")
     
     pre_qna_interpretation = ""
     image_interpretation = ""
     blip2_results = ""
+    interp_config = dict(captioning_config(models), openai_model=openai_model)
     
     # Get first interpretation
     image_interp_chain = get_image_interpretation_chain(
         model=openai_model, verbose=verbose)
-    image_interpretation = image_interp_chain.predict(
-        image_descriptions=captioning_results["captions"],
-        ai_models=", ".join(captioning_results["models"]))
-    image_interpretation = image_interpretation.strip()
+    image_interpretation = _cached(
+        cache, image_hash, 'interpretation', interp_config,
+        lambda: image_interp_chain.predict(
+            image_descriptions=captioning_results["captions"],
+            ai_models=", ".join(captioning_results["models"])).strip())
     pre_qna_interpretation = image_interpretation
+    _report(progress, "interpretation done")
 
     if num_blip2_questions > 0:
+        qna_config = dict(interp_config, num_blip2_questions=num_blip2_questions, clue=None)
+
         # Talk with BLIP-v2 to get more information
-        blip2_results = talk_with_blip2(
-            image_interpretation=image_interpretation,
-            image=image,
-            ask_blip2_fn=models.blip2,
-            num_questions=num_blip2_questions,
-            model=openai_model,
-            verbose=verbose)
-        blip2_results = blip2_results.strip()
+        blip2_results = _cached(
+            cache, image_hash, 'qna_session', qna_config,
+            lambda: talk_with_blip2(
+                image_interpretation=image_interpretation,
+                image=image,
+                ask_blip2_fn=models.blip2,
+                num_questions=num_blip2_questions,
+                model=openai_model,
+                verbose=verbose).strip())
+        _report(progress, "QnA done")
 
         # Get final interpretation after QnA session:
         final_interp_chain = get_post_qna_inpterpretation_chain(
             model=openai_model, verbose=verbose)
-        image_interpretation = final_interp_chain.predict(
-            captions=captioning_results["captions"],
-            ai_models=", ".join(captioning_results["models"]),
-            qna_session=blip2_results)
-        image_interpretation = image_interpretation.strip()
+        image_interpretation = _cached(
+            cache, image_hash, 'post_qna_interpretation', qna_config,
+            lambda: final_interp_chain.predict(
+                captions=captioning_results["captions"],
+                ai_models=", ".join(captioning_results["models"]),
+                qna_session=blip2_results).strip())
     else:
         blip2_results = ""
 
     # Generate clue
+    _report(progress, "generating the clue")
     clue_chain = get_clue_chain(
         model=openai_model,
-        verbose=verbose)
+        verbose=verbose,
+        stream=stream)
     clue_results = clue_chain({
         'image_interpretation': image_interpretation,
         'personality': personality,
@@ -242,6 +482,64 @@ def generate_clue_for_image(image,
     return ret_dict
 
 
+def generate_clues_for_images(images,
+                              generate_captions_fn,
+                              models,
+                              personality='generic',
+                              openai_model='gpt-3.5-turbo-instruct',
+                              num_blip2_questions=3,
+                              cache=None,
+                              queue_size=1,
+                              llm_workers=2,
+                              caption_batch_size=8,
+                              progress=None,
+                              verbose=True):
+    # Captioning takes the queued cards in batches of up to caption_batch_size, one batched
+    # forward pass per model, while the remote LLM chains work on the cards captioned before.
+    # The BLIP-2 answers of the QnA session are driven by the LLM questions, so they
+    # run in the LLM stage and share the BLIP-2 lock with the captioning stage.
+    captioned, clued = _Counter(), _Counter()
+
+    def caption_stage(idxs):
+        # A view of the prepared cards keeps the tensors shared with the later models
+        captioning_results = caption_images(
+            preprocessing.select(images, idxs), generate_captions_fn, models, cache=cache)
+        _report(progress, f"captioned {captioned.increment(len(idxs))}/{len(images)} cards")
+        return [(images[idx], result) for idx, result in zip(idxs, captioning_results)]
+
+    def clue_stage(item):
+        image, captioning_results = item
+        result = generate_clue_for_image(
+            image, generate_captions_fn, models,
+            personality=personality,
+            openai_model=openai_model,
+            num_blip2_questions=num_blip2_questions,
+            captioning_results=captioning_results,
+            cache=cache,
+            verbose=verbose)
+        _report(progress, f"clues ready for {clued.increment()}/{len(images)} cards")
+        return result
+
+    pipeline = StagedPipeline([
+        ('captioning', tracing.propagate(caption_stage), 1, caption_batch_size),
+        ('llm', tracing.propagate(clue_stage), llm_workers),
+    ], queue_size=queue_size)
+    results = pipeline.run(list(range(len(images))))
+    return results, pipeline.stats()
+
+
+def _skipped_card_result(similarity):
+    # Reasoning entry for a card that didn't make the similarity shortlist
+    return {
+        'captions': "",
+        'qna_session': "",
+        'interpretation': "",
+        'pre_qna_interpretation': "",
+        'clue_relation': "",
+        'similarity': similarity,
+    }
+
+
 def guess_image_by_clue(images,
                         clue,
                         generate_captions_fn,
@@ -249,101 +547,156 @@ def guess_image_by_clue(images,
                         generated_descriptions=None,
                         openai_model='gpt-3.5-turbo-instruct',
                         num_blip2_questions=1,
+                        cache=None,
+                        max_concurrency=4,
+                        request_timeout=60,
+                        embedder=None,
+                        similarities=None,
+                        top_k=None,
+                        decisive_margin=None,
+                        progress=None,
+                        stream=None,
                         verbose=True):
 
-    results = [dict() for _ in range(len(images))]
-    
-    for image_idx, image in enumerate(images):
-        if generated_descriptions is None:
-            # Generate deep captions
-            captioning_results = generate_captions_fn(image, models)
-            results[image_idx].update({
-                'captions': captioning_results["captions"].strip(),
-            })
+    # Fast mode: rank the cards by image-text similarity to the clue, the LLM chains only
+    # run on the top_k cards and not at all when the best card wins by decisive_margin
+    if similarities is None and embedder is not None:
+        similarities = embedder.embed_images(images) @ embedder.embed_texts([clue])[0]
+    if similarities is not None:
+        similarities = [float(similarity) for similarity in similarities]
+        shortlist = select_shortlist(similarities, top_k=top_k, decisive_margin=decisive_margin)
+    else:
+        shortlist = list(range(len(images)))
+    # Keep the table order in the final prompt
+    shortlist = sorted(shortlist)
+    if similarities is not None:
+        _report(progress, f"shortlisted {len(shortlist)} of {len(images)} cards by similarity")
 
-            # Get first interpretation
-            image_interp_chain = get_image_interpretation_chain(
-                model=openai_model, verbose=verbose)
-            image_interpretation = image_interp_chain.predict(
-                image_descriptions=captioning_results["captions"],
-                ai_models=", ".join(captioning_results["models"]))
-            image_interpretation = image_interpretation.strip()
-            results[image_idx].update({
-                'interpretation': image_interpretation.strip(),
+    if len(shortlist) == 1 and similarities is not None:
+        best = shortlist[0]
+        runner_up = max([similarity for idx, similarity in enumerate(similarities) if idx != best], default=None)
+        final_answer = f"Image_{best} is the closest card to the clue by image-text similarity ({similarities[best]:.3f}"
+        final_answer += f" versus {runner_up:.3f} for the next card)." if runner_up is not None else ")."
+        return {
+            'per_image_reasoning': [_skipped_card_result(similarity) for similarity in similarities],
+            'final_answer': final_answer,
+            'similarities': similarities,
+            'shortlist': shortlist,
+        }
+
+    if generated_descriptions is None:
+        shortlisted_images = preprocessing.select(images, shortlist)
+        image_hashes = [image_content_hash(image) for image in shortlisted_images] if cache is not None else [None] * len(shortlist)
+        # Caption all cards at once, one batched forward pass per model
+        all_captioning_results = dict(zip(shortlist, caption_images(
+            shortlisted_images, generate_captions_fn, models, cache=cache, image_hashes=image_hashes)))
+        image_hashes = dict(zip(shortlist, image_hashes))
+        _report(progress, f"captioned {len(shortlist)} cards")
+    # Every LLM step below is one multi-prompt request for all shortlisted cards, the QnA
+    # sessions are dialogues and the only step that still runs per card
+    shortlist_results = {image_idx: dict() for image_idx in shortlist}
+    if generated_descriptions is None:
+        captions = [all_captioning_results[image_idx] for image_idx in shortlist]
+        card_hashes = [image_hashes[image_idx] for image_idx in shortlist]
+        # The models that ran may differ between cards, the captioning config covers them all
+        interp_config = dict(captioning_config(models), openai_model=openai_model)
+
+        # Get first interpretation
+        image_interp_chain = get_image_interpretation_chain(
+            model=openai_model, verbose=verbose, request_timeout=request_timeout)
+        interpretations = _cached_batch(
+            cache, card_hashes, 'interpretation', interp_config,
+            lambda missing: [output["image_interpretation"].strip() for output in _apply(image_interp_chain, [
+                {'image_descriptions': captions[idx]["captions"], 'ai_models': ", ".join(captions[idx]["models"])}
+                for idx in missing])])
+        for idx, image_idx in enumerate(shortlist):
+            shortlist_results[image_idx].update({
+                'captions': captions[idx]["captions"].strip(),
+                'interpretation': interpretations[idx].strip(),
             })
+        _report(progress, f"interpreted {len(shortlist)} cards")
 
-            if num_blip2_questions > 0:
-                pre_qna_interpretation = ""  # image_interpretation
-                results[image_idx].update({
-                    'pre_qna_interpretation': pre_qna_interpretation.strip(),
-                })
+        if num_blip2_questions > 0:
+            # The QnA session is steered by the clue, so it is cached per clue
+            qna_config = dict(interp_config, num_blip2_questions=num_blip2_questions, clue=clue)
+            asked = _Counter()
 
+            def qna_session(idx):
                 # Talk with BLIP-v2 to get more information
-                blip2_results = talk_with_blip2(
-                    image_interpretation=captioning_results["captions"].strip(),  # image_interpretation,
-                    image=image,
-                    clue=clue,
-                    ask_blip2_fn=models.blip2,
-                    num_questions=num_blip2_questions,
-                    model=openai_model,
-                    verbose=verbose)
-                blip2_results = blip2_results.strip()
-
-                # Get final interpretation after QnA session:
-                final_interp_chain = get_post_qna_inpterpretation_chain(
-                    model=openai_model, verbose=verbose)
-                image_interpretation = final_interp_chain.predict(
-                    captions=captioning_results["captions"],
-                    ai_models=", ".join(captioning_results["models"]),
-                    qna_session=blip2_results)
-                image_interpretation = image_interpretation.strip()
-
-                results[image_idx].update({
-                    'qna_session': blip2_results.strip(),
-                    'interpretation': image_interpretation.strip(),
+                blip2_results = _cached(
+                    cache, card_hashes[idx], 'qna_session', qna_config,
+                    lambda: talk_with_blip2(
+                        image_interpretation=captions[idx]["captions"].strip(),  # image_interpretation,
+                        image=images[shortlist[idx]],
+                        clue=clue,
+                        ask_blip2_fn=models.blip2,
+                        num_questions=num_blip2_questions,
+                        model=openai_model,
+                        verbose=verbose,
+                        request_timeout=request_timeout).strip())
+                _report(progress, f"QnA done for {asked.increment()}/{len(shortlist)} cards")
+                return blip2_results
+
+            # max_concurrency=1 talks about the cards one by one
+            with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+                qna_sessions = list(executor.map(tracing.propagate(qna_session), range(len(shortlist))))
+
+            # Get final interpretation after QnA session:
+            final_interp_chain = get_post_qna_inpterpretation_chain(
+                model=openai_model, verbose=verbose, request_timeout=request_timeout)
+            interpretations = _cached_batch(
+                cache, card_hashes, 'post_qna_interpretation', qna_config,
+                lambda missing: [output["image_interpretation"].strip() for output in _apply(final_interp_chain, [
+                    {'captions': captions[idx]["captions"], 'ai_models': ", ".join(captions[idx]["models"]),
+                     'qna_session': qna_sessions[idx]}
+                    for idx in missing])])
+            for idx, image_idx in enumerate(shortlist):
+                shortlist_results[image_idx].update({
+                    'pre_qna_interpretation': "",  # image_interpretation
+                    'qna_session': qna_sessions[idx].strip(),
+                    'interpretation': interpretations[idx].strip(),
                 })
-            else:
-                results[image_idx].update({
-                    'pre_qna_interpretation': image_interpretation.strip(),
+        else:
+            for image_idx in shortlist:
+                shortlist_results[image_idx].update({
+                    'pre_qna_interpretation': shortlist_results[image_idx]['interpretation'],
                     'qna_session': "",
                 })
-        else:
+    else:
+        for image_idx in shortlist:
             generated_desc = generated_descriptions[image_idx]
-            results[image_idx].update({
+            shortlist_results[image_idx].update({
                 'captions': generated_desc['captions']['captions'].strip(),
                 'qna_session': generated_desc['qna_session'].strip(),
                 'interpretation': generated_desc['interpretation'].strip(),
                 'pre_qna_interpretation': generated_desc['pre_qna_interpretation'].strip(),
             })
 
-        # How this image can be related to the cue?
-        clue_relation_llm = OpenAI(model_name=openai_model, max_tokens=512)
-        clue_relation_prompt = PromptTemplate(
-            input_variables=["interpretation", "clue"],
-            template=(
-                "Given an image with the following description:"
-                "\n"
-                "{interpretation}"
-                "\n"
-                'Explain how this image is associated with phrase "{clue}"? '
-                "Any movie, book, or historical facts you can think of?"))
-        clue_relation_chain = LLMChain(
-            llm=clue_relation_llm, prompt=clue_relation_prompt,
-            output_key="association", verbose=verbose)
-        clue_relation = clue_relation_chain.predict(
-            interpretation=results[image_idx]['interpretation'],
-            clue=clue)
-        results[image_idx].update({
-            "clue_relation": clue_relation.strip(),
-        })
+    # How this image can be related to the cue?
+    clue_relation_chain = get_clue_relation_chain(
+        model=openai_model, verbose=verbose, request_timeout=request_timeout)
+    clue_relations = _apply(clue_relation_chain, [
+        {'interpretation': shortlist_results[image_idx]['interpretation'], 'clue': clue}
+        for image_idx in shortlist])
+    for image_idx, output in zip(shortlist, clue_relations):
+        shortlist_results[image_idx]['clue_relation'] = output["association"].strip()
+    _report(progress, f"related {len(shortlist)} cards to the clue")
+
+    results = [
+        _skipped_card_result(similarities[image_idx]) if similarities is not None else dict()
+        for image_idx in range(len(images))
+    ]
+    for image_idx, result in shortlist_results.items():
+        results[image_idx].update(result)
 
     # Final step to decide which image suits the clue the best
+    _report(progress, "choosing the final answer")
     prompt = (
         "Given the following image descriptions, explanations how those images "
         'can be associated with the phrase "{clue}", ')
 
     prompt += "all in the YAML format:\n\n"
-    for image_idx in range(len(results)):
+    for image_idx in shortlist:
         prompt += f"- Image_{image_idx}:\n"
         prompt += f"    description: {results[image_idx]['interpretation']}\n"
         prompt += f"    explanation: {results[image_idx]['clue_relation']}\n"
@@ -353,7 +706,7 @@ def guess_image_by_clue(images,
         'is best described by the phrase "{clue}"? Explain your choice. '
         "Give your final answer as the image name.")
 
-    final_llm = OpenAI(model_name=openai_model, max_tokens=512)
+    final_llm, _ = _streaming_llm(openai_model, stream, "Answer", max_tokens=512, request_timeout=request_timeout)
     final_prompt = PromptTemplate(input_variables=["clue"], template=prompt)
     final_prompt_chain = LLMChain(
         llm=final_llm, prompt=final_prompt,
@@ -363,4 +716,6 @@ def guess_image_by_clue(images,
     return {
         'per_image_reasoning': results,
         'final_answer': final_answer,
+        'similarities': similarities,
+        'shortlist': shortlist,
     }
\ No newline at end of file
@@ -0,0 +1,160 @@
+import hashlib
+import logging
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+import tracing
+
+# Columns of the results tables, in the order put() writes them
+RESULT_COLUMNS = {
+    'generated_clues': (
+        'image_hash', 'captions', 'interpretation', 'association', 'clue', 'score', 'qna_session', 'pre_qna_interpretation'),
+    'guesses': (
+        'grid_hash', 'guessed_image', 'true_image', 'final_answer', 'score', 'clue', 'clue_relations', 'shortlist'),
+    'guesses_from_hand': (
+        'grid_hash', 'guessed_image', 'final_answer', 'score', 'clue', 'clue_relations'),
+}
+
+
+def grid_hash(grid_bytes):
+    return None if grid_bytes is None else hashlib.sha256(grid_bytes).hexdigest()
+
+
+class ResultsStore:
+    """Rated clues and guesses in dixit_results.db. Writes are queued and committed by a single
+    writer thread, which puts everything queued since its last commit into one transaction, so
+    the handlers waiting for their rows share one commit. Grids are stored once per content hash in image_grids."""
+
+    def __init__(self, path="dixit_results.db", schema_path="schema.sql", max_batch=256):
+        self.path = path
+        self.max_batch = max_batch
+        with open(schema_path) as f:
+            self.schema = f.read()
+        self.queue = queue.Queue()
+        con = self._connect()
+        self._migrate(con)
+        con.executescript(self.schema)
+        con.close()
+        # Readers get their own connection, with WAL they don't block the writer
+        self.read_lock = threading.Lock()
+        self.read_con = self._connect()
+        self.thread = threading.Thread(target=self._writer, name="dixit-results-writer", daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, check_same_thread=False)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.create_function("sha256", 1, grid_hash, deterministic=True)
+        return con
+
+    def _migrate(self, con):
+        # Databases written before the grids table kept the JPEG of the grid in every guess row
+        columns = [row[1] for row in con.execute("PRAGMA table_info(guesses)")]
+        if 'image_grid' not in columns:
+            return
+        if 'shortlist' not in columns:
+            con.execute("ALTER TABLE guesses ADD COLUMN shortlist TEXT")
+        logging.log(logging.INFO, f"Moving the grids of {self.path} into the image_grids table.")
+        script = "BEGIN;\nALTER TABLE guesses RENAME TO guesses_old;\nALTER TABLE guesses_from_hand RENAME TO guesses_from_hand_old;\n"
+        script += self.schema + ";\n"
+        for table in ('guesses', 'guesses_from_hand'):
+            columns = ", ".join(RESULT_COLUMNS[table][1:])
+            script += (
+                f"INSERT OR IGNORE INTO image_grids SELECT sha256(image_grid), image_grid FROM {table}_old WHERE image_grid IS NOT NULL;\n"
+                f"INSERT INTO {table}(grid_hash, {columns}) SELECT sha256(image_grid), {columns} FROM {table}_old;\n"
+                f"DROP TABLE {table}_old;\n")
+        try:
+            con.executescript(script + "COMMIT;")
+        except sqlite3.Error:
+            con.execute("ROLLBACK")
+            raise
+        # Give the space of the dropped blobs back to the file system
+        con.execute("VACUUM")
+
+    def put(self, table, row, grid_bytes=None):
+        """Queues a result row. grid_bytes, the JPEG of the grid the row refers to, is stored under
+        its hash, which the row gets as grid_hash. The returned future is done once committed."""
+        columns = RESULT_COLUMNS[table]
+        row = dict(row)
+        if 'grid_hash' in columns:
+            row['grid_hash'] = grid_hash(grid_bytes)
+        values = tuple(row.get(column) for column in columns)
+        future = Future()
+        # The write is traced as a step of the request that queued the row
+        self.queue.put((table, values, grid_bytes, future, tracing.current_span()))
+        return future
+
+    def _writer(self):
+        con = self._connect()
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            batch = [item for item in batch if item is not None]
+            self._write_batch(con, batch)
+            for _ in range(len(batch) + stop):
+                self.queue.task_done()
+            if stop:
+                con.close()
+                return
+
+    def _write_batch(self, con, batch):
+        # A batch holds the rows of several requests, each of them gets a span for the commit
+        parents = list(dict.fromkeys(item[4] for item in batch))
+        write_spans = [
+            tracing.start_span(
+                "db_write/results", parent=parent, size=sum(item[4] is parent for item in batch), batch_size=len(batch))
+            for parent in parents
+        ]
+        try:
+            self._insert_batch(con, batch)
+        finally:
+            for write_span in write_spans:
+                tracing.end_span(write_span)
+
+    def _insert_batch(self, con, batch):
+        results = []
+        try:
+            with con:
+                for table, values, grid_bytes, future, _ in batch:
+                    # A failing row (e.g. a clue for an image that is already rated) only loses itself,
+                    # sqlite rolls back the statement and not the transaction
+                    try:
+                        if grid_bytes is not None:
+                            con.execute("INSERT OR IGNORE INTO image_grids VALUES(?, ?)", (values[0], grid_bytes))
+                        placeholders = ", ".join("?" for _ in values)
+                        con.execute(f"INSERT INTO {table}({', '.join(RESULT_COLUMNS[table])}) VALUES({placeholders})", values)
+                        results.append((future, None))
+                    except sqlite3.Error as e:
+                        logging.log(logging.ERROR, f"Dropped a row of {table}: {e!r}")
+                        results.append((future, e))
+        except sqlite3.Error as e:
+            logging.log(logging.ERROR, f"Failed to commit {len(batch)} results: {e!r}")
+            results = [(future, e) for _, _, _, future, _ in batch]
+        for future, error in results:
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def query(self, sql, params=()):
+        # Reads what is committed, rows still queued for the writer are not there yet
+        with self.read_lock:
+            return self.read_con.execute(sql, params).fetchall()
+
+    def flush(self):
+        # Waits until everything queued so far is committed
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        with self.read_lock:
+            self.read_con.close()
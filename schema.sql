@@ -9,22 +9,39 @@ CREATE TABLE IF NOT EXISTS generated_clues(
     pre_qna_interpretation TEXT
 );
 
+-- JPEG of every distinct grid, guesses refer to it by the sha256 of the bytes
+CREATE TABLE IF NOT EXISTS image_grids(
+    grid_hash TEXT PRIMARY KEY,
+    image_grid BLOB
+);
 
 CREATE TABLE IF NOT EXISTS guesses(
-    image_grid BLOB, 
+    grid_hash TEXT, 
     guessed_image TEXT, 
     true_image TEXT, 
     final_answer TEXT,
     score INTEGER, 
     clue TEXT,
-    clue_relations TEXT
+    clue_relations TEXT,
+    shortlist TEXT
 );
 
 CREATE TABLE IF NOT EXISTS guesses_from_hand(
-    image_grid BLOB, 
+    grid_hash TEXT, 
     guessed_image TEXT, 
     final_answer TEXT,
     score INTEGER, 
     clue TEXT,
     clue_relations TEXT
-);
\ No newline at end of file
+);
+
+CREATE INDEX IF NOT EXISTS generated_clues_clue ON generated_clues(clue);
+CREATE INDEX IF NOT EXISTS generated_clues_score ON generated_clues(score);
+CREATE INDEX IF NOT EXISTS guesses_clue ON guesses(clue);
+CREATE INDEX IF NOT EXISTS guesses_score ON guesses(score);
+CREATE INDEX IF NOT EXISTS guesses_guessed_image ON guesses(guessed_image);
+CREATE INDEX IF NOT EXISTS guesses_grid_hash ON guesses(grid_hash);
+CREATE INDEX IF NOT EXISTS guesses_from_hand_clue ON guesses_from_hand(clue);
+CREATE INDEX IF NOT EXISTS guesses_from_hand_score ON guesses_from_hand(score);
+CREATE INDEX IF NOT EXISTS guesses_from_hand_guessed_image ON guesses_from_hand(guessed_image);
+CREATE INDEX IF NOT EXISTS guesses_from_hand_grid_hash ON guesses_from_hand(grid_hash);
@@ -0,0 +1,103 @@
+import threading
+import time
+
+
+class Session:
+    """State of one interaction in progress (detected cards, clue, results waiting for the
+    points) of one user in one chat."""
+
+    def __init__(self):
+        self.fresh_clue = False
+        self.clue = None
+        self.clue_from_hand = None
+        self.clue_dict = None
+        self.added_cards_dict = None
+        self.added_cards_image_path = None
+        self.cache_path_clue = None
+        self.cache_path_guess = None
+        self.images_clue = None
+        self.image_for_clue = None
+        self.images_guess = None
+        self.grid = None
+        self.hand_grid_bytes = None
+        self.result_dict = None
+        self.result_dict_hand = None
+        self.true_image = None
+        self.last_access = time.monotonic()
+
+
+class SessionStore:
+    """Sessions keyed by (chat_id, user_id). Sessions not used for ttl_seconds are dropped
+    together with the card images they hold."""
+
+    def __init__(self, ttl_seconds=3600):
+        self.ttl_seconds = ttl_seconds
+        self.sessions = dict()
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def get(self, chat_id, user_id):
+        now = time.monotonic()
+        with self.lock:
+            self._evict_expired(now)
+            session = self.sessions.get((chat_id, user_id))
+            if session is None:
+                session = Session()
+                self.sessions[(chat_id, user_id)] = session
+            session.last_access = now
+            return session
+
+    def _evict_expired(self, now):
+        expired = [key for key, session in self.sessions.items() if now - session.last_access > self.ttl_seconds]
+        for key in expired:
+            del self.sessions[key]
+        self.evicted += len(expired)
+
+    def pop(self, chat_id, user_id):
+        with self.lock:
+            return self.sessions.pop((chat_id, user_id), None)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class ExpiringStore:
+    """Values rebuilt on demand (the hand index and hand grid of a user), dropped when not used
+    for ttl_seconds like the sessions."""
+
+    def __init__(self, ttl_seconds=3600):
+        self.ttl_seconds = ttl_seconds
+        # key -> (value, time of the last access)
+        self.values = dict()
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            self._evict_expired(now)
+            if key not in self.values:
+                return None
+            value = self.values[key][0]
+            self.values[key] = (value, now)
+            return value
+
+    def put(self, key, value):
+        now = time.monotonic()
+        with self.lock:
+            self._evict_expired(now)
+            self.values[key] = (value, now)
+
+    def _evict_expired(self, now):
+        expired = [key for key, (_, last_access) in self.values.items() if now - last_access > self.ttl_seconds]
+        for key in expired:
+            del self.values[key]
+        self.evicted += len(expired)
+
+    def pop(self, key):
+        with self.lock:
+            value = self.values.pop(key, None)
+            return value[0] if value is not None else None
+
+    def __len__(self):
+        return len(self.values)
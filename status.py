@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+
+
+class StatusMessage:
+    """A chat message edited in place with the progress reports and the streamed LLM output of a
+    running request. Telegram rate-limits edits, so edits closer than min_interval are coalesced
+    and flush() shows the latest state."""
+
+    # Telegram messages are limited to 4096 characters
+    MAX_LENGTH = 4000
+
+    def __init__(self, bot, chat_id, header, job=None, min_interval=1.0):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.header = header
+        self.job = job
+        self.min_interval = min_interval
+        self.progress_text = ""
+        self.stream_text = ""
+        self.shown_text = header
+        self.last_edit = 0.0
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.first_output_seconds = None
+        self.message = bot.send_message(chat_id, header)
+        if job is not None:
+            job.on_progress = self.show_progress
+
+    def progress(self, text):
+        # Progress reports of a job are its cancellation points
+        if self.job is not None:
+            self.job.progress(text)
+        else:
+            self.show_progress(text)
+
+    def show_progress(self, text):
+        self.progress_text = text
+        self.edit()
+
+    def stream(self, text):
+        if self.job is not None:
+            self.job.check_cancelled()
+        if self.first_output_seconds is None:
+            self.first_output_seconds = time.perf_counter() - self.start
+        self.stream_text = text
+        self.edit()
+
+    def render(self):
+        text = self.header
+        if self.progress_text != "":
+            text += "\n" + self.progress_text
+        if self.stream_text != "":
+            text += "\n\n" + self.stream_text
+        # Keep the beginning and the newest part of long streamed answers
+        if len(text) > self.MAX_LENGTH:
+            text = text[:self.MAX_LENGTH // 4] + "\n...\n" + text[-(self.MAX_LENGTH * 3 // 4):]
+        return text
+
+    def edit(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.last_edit < self.min_interval:
+                return
+            text = self.render()
+            if text == self.shown_text:
+                return
+            self.last_edit = now
+            self.shown_text = text
+        try:
+            self.bot.edit_message_text(text, self.chat_id, self.message.message_id)
+        except Exception as e:
+            logging.log(logging.WARNING, f"Couldn't update the status message: {e}")
+
+    def flush(self):
+        self.edit(force=True)
+
+    def timing_text(self):
+        if self.first_output_seconds is None:
+            return ""
+        return f" (first output after {self.first_output_seconds:0.1f} seconds)"
@@ -0,0 +1,11 @@
+import sys
+import types
+
+try:
+    import lavis.models  # noqa: F401
+except ImportError:
+    # captioning imports lavis to load BLIP-2, which no test does, so the tests run without it
+    lavis = types.ModuleType("lavis")
+    lavis.models = types.ModuleType("lavis.models")
+    lavis.models.load_model_and_preprocess = None
+    sys.modules.update({'lavis': lavis, 'lavis.models': lavis.models})
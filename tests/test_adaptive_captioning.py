@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import captioning
+from captioning import CAPTIONER_COSTS, CAPTIONERS, FULL_COST, AdaptiveCaptioning, generate_captions
+
+
+class Card:
+    # Stands in for the PIL image of a card
+    def __init__(self, name):
+        self.name = name
+
+
+def cards(*names):
+    return [Card(name) for name in names]
+
+
+class StubCaptioner:
+    # Captions a card by looking up its name
+    def __init__(self, attr, captions, calls):
+        self.attr = attr
+        self.captions = captions
+        self.calls = calls
+
+    def __call__(self, images, max_batch_size=None, **kwargs):
+        names = [image.name for image in images]
+        self.calls.append((self.attr, names, kwargs))
+        return [self.captions.get((self.attr, name), f"{self.attr} caption of {name}") for name in names]
+
+
+class StubModels:
+    def __init__(self, captions=None, adaptive=None):
+        self.adaptive = adaptive
+        self.calls = []
+        for attr, _ in CAPTIONERS:
+            setattr(self, attr, StubCaptioner(attr, captions or dict(), self.calls))
+
+    def ran(self, attr):
+        return [(images, kwargs) for called, images, kwargs in self.calls if called == attr]
+
+
+def stub_embed_texts(texts):
+    # The same text gets the same unit vector, different texts are orthogonal
+    vocabulary = {text: idx for idx, text in enumerate(dict.fromkeys(texts))}
+    embeddings = np.zeros((len(texts), len(vocabulary)), dtype=np.float32)
+    for row, text in enumerate(texts):
+        embeddings[row, vocabulary[text]] = 1.0
+    return embeddings
+
+
+def agreeing(*cards):
+    # The cheap models give the same caption for these cards
+    return {(attr, card): "a lonely tree on a hill" for card in cards for attr in captioning.CHEAP_CAPTIONERS}
+
+
+def test_full_cost_covers_every_model():
+    assert FULL_COST == 14
+    assert set(CAPTIONER_COSTS) == {attr for attr, _ in CAPTIONERS}
+
+
+def test_agreement_scores():
+    adaptive = AdaptiveCaptioning(stub_embed_texts)
+    scores = adaptive.agreement_scores([["a", "a"], ["a", "b"], ["a", "a", "b"], ["a"]])
+    # Mean similarity over the pairs of different captions of a card
+    assert scores == pytest.approx([1.0, 0.0, 1 / 3, 0.0])
+
+
+def test_without_adaptive_captioning_every_model_runs():
+    models = StubModels()
+    results = generate_captions(cards("card0", "card1"), models)
+    assert [attr for attr, _, _ in models.calls] == [attr for attr, _ in CAPTIONERS]
+    assert results[0]['models'] == [name for _, name in CAPTIONERS]
+    assert results[0]['captions'].splitlines()[0] == "Git-Large: git_large caption of card0"
+    assert (results[0]['skipped'], results[0]['reduced']) == ([], [])
+
+
+def test_disagreement_runs_every_model_within_the_budget():
+    models = StubModels(adaptive=AdaptiveCaptioning(stub_embed_texts, budget=FULL_COST))
+    result = generate_captions(Card("card0"), models)
+    assert sorted(result['models']) == sorted(name for _, name in CAPTIONERS)
+    assert (result['skipped'], result['reduced']) == ([], [])
+    # Cheap models first, then by cost
+    assert [attr for attr, _, _ in models.calls] == ['vit_gpt2', 'blip_base', 'git_large', 'blip_large', 'blip2']
+    assert all(kwargs == dict() for _, _, kwargs in models.calls)
+
+
+def test_budget_leaves_out_the_models_that_dont_fit():
+    # 2 for the cheap models, 2 + 2 for the mid-size ones, BLIP-2 at 8 doesn't fit
+    models = StubModels(adaptive=AdaptiveCaptioning(stub_embed_texts, budget=10))
+    result = generate_captions(cards("card0"), models)[0]
+    assert result['skipped'] == ['BLIP-2']
+    assert result['models'] == ['Git-Large', 'BLIP-LARGE', 'BLIP-BASE', 'VIT-GPT2']
+    assert models.ran('blip2') == []
+
+    models = StubModels(adaptive=AdaptiveCaptioning(stub_embed_texts, budget=3))
+    result = generate_captions(cards("card0"), models)[0]
+    assert result['models'] == ['BLIP-BASE', 'VIT-GPT2']
+    assert result['skipped'] == ['Git-Large', 'BLIP-LARGE', 'BLIP-2']
+
+
+def test_consensus_skips_mid_size_models_and_reduces_blip2():
+    models = StubModels(captions=agreeing("card1"), adaptive=AdaptiveCaptioning(stub_embed_texts, budget=FULL_COST))
+    results = generate_captions(cards("card0", "card1", "card2"), models)
+
+    assert results[1]['skipped'] == ['Git-Large', 'BLIP-LARGE']
+    assert results[1]['reduced'] == ['BLIP-2']
+    assert results[1]['models'] == ['BLIP-BASE', 'VIT-GPT2', 'BLIP-2']
+    for result in (results[0], results[2]):
+        assert (result['skipped'], result['reduced']) == ([], [])
+
+    # The cards that disagree share the full batches, the agreed card gets its own greedy BLIP-2 batch
+    assert [images for images, _ in models.ran('git_large')] == [["card0", "card2"]]
+    blip2_calls = models.ran('blip2')
+    assert blip2_calls[0] == (["card0", "card2"], dict())
+    assert blip2_calls[1] == (["card1"], captioning.REDUCED_CAPTIONERS['blip2'][1])
+    assert all(images == ["card0", "card1", "card2"] for images, _ in models.ran('vit_gpt2'))
+
+
+def test_consensus_within_a_small_budget_skips_blip2():
+    # The cheap models cost 2, the reduced BLIP-2 run 3 more
+    models = StubModels(captions=agreeing("card0"), adaptive=AdaptiveCaptioning(stub_embed_texts, budget=4))
+    result = generate_captions(Card("card0"), models)
+    assert result['skipped'] == ['Git-Large', 'BLIP-LARGE', 'BLIP-2']
+    assert result['reduced'] == []
+
+    models = StubModels(captions=agreeing("card0"), adaptive=AdaptiveCaptioning(stub_embed_texts, budget=5))
+    assert generate_captions(Card("card0"), models)['reduced'] == ['BLIP-2']
+
+
+def test_agreement_threshold():
+    captions = {('vit_gpt2', "card0"): "a tree", ('blip_base', "card0"): "a tree on a hill"}
+    # Different captions embed orthogonally here, so only a threshold of 0 counts them as agreeing
+    models = StubModels(captions=captions, adaptive=AdaptiveCaptioning(stub_embed_texts, agreement=0.0))
+    assert generate_captions(Card("card0"), models)['reduced'] == ['BLIP-2']
+    models = StubModels(captions=captions, adaptive=AdaptiveCaptioning(stub_embed_texts, agreement=0.5))
+    assert generate_captions(Card("card0"), models)['reduced'] == []
+
+
+def test_adaptive_config():
+    assert AdaptiveCaptioning(stub_embed_texts, budget=8, agreement=0.8).config == {
+        'mode': 'adaptive', 'budget': 8, 'agreement': 0.8}
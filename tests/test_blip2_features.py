@@ -0,0 +1,156 @@
+import contextlib
+import types
+
+import pytest
+from PIL import Image
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import captioning
+from captioning import BLIP2Wrapper
+
+
+class FakeTokenizer:
+    # A prompt is one token, its index in the list of prompts seen so far
+    def __init__(self):
+        self.vocabulary = []
+
+    def __call__(self, prompts, padding=None, return_tensors=None):
+        for prompt in prompts:
+            if prompt not in self.vocabulary:
+                self.vocabulary.append(prompt)
+        input_ids = torch.tensor([[self.vocabulary.index(prompt)] for prompt in prompts])
+        tokens = types.SimpleNamespace(input_ids=input_ids, attention_mask=torch.ones_like(input_ids))
+        tokens.to = lambda device: tokens
+        return tokens
+
+    def batch_decode(self, outputs, skip_special_tokens=False):
+        return [f"{self.vocabulary[prompt]} card {red}" for red, prompt in outputs.tolist()]
+
+
+class FakeBlip2T5:
+    """Has the attributes of lavis Blip2T5 that BLIP2Wrapper reads. The query output of an image is
+    the red value of its pixels, generate() answers with that value and the prompt."""
+
+    prompt = "a photo of"
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.query_tokens = torch.zeros(1, 1, 1)
+        self.ln_vision = lambda embeds: embeds
+        self.Qformer = types.SimpleNamespace(bert=self.qformer)
+        self.t5_proj = lambda hidden: hidden
+        self.t5_tokenizer = FakeTokenizer()
+        self.t5_model = types.SimpleNamespace(
+            encoder=types.SimpleNamespace(embed_tokens=lambda input_ids: input_ids.float().unsqueeze(-1)),
+            generate=self.generate)
+
+    def maybe_autocast(self, dtype=None):
+        return contextlib.nullcontext()
+
+    def visual_encoder(self, image_ts):
+        self.calls.append(('vision', image_ts[:, 0].int().tolist()))
+        return image_ts.unsqueeze(1)
+
+    def qformer(self, query_embeds, encoder_hidden_states, encoder_attention_mask, return_dict):
+        assert query_embeds.shape[0] == encoder_hidden_states.shape[0]
+        return types.SimpleNamespace(last_hidden_state=encoder_hidden_states)
+
+    def generate(self, inputs_embeds, attention_mask, num_beams, **kwargs):
+        self.calls.append(('decode', len(inputs_embeds), num_beams))
+        # Query output then the prompt token
+        assert inputs_embeds.shape[1:] == attention_mask.shape[1:] + (1,) == (2, 1)
+        return inputs_embeds[:, :, 0].long()
+
+
+def eval_processor(image):
+    # lavis processors take one image at a time
+    return torch.tensor([float(image.getpixel((0, 0))[0])])
+
+
+def card(red):
+    return Image.new('RGB', (4, 4), (red, 0, 0))
+
+
+@pytest.fixture
+def make_wrapper(monkeypatch):
+    calls = []
+    monkeypatch.setattr(captioning, 'lavis_version', lambda: captioning.BLIP2_T5_LAVIS_VERSIONS[-1])
+    monkeypatch.setattr(captioning, 'load_model_and_preprocess', lambda **kwargs: (
+        FakeBlip2T5(calls), {'eval': eval_processor}, None))
+
+    def make_wrapper(**kwargs):
+        return BLIP2Wrapper(name='blip2_t5', model_type='pretrain_flant5xl', **kwargs), calls
+    return make_wrapper
+
+
+def ran(calls, step):
+    return [call[1:] for call in calls if call[0] == step]
+
+
+def test_features_are_encoded_once_per_image(make_wrapper):
+    blip2, calls = make_wrapper(max_batch_size=2)
+    features = blip2.image_features([card(1), card(2), card(1), card(3)])
+    assert [float(feature.sum()) for feature in features] == [1.0, 2.0, 1.0, 3.0]
+    # Same pixels are encoded once, the missing images go through the vision tower in batches
+    assert ran(calls, 'vision') == [([1, 2],), ([3],)]
+
+    calls.clear()
+    blip2.image_features([card(3), card(2)])
+    assert ran(calls, 'vision') == []
+    blip2.image_features([card(4), card(1)])
+    assert ran(calls, 'vision') == [([4],)]
+
+
+def test_least_recently_used_features_are_evicted(make_wrapper):
+    blip2, calls = make_wrapper(feature_cache_size=2)
+    blip2.image_features([card(1), card(2)])
+    # Reading 1 makes 2 the least recently used entry
+    blip2.image_features([card(1)])
+    blip2.image_features([card(3)])
+    assert len(blip2.features) == 2
+    calls.clear()
+    blip2.image_features([card(1), card(3)])
+    assert ran(calls, 'vision') == []
+    blip2.image_features([card(2)])
+    assert ran(calls, 'vision') == [([2],)]
+
+
+def test_an_image_object_is_hashed_once_per_call(make_wrapper, monkeypatch):
+    blip2, calls = make_wrapper()
+    hashed = []
+
+    def image_content_hash(image):
+        hashed.append(image)
+        return str(image.getpixel((0, 0)))
+
+    monkeypatch.setattr(captioning, 'image_content_hash', image_content_hash)
+    image = card(5)
+    blip2.image_features([image, image, card(5)])
+    assert len(hashed) == 2
+    assert ran(calls, 'vision') == [([5],)]
+
+
+def test_questions_are_answered_in_batches(make_wrapper):
+    blip2, calls = make_wrapper(max_batch_size=2)
+    images = [card(1), card(2), card(3)]
+    answers = blip2(images, question=["what is it", "who is there", "where is it"], num_beams=1)
+    assert answers == [
+        "Question: what is it? Answer: card 1",
+        "Question: who is there? Answer: card 2",
+        "Question: where is it? Answer: card 3"]
+    assert ran(calls, 'decode') == [(2, 1), (1, 1)]
+
+    # Captions and questions about the same cards reuse their features, only T5 runs again
+    calls.clear()
+    assert blip2(images) == ["a photo of card 1", "a photo of card 2", "a photo of card 3"]
+    assert blip2(card(2), question="what is it") == "Question: what is it? Answer: card 2"
+    assert ran(calls, 'vision') == []
+    assert ran(calls, 'decode') == [(2, 4), (1, 4), (1, 4)]
+
+
+def test_other_lavis_releases_are_refused(make_wrapper, monkeypatch):
+    monkeypatch.setattr(captioning, 'lavis_version', lambda: "1.1.0")
+    with pytest.raises(RuntimeError, match="found 1.1.0"):
+        make_wrapper()
@@ -0,0 +1,239 @@
+import json
+import threading
+
+import pytest
+from PIL import Image
+
+pytest.importorskip("langchain")
+
+import cache
+from cache import CardCache, CompletionCache, config_key, image_content_hash
+from langchain.schema import Generation
+from prompts import captioning_config
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        self.now += 1.0
+        return self.now
+
+
+class StubModels:
+    def __init__(self, model_names, adaptive=None, precision=None, backend=None):
+        self.model_names = model_names
+        self.adaptive = adaptive
+        self.precision = precision or dict()
+        self.backend = backend or dict()
+
+
+class StubAdaptive:
+    def __init__(self, config):
+        self.config = config
+
+
+def make_card_cache(tmp_path, monkeypatch, **kwargs):
+    # Every access is one second after the previous one, so the LRU order is exact
+    monkeypatch.setattr(cache.time, 'time', FakeClock())
+    return CardCache(str(tmp_path / "card_cache.db"), **kwargs)
+
+
+def entry_size(value):
+    return len(json.dumps(value))
+
+
+def test_card_cache_round_trip(tmp_path, monkeypatch):
+    card_cache = make_card_cache(tmp_path, monkeypatch)
+    value = {'captions': "BLIP-BASE: a tree", 'models': ['BLIP-BASE']}
+    config = {'models': ['BLIP-BASE']}
+    assert card_cache.get('abc', 'captions', config) is None
+    card_cache.put('abc', 'captions', config, value)
+    assert card_cache.get('abc', 'captions', config) == value
+    # Stages of the same card are separate entries
+    assert card_cache.get('abc', 'interpretation', config) is None
+
+    # The entries outlive the connection
+    reopened = CardCache(str(tmp_path / "card_cache.db"))
+    assert reopened.get('abc', 'captions', config) == value
+    assert reopened.stats()['bytes'] == entry_size(value)
+
+
+def test_card_cache_counts_hits_and_misses_per_stage(tmp_path, monkeypatch):
+    card_cache = make_card_cache(tmp_path, monkeypatch)
+    card_cache.put('abc', 'captions', {}, "captions")
+    card_cache.get('abc', 'captions', {})
+    card_cache.get('abc', 'captions', {})
+    card_cache.get('def', 'captions', {})
+    card_cache.get('abc', 'clue', {})
+    stats = card_cache.stats()
+    assert stats['entries'] == 1
+    assert stats['stages'] == {'captions': {'hits': 2, 'misses': 1}, 'clue': {'hits': 0, 'misses': 1}}
+
+
+def test_card_cache_evicts_least_recently_used_entries(tmp_path, monkeypatch):
+    value = "x" * 100
+    card_cache = make_card_cache(tmp_path, monkeypatch, max_bytes=3 * entry_size(value))
+    for image_hash in 'abc':
+        card_cache.put(image_hash, 'captions', {}, value)
+    # Reading a makes b the least recently used entry
+    assert card_cache.get('a', 'captions', {}) == value
+    card_cache.put('d', 'captions', {}, value)
+    assert card_cache.get('b', 'captions', {}) is None
+    assert [card_cache.get(image_hash, 'captions', {}) for image_hash in 'acd'] == [value] * 3
+    assert card_cache.stats()['bytes'] == 3 * entry_size(value)
+
+    # Replacing an entry only charges the difference in size
+    card_cache.put('a', 'captions', {}, "y")
+    assert card_cache.stats()['bytes'] == 2 * entry_size(value) + entry_size("y")
+    assert card_cache.stats()['entries'] == 3
+
+    # An entry larger than the budget doesn't stay
+    card_cache.put('e', 'captions', {}, "z" * 1000)
+    assert card_cache.stats()['entries'] == 0
+    assert card_cache.stats()['bytes'] == 0
+
+
+def test_card_cache_key_changes_with_the_captioner_config(tmp_path, monkeypatch):
+    card_cache = make_card_cache(tmp_path, monkeypatch)
+    models = StubModels(['BLIP-BASE', 'GIT-LARGE'])
+    card_cache.put('abc', 'captions', captioning_config(models), "two models")
+    assert card_cache.get('abc', 'captions', captioning_config(StubModels(['BLIP-BASE', 'GIT-LARGE']))) == "two models"
+
+    # Another set of captioners or adaptive captioning settings need their own captions
+    assert card_cache.get('abc', 'captions', captioning_config(StubModels(['BLIP-BASE']))) is None
+    adaptive = StubModels(['BLIP-BASE', 'GIT-LARGE'], adaptive=StubAdaptive({'agreement': 0.85}))
+    assert card_cache.get('abc', 'captions', captioning_config(adaptive)) is None
+    card_cache.put('abc', 'captions', captioning_config(adaptive), "adaptive")
+    other_threshold = StubModels(['BLIP-BASE', 'GIT-LARGE'], adaptive=StubAdaptive({'agreement': 0.9}))
+    assert card_cache.get('abc', 'captions', captioning_config(other_threshold)) is None
+    assert card_cache.get('abc', 'captions', captioning_config(adaptive)) == "adaptive"
+
+
+def test_card_cache_key_changes_with_precision_and_backend(tmp_path, monkeypatch):
+    card_cache = make_card_cache(tmp_path, monkeypatch)
+    names = ['BLIP-BASE', 'GIT-LARGE']
+    card_cache.put('abc', 'captions', captioning_config(StubModels(names)), "fp32 on torch")
+
+    int8 = StubModels(names, precision={'git_large': 'int8'})
+    onnx = StubModels(names, backend={'git_large': 'onnx'})
+    assert card_cache.get('abc', 'captions', captioning_config(int8)) is None
+    assert card_cache.get('abc', 'captions', captioning_config(onnx)) is None
+    card_cache.put('abc', 'captions', captioning_config(int8), "int8")
+    assert card_cache.get('abc', 'captions', captioning_config(StubModels(names, precision={'git_large': 'bf16'}))) is None
+    assert card_cache.get('abc', 'captions', captioning_config(int8)) == "int8"
+    assert card_cache.get('abc', 'captions', captioning_config(StubModels(names))) == "fp32 on torch"
+
+    # Spelling out the defaults keeps the key of the entries written without them
+    defaults = StubModels(names, precision={'git_large': 'fp32'}, backend={'git_large': 'torch'})
+    assert captioning_config(defaults) == captioning_config(StubModels(names)) == {'models': names}
+
+
+def test_config_key_ignores_dict_order():
+    assert config_key({'models': ['a'], 'openai_model': 'm'}) == config_key({'openai_model': 'm', 'models': ['a']})
+    assert config_key({'models': ['a', 'b']}) != config_key({'models': ['b', 'a']})
+
+
+def test_image_content_hash_depends_on_pixels_only(tmp_path):
+    image = Image.new('RGB', (4, 4), (10, 20, 30))
+    image.save(tmp_path / "card.png")
+    assert image_content_hash(Image.open(tmp_path / "card.png")) == image_content_hash(image)
+    assert image_content_hash(Image.new('RGB', (4, 4), (10, 20, 31))) != image_content_hash(image)
+    assert image_content_hash(Image.new('RGB', (2, 8), (10, 20, 30))) != image_content_hash(image)
+
+
+class SettableClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_completion_cache(tmp_path, monkeypatch, **kwargs):
+    clock = SettableClock()
+    monkeypatch.setattr(cache.time, 'time', clock)
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    return CompletionCache(str(tmp_path / "completion_cache.db"), **kwargs), clock
+
+
+def complete(completion_cache, clock, prompt, text=None, seconds=2.0, llm_string="gpt-3.5-turbo-instruct"):
+    # What LangChain does around an API call: look up, call the API on a miss, store the result
+    generations = completion_cache.lookup(prompt, llm_string)
+    if generations is None:
+        clock.now += seconds
+        generations = [Generation(text=text or f"completion of {prompt}")]
+        completion_cache.update(prompt, llm_string, generations)
+    return generations
+
+
+def test_completion_cache_hit_saves_the_api_latency(tmp_path, monkeypatch):
+    completion_cache, clock = make_completion_cache(tmp_path, monkeypatch)
+    assert complete(completion_cache, clock, "a prompt", seconds=3.0)[0].text == "completion of a prompt"
+    assert complete(completion_cache, clock, "a prompt", text="not called")[0].text == "completion of a prompt"
+    # The same prompt for another model is another completion
+    assert completion_cache.lookup("a prompt", "gpt-4") is None
+    assert completion_cache.stats() == {'entries': 1, 'hits': 1, 'misses': 2, 'saved_seconds': 3.0}
+
+
+def test_completion_cache_entries_expire(tmp_path, monkeypatch):
+    completion_cache, clock = make_completion_cache(tmp_path, monkeypatch, ttl_seconds=100)
+    complete(completion_cache, clock, "old")
+    clock.now += 60
+    complete(completion_cache, clock, "new")
+    clock.now += 50
+    assert completion_cache.lookup("old", "gpt-3.5-turbo-instruct") is None
+    assert completion_cache.lookup("new", "gpt-3.5-turbo-instruct") is not None
+    # Storing a completion also drops the expired ones that were never looked up again
+    clock.now += 100
+    complete(completion_cache, clock, "newest")
+    assert completion_cache.stats()['entries'] == 1
+
+
+def test_completion_cache_keeps_the_most_recently_used_entries(tmp_path, monkeypatch):
+    completion_cache, clock = make_completion_cache(tmp_path, monkeypatch, max_entries=2)
+    complete(completion_cache, clock, "a")
+    complete(completion_cache, clock, "b")
+    clock.now += 1
+    # Using a makes b the least recently used entry
+    complete(completion_cache, clock, "a")
+    complete(completion_cache, clock, "c")
+    assert completion_cache.stats()['entries'] == 2
+    assert completion_cache.lookup("b", "gpt-3.5-turbo-instruct") is None
+    assert completion_cache.lookup("a", "gpt-3.5-turbo-instruct") is not None
+    assert completion_cache.lookup("c", "gpt-3.5-turbo-instruct") is not None
+
+
+def test_completion_cache_bypass(tmp_path, monkeypatch):
+    completion_cache, clock = make_completion_cache(tmp_path, monkeypatch)
+    complete(completion_cache, clock, "a prompt", text="cached")
+    with completion_cache.bypass():
+        assert complete(completion_cache, clock, "a prompt", text="fresh")[0].text == "fresh"
+        with completion_cache.bypass():
+            pass
+        # Leaving a nested block keeps the outer one bypassing
+        assert complete(completion_cache, clock, "another prompt", text="fresh")[0].text == "fresh"
+    assert complete(completion_cache, clock, "a prompt")[0].text == "cached"
+    assert completion_cache.lookup("another prompt", "gpt-3.5-turbo-instruct") is None
+    assert completion_cache.stats()['hits'] == 1
+
+
+def test_completion_cache_drops_failed_requests(tmp_path, monkeypatch):
+    completion_cache, clock = make_completion_cache(tmp_path, monkeypatch)
+    # The API call of every miss fails, update() is never called
+    for idx in range(5):
+        assert completion_cache.lookup(f"prompt {idx}", "gpt-3.5-turbo-instruct") is None
+    assert len(completion_cache._pending()) == 5
+    clock.now += completion_cache.pending_timeout_seconds + 1
+    complete(completion_cache, clock, "a prompt")
+    assert completion_cache._pending() == dict()
+
+
+def test_completion_cache_pending_requests_are_per_thread(tmp_path, monkeypatch):
+    completion_cache, clock = make_completion_cache(tmp_path, monkeypatch)
+    completion_cache.lookup("a prompt", "gpt-3.5-turbo-instruct")
+    other = threading.Thread(target=complete, args=(completion_cache, clock, "another prompt"))
+    other.start()
+    other.join(5)
+    assert list(completion_cache._pending()) == [completion_cache._key("a prompt", "gpt-3.5-turbo-instruct")]
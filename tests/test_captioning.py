@@ -0,0 +1,78 @@
+import pytest
+from PIL import Image
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from captioning import CAPTIONERS, CaptioningModel, generate_captions
+
+
+def card(red):
+    return Image.new('RGB', (4, 4), (red, 0, 0))
+
+
+def red_processor(image):
+    # Processes one image at a time like the lavis processors, the pixel tensor is the red value
+    return torch.tensor([float(image.getpixel((0, 0))[0])])
+
+
+class FakeGenerator:
+    def __init__(self):
+        self.batches = []
+
+    def generate(self, pixel_values, max_length):
+        self.batches.append(pixel_values.int().flatten().tolist())
+        return pixel_values.long()
+
+
+class FakeTokenizer:
+    def batch_decode(self, generated_ids, skip_special_tokens=False):
+        return [f"card {red} " for red in generated_ids.flatten().tolist()]
+
+
+def fake_captioning_model(max_batch_size):
+    model = CaptioningModel.__new__(CaptioningModel)
+    model.max_batch_size = max_batch_size
+    model.dtype = torch.float32
+    model.model = {'model': FakeGenerator(), 'processor': red_processor, 'tokenizer': FakeTokenizer()}
+    return model
+
+
+def test_captioning_model_captions_in_batches_in_order():
+    model = fake_captioning_model(max_batch_size=2)
+    images = [card(red) for red in (5, 3, 9, 1, 7)]
+    assert model(images) == [f"card {red} " for red in (5, 3, 9, 1, 7)]
+    assert model.model['model'].batches == [[5, 3], [9, 1], [7]]
+
+    model.model['model'].batches.clear()
+    assert model(images, max_batch_size=4) == [f"card {red} " for red in (5, 3, 9, 1, 7)]
+    assert model.model['model'].batches == [[5, 3, 9, 1], [7]]
+    assert model(card(4)) == "card 4 "
+
+
+class StubModels:
+    # Every captioner is a fake CaptioningModel prefixing the caption with its name
+    def __init__(self):
+        self.models = dict()
+        for attr, _ in CAPTIONERS:
+            self.models[attr] = fake_captioning_model(max_batch_size=8)
+            setattr(self, attr, self.captioner(attr))
+
+    def captioner(self, attr):
+        def caption(images, max_batch_size=None):
+            return [f"{attr} {caption}" for caption in self.models[attr](images, max_batch_size=max_batch_size)]
+        return caption
+
+
+def test_generate_captions_keeps_the_order_of_the_cards():
+    models = StubModels()
+    reds = [10, 20, 30, 40, 50]
+    results = generate_captions([card(red) for red in reds], models, max_batch_size=2)
+    for red, result in zip(reds, results):
+        assert result['captions'].splitlines() == [f"{name}: {attr} card {red}" for attr, name in CAPTIONERS]
+        assert result['models'] == [name for _, name in CAPTIONERS]
+    # One batched pass over the table per model
+    for attr, _ in CAPTIONERS:
+        assert models.models[attr].model['model'].batches == [[10, 20], [30, 40], [50]]
+
+    assert generate_captions(card(60), models)['captions'].splitlines()[0] == "Git-Large: git_large card 60"
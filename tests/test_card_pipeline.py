@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from card_pipeline import StagedPipeline
+
+
+def test_results_keep_input_order():
+    def slow_square(item):
+        # Later items finish first
+        time.sleep(0.001 * (10 - item))
+        return item * item
+
+    pipeline = StagedPipeline([
+        ('square', slow_square, 4),
+        ('add', lambda item: item + 1, 3),
+    ], queue_size=2)
+    assert pipeline.run(list(range(10))) == [item * item + 1 for item in range(10)]
+    stats = pipeline.stats()
+    assert stats['square']['items'] == 10
+    assert stats['add']['items'] == 10
+    assert 0.0 <= stats['square']['utilisation'] <= 1.0
+
+
+def test_empty_input():
+    pipeline = StagedPipeline([('double', lambda item: item * 2, 2)])
+    assert pipeline.run([]) == []
+
+
+def test_batched_stage_gets_lists_up_to_batch_size():
+    batch_sizes = []
+
+    def caption(batch):
+        batch_sizes.append(len(batch))
+        # While a batch runs the next one fills up the queue
+        time.sleep(0.02)
+        return [f"caption {item}" for item in batch]
+
+    pipeline = StagedPipeline([
+        ('caption', caption, 1, 4),
+        ('clue', lambda item: item.upper(), 2),
+    ])
+    assert pipeline.run(list(range(10))) == [f"CAPTION {item}" for item in range(10)]
+    assert sum(batch_sizes) == 10
+    assert max(batch_sizes) == 4
+    assert all(size <= 4 for size in batch_sizes)
+    assert pipeline.stats()['caption']['items'] == 10
+
+
+def test_first_error_is_raised():
+    class CardError(Exception):
+        pass
+
+    error = CardError("card 3")
+
+    def fail_on_three(item):
+        if item == 3:
+            raise error
+        return item
+
+    pipeline = StagedPipeline([
+        ('first', fail_on_three, 2),
+        ('second', lambda item: item, 2),
+    ])
+    with pytest.raises(CardError) as raised:
+        pipeline.run(list(range(8)))
+    assert raised.value is error
+
+
+def test_error_in_batched_stage_is_raised():
+    def fail(batch):
+        raise ValueError(f"batch of {len(batch)}")
+
+    pipeline = StagedPipeline([('caption', fail, 1, 4)])
+    with pytest.raises(ValueError):
+        pipeline.run(list(range(6)))
+
+
+def test_error_stops_feeding_and_later_stages():
+    first_calls, second_calls = [], []
+    lock = threading.Lock()
+
+    def first(item):
+        with lock:
+            first_calls.append(item)
+        if item == 0:
+            raise RuntimeError("cancelled")
+        return item
+
+    def second(item):
+        with lock:
+            second_calls.append(item)
+        return item
+
+    pipeline = StagedPipeline([
+        ('first', first, 1),
+        ('second', second, 1),
+    ], queue_size=1)
+    with pytest.raises(RuntimeError):
+        pipeline.run(list(range(1000)))
+    # Only the items queued before the error reached the first stage, none ran after it
+    assert first_calls == [0]
+    assert second_calls == []
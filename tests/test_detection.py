@@ -0,0 +1,108 @@
+import json
+import string
+
+import numpy as np
+import pytest
+from PIL import Image
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from detection import CARD_LABELS, CardDetector
+
+IMAGE_SIZE = 32
+
+
+def tiny_processor(tmp_path):
+    # A character level CLIP tokenizer, the real vocabulary needs a download
+    vocab = ["<|startoftext|>", "<|endoftext|>", "!"] + list(string.ascii_lowercase)
+    vocab += [char + "</w>" for char in string.ascii_lowercase]
+    (tmp_path / "vocab.json").write_text(json.dumps({token: idx for idx, token in enumerate(vocab)}))
+    (tmp_path / "merges.txt").write_text("#version: 0.2\n")
+    tokenizer = transformers.CLIPTokenizer(
+        str(tmp_path / "vocab.json"), str(tmp_path / "merges.txt"), pad_token="!", model_max_length=16)
+    image_processor = transformers.OwlViTImageProcessor(
+        size={'height': IMAGE_SIZE, 'width': IMAGE_SIZE}, crop_size={'height': IMAGE_SIZE, 'width': IMAGE_SIZE})
+    return transformers.OwlViTProcessor(image_processor=image_processor, tokenizer=tokenizer)
+
+
+def tiny_owlvit():
+    config = transformers.OwlViTConfig(
+        text_config={'vocab_size': 55, 'hidden_size': 32, 'intermediate_size': 37, 'num_hidden_layers': 2,
+                     'num_attention_heads': 4, 'max_position_embeddings': 40, 'pad_token_id': 2,
+                     'bos_token_id': 0, 'eos_token_id': 1},
+        vision_config={'hidden_size': 32, 'intermediate_size': 37, 'num_hidden_layers': 2, 'num_attention_heads': 4,
+                       'image_size': IMAGE_SIZE, 'patch_size': 8},
+        projection_dim=32)
+    return transformers.OwlViTForObjectDetection(config).eval()
+
+
+def photos(count, size=(64, 48)):
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)) for _ in range(count)]
+
+
+def assert_same_predictions(predictions, expected):
+    # Batches of another size round differently
+    assert [[item['label'] for item in image] for image in predictions] == [
+        [item['label'] for item in image] for image in expected]
+    for image, expected_image in zip(predictions, expected):
+        assert [item['score'] for item in image] == pytest.approx([item['score'] for item in expected_image], abs=1e-4)
+        for item, expected_item in zip(image, expected_image):
+            assert item['box'] == pytest.approx(expected_item['box'], abs=1)
+
+
+class CountingDetector(CardDetector):
+    def __init__(self, *args, **kwargs):
+        self.encoded = []
+        super().__init__(*args, **kwargs)
+
+    def text_features(self, inputs):
+        self.encoded.append(inputs['input_ids'].shape[0])
+        return super().text_features(inputs)
+
+
+def test_queries_are_encoded_once_per_label_set(tmp_path):
+    detector = CountingDetector(tiny_owlvit(), tiny_processor(tmp_path))
+    detector(photos(1)[0], candidate_labels=CARD_LABELS)
+    detector(photos(2), candidate_labels=CARD_LABELS)
+    assert detector.encoded == [1]
+    detector(photos(1)[0], candidate_labels=["card", "table"])
+    assert detector.encoded == [1, 2]
+
+
+def test_batched_photos_match_one_at_a_time(tmp_path):
+    detector = CardDetector(tiny_owlvit(), tiny_processor(tmp_path), threshold=0.0)
+    images = photos(3)
+    batched = detector(images)
+    assert len(batched) == 3
+    assert_same_predictions(batched, [detector(image) for image in images])
+    # Boxes are in the coordinates of the full-size photo
+    assert max(prediction['box']['xmax'] for prediction in batched[0]) > IMAGE_SIZE
+
+
+def test_jpeg_photos_are_decoded_at_a_reduced_scale(tmp_path):
+    detector = CardDetector(tiny_owlvit(), tiny_processor(tmp_path))
+    photos(1, size=(256, 192))[0].save(tmp_path / "photo.jpg")
+    small = detector.downscale(Image.open(tmp_path / "photo.jpg"))
+    assert small.size == (IMAGE_SIZE, IMAGE_SIZE)
+
+
+def test_onnx_detector_matches_the_torch_detector(tmp_path, monkeypatch):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    import onnx_backend
+    monkeypatch.setattr(onnx_backend, 'ONNX_FOLDER', str(tmp_path / "onnx"))
+    processor = tiny_processor(tmp_path)
+    model = tiny_owlvit()
+    onnx_backend.export_detector("owlvit", model, processor)
+    paths = [onnx_backend.model_path("owlvit", part) for part in ("text", "detector")]
+    onnx_detector = onnx_backend.OnnxCardDetector(
+        *[onnx_backend.create_session(path) for path in paths], processor, threshold=0.0, model_files=paths)
+    detector = CardDetector(model, processor, threshold=0.0)
+
+    images = photos(3)
+    for labels in (CARD_LABELS, ["card", "table"]):
+        expected = detector(images, candidate_labels=labels)
+        assert_same_predictions(onnx_detector(images, candidate_labels=labels), expected)
+    assert set(onnx_detector.query_embeds) == {tuple(CARD_LABELS), ("card", "table")}
@@ -0,0 +1,166 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("transformers")
+
+from embedding import HandIndex, normalize, select_shortlist
+
+
+class StubEmbedder:
+    # Card i is the unit vector e_i, the clue embedding gives the similarity of every card
+    def __init__(self, similarities):
+        self.similarities = np.asarray(similarities, dtype=np.float32)
+
+    def embed_images(self, images):
+        return np.eye(len(self.similarities), dtype=np.float32)[:len(images)]
+
+    def embed_texts(self, texts):
+        return np.stack([self.similarities for _ in texts])
+
+
+def no_captioning(images, models):
+    raise AssertionError("a decided guess must not caption the cards")
+
+
+def test_shortlist_ranks_best_first():
+    assert select_shortlist([0.1, 0.4, 0.3, 0.2]) == [1, 2, 3, 0]
+    assert select_shortlist(np.array([0.1, 0.4, 0.3, 0.2], dtype=np.float32)) == [1, 2, 3, 0]
+
+
+def test_shortlist_top_k():
+    similarities = [0.1, 0.4, 0.3, 0.2, 0.25]
+    assert select_shortlist(similarities, top_k=2) == [1, 2]
+    assert select_shortlist(similarities, top_k=10) == [1, 2, 4, 3, 0]
+    # top_k never drops every card
+    assert select_shortlist(similarities, top_k=0) == [1]
+
+
+def test_shortlist_decisive_margin():
+    assert select_shortlist([0.1, 0.4, 0.3], decisive_margin=0.1) == [1]
+    assert select_shortlist([0.1, 0.4, 0.31], decisive_margin=0.1, top_k=2) == [1, 2]
+    # The margin wins over top_k, top_k applies when the margin doesn't decide
+    assert select_shortlist([0.1, 0.4, 0.3], decisive_margin=0.05, top_k=3) == [1]
+    assert select_shortlist([0.1, 0.4, 0.35], decisive_margin=0.1) == [1, 2, 0]
+    # A single card has no runner up to compare with
+    assert select_shortlist([0.4], decisive_margin=0.1) == [0]
+    assert select_shortlist([], top_k=3) == []
+
+
+def test_normalize():
+    embeddings = normalize(np.array([[3.0, 4.0], [0.0, 0.0]], dtype=np.float32))
+    np.testing.assert_allclose(embeddings, [[0.6, 0.8], [0.0, 0.0]])
+
+
+def test_guess_returns_early_when_the_margin_decides():
+    prompts = pytest.importorskip("prompts")
+    images = [object()] * 4
+    result = prompts.guess_image_by_clue(
+        images, "a lonely tree", no_captioning, models=None, embedder=StubEmbedder([0.2, 0.1, 0.6, 0.3]),
+        decisive_margin=0.2, verbose=False)
+    assert result['shortlist'] == [2]
+    assert result['final_answer'].startswith("Image_2 is the closest card")
+    assert "0.600 versus 0.300" in result['final_answer']
+    assert result['similarities'] == pytest.approx([0.2, 0.1, 0.6, 0.3])
+    assert [card['similarity'] for card in result['per_image_reasoning']] == result['similarities']
+
+
+def test_guess_with_a_single_card_on_the_table():
+    prompts = pytest.importorskip("prompts")
+    result = prompts.guess_image_by_clue(
+        [object()], "a lonely tree", no_captioning, models=None, similarities=[0.5], top_k=3, verbose=False)
+    assert result['shortlist'] == [0]
+    assert result['final_answer'].endswith("(0.500).")
+
+
+class StubCardEmbedder:
+    # Embeds a card by its colour and a clue by its length, and records what it was asked for
+    def __init__(self):
+        self.images, self.texts = [], []
+
+    def embed_images(self, images):
+        self.images.extend(images)
+        return normalize(np.stack([np.asarray(image, dtype=np.float32)[0, 0] for image in images]))
+
+    def embed_texts(self, texts):
+        self.texts.extend(texts)
+        return normalize(np.stack([[len(text), 1.0, 0.0] for text in texts]).astype(np.float32))
+
+
+def hand_cards(count=4):
+    rng = np.random.default_rng(0)
+    return {
+        f"card{idx}": {
+            'image_embedding': normalize(rng.standard_normal(3)).tolist(),
+            'description_embedding': normalize(rng.standard_normal(3)).tolist(),
+        }
+        for idx in range(count)
+    }
+
+
+def test_hand_index_search_blends_image_and_description():
+    cards = hand_cards()
+    index, updated = HandIndex.from_cards(cards)
+    assert not updated
+    assert index.card_hashes == list(cards)
+    clue = normalize(np.array([0.3, -0.2, 0.9], dtype=np.float32))
+    images = np.array([card['image_embedding'] for card in cards.values()])
+    descriptions = np.array([card['description_embedding'] for card in cards.values()])
+    np.testing.assert_allclose(index.search(clue, image_weight=1.0), images @ clue, rtol=1e-5)
+    np.testing.assert_allclose(index.search(clue, image_weight=0.0), descriptions @ clue, rtol=1e-5)
+    np.testing.assert_allclose(index.search(clue), 0.5 * (images @ clue + descriptions @ clue), rtol=1e-5)
+
+
+def test_hand_index_add_and_remove_match_a_rebuild():
+    cards = hand_cards(6)
+    index = HandIndex()
+    for card_hash in ['card0', 'card1', 'card2', 'card3']:
+        index.add(card_hash, cards[card_hash]['image_embedding'], cards[card_hash]['description_embedding'])
+    # Re-adding a card replaces its embeddings in place
+    index.add('card1', cards['card4']['image_embedding'], cards['card4']['description_embedding'])
+    index.remove(['card0', 'unknown'])
+    index.add('card5', cards['card5']['image_embedding'], cards['card5']['description_embedding'])
+
+    expected = {
+        'card1': cards['card4'], 'card2': cards['card2'], 'card3': cards['card3'], 'card5': cards['card5']}
+    rebuilt, _ = HandIndex.from_cards(expected)
+    assert index.card_hashes == rebuilt.card_hashes == ['card1', 'card2', 'card3', 'card5']
+    np.testing.assert_array_equal(index.image_embeddings, rebuilt.image_embeddings)
+    np.testing.assert_array_equal(index.description_embeddings, rebuilt.description_embeddings)
+    clue = np.array([1.0, 0.0, 0.0], dtype=np.float32)
+    np.testing.assert_array_equal(index.search(clue), rebuilt.search(clue))
+
+
+def test_empty_hand_index():
+    index, _ = HandIndex.from_cards(dict())
+    assert len(index) == 0
+    assert index.search(np.ones(3, dtype=np.float32)).shape == (0,)
+    index.remove(['card0'])
+    cards = hand_cards(1)
+    index.add('card0', cards['card0']['image_embedding'], cards['card0']['description_embedding'])
+    index.remove(['card0'])
+    assert index.search(np.ones(3, dtype=np.float32)).shape == (0,)
+
+
+def test_hand_index_backfills_missing_embeddings(tmp_path):
+    cards = hand_cards(3)
+    for card_hash, colour in [('card0', (255, 0, 0)), ('card2', (0, 0, 255))]:
+        path = str(tmp_path / f"{card_hash}.png")
+        Image.new('RGB', (4, 4), colour).save(path)
+        cards[card_hash] = {'image_path': path, 'clue': f" clue of {card_hash} "}
+    embedder = StubCardEmbedder()
+
+    index, updated = HandIndex.from_cards(cards, embedder)
+    assert updated
+    # Only the cards stored without embeddings went through the embedder, by their clue
+    assert len(embedder.images) == 2
+    assert embedder.texts == ["clue of card0", "clue of card2"]
+    assert cards['card0']['image_embedding'] == pytest.approx([1.0, 0.0, 0.0])
+    assert cards['card2']['image_embedding'] == pytest.approx([0.0, 0.0, 1.0])
+    assert index.card_hashes == ['card0', 'card1', 'card2']
+    np.testing.assert_allclose(index.search([0.0, 0.0, 1.0], image_weight=1.0), [0.0, cards['card1']['image_embedding'][2], 1.0], atol=1e-6)
+
+    # With the embeddings stored on the cards nothing is computed again
+    _, updated = HandIndex.from_cards(cards, embedder)
+    assert not updated
+    assert len(embedder.images) == 2
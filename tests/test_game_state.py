@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+import pytest
+import yaml
+from PIL import Image
+
+pytest.importorskip("langchain")
+
+from game_state import GameStateStore
+from image_store import ImageStore
+
+
+def card(name, **fields):
+    return {
+        'image_path': f".cache/images/{name}.jpg",
+        'captions': {'captions': f"BLIP-BASE: {name}", 'models': ['BLIP-BASE']},
+        'clue': f"clue of {name}",
+        'association': f"association of {name}",
+        'interpretation': f"interpretation of {name}",
+        'pre_qna_interpretation': f"first interpretation of {name}",
+        'qna_session': f"Q: what is it? A: {name}",
+        **fields,
+    }
+
+
+def make_store(tmp_path, **kwargs):
+    return GameStateStore(str(tmp_path / "game_state.db"), **kwargs)
+
+
+def test_cards_keep_the_order_they_were_added_in(tmp_path):
+    store = make_store(tmp_path)
+    store.add_cards('alice', {'c': card('c'), 'a': card('a')})
+    store.add_cards('alice', {'b': card('b')})
+    assert store.hand_hashes('alice') == ['c', 'a', 'b']
+    assert list(store.get_hand('alice')) == ['c', 'a', 'b']
+    assert list(store.get_hand('alice', summary=True)) == ['c', 'a', 'b']
+    assert store.count('alice') == 3
+    assert store.count('bob') == 0
+
+
+def test_adding_a_known_card_replaces_it_in_place(tmp_path):
+    store = make_store(tmp_path)
+    store.add_cards('alice', {'a': card('a'), 'b': card('b')})
+    store.add_cards('alice', {'a': card('a', clue="a new clue"), 'c': card('c')})
+    hand = store.get_hand('alice')
+    assert list(hand) == ['a', 'b', 'c']
+    assert hand['a']['clue'] == "a new clue"
+
+
+def test_remove_and_reset(tmp_path):
+    store = make_store(tmp_path)
+    store.add_cards('alice', {name: card(name) for name in 'abcd'})
+    store.add_cards('bob', {'a': card('a')})
+    store.remove_cards('alice', ['b', 'unknown'])
+    assert store.hand_hashes('alice') == ['a', 'c', 'd']
+    # A card added after a removal goes to the end, not into the gap
+    store.add_cards('alice', {'e': card('e')})
+    assert store.hand_hashes('alice') == ['a', 'c', 'd', 'e']
+
+    store.reset('alice')
+    assert store.get_hand('alice') == dict()
+    assert store.hand_hashes('bob') == ['a']
+    assert store.image_paths() == [card('a')['image_path']]
+
+
+def test_card_fields_round_trip(tmp_path):
+    store = make_store(tmp_path)
+    store.add_cards('alice', {'a': card('a')})
+    store.add_cards('alice', {'b': {'image_path': "b.jpg", 'captions': None}})
+    hand = store.get_hand('alice')
+    assert hand['a'] == card('a')
+    # Missing text fields come back empty, and without embeddings HandIndex backfills them
+    assert hand['b']['clue'] == ""
+    assert 'image_embedding' not in hand['b']
+    assert store.get_hand('alice', summary=True)['a'] == {'image_path': card('a')['image_path'], 'clue': "clue of a"}
+
+
+def test_embeddings_round_trip_as_float32_blobs(tmp_path):
+    store = make_store(tmp_path)
+    rng = np.random.default_rng(0)
+    image_embedding = rng.standard_normal(512).round(6).tolist()
+    description_embedding = rng.standard_normal(512).round(6).tolist()
+    store.add_cards('alice', {'a': card(
+        'a', image_embedding=image_embedding, description_embedding=description_embedding)})
+
+    card_info = make_store(tmp_path).get_hand('alice')['a']
+    assert len(card_info['image_embedding']) == 512
+    np.testing.assert_allclose(card_info['image_embedding'], image_embedding, rtol=1e-6)
+    np.testing.assert_allclose(card_info['description_embedding'], description_embedding, rtol=1e-6)
+
+
+def test_cards_hold_references_on_their_images(tmp_path):
+    images = ImageStore(str(tmp_path / "images"), str(tmp_path / "image_store.db"))
+    path, saved = images.put_image(Image.new('RGB', (8, 8), (1, 2, 3)))
+    saved.result()
+
+    def refcount():
+        return images.con.execute("SELECT refcount FROM images WHERE path = ?", (path,)).fetchone()[0]
+
+    store = make_store(tmp_path, images=images)
+    store.add_cards('alice', {'a': card('a', image_path=path)})
+    store.add_cards('bob', {'a': card('a', image_path=path)})
+    assert refcount() == 2
+    # Replacing a card takes the new reference before dropping the old one
+    store.add_cards('alice', {'a': card('a', image_path=path)})
+    assert refcount() == 2
+    store.remove_cards('alice', ['a'])
+    assert refcount() == 1
+    store.reset('bob')
+    assert refcount() == 0
+
+
+def test_migrate_yaml(tmp_path):
+    folder = tmp_path / "game_state"
+    folder.mkdir()
+    with open(folder / "alice.yaml", 'w') as fd:
+        yaml.dump({'my_cards': {'c': card('c'), 'a': card('a')}}, fd, sort_keys=False)
+    with open(folder / "bob.yaml", 'w') as fd:
+        yaml.dump({'my_cards': None}, fd)
+    (folder / "carol.yaml").write_text("")
+
+    store = make_store(tmp_path)
+    assert store.migrate_yaml(str(folder)) == 3
+    assert store.get_hand('alice') == {'c': card('c'), 'a': card('a')}
+    assert list(store.get_hand('alice')) == ['c', 'a']
+    assert store.count('bob') == 0
+    assert sorted(os.listdir(folder)) == ['alice.yaml.migrated', 'bob.yaml.migrated', 'carol.yaml.migrated']
+
+    # The renamed files are not imported again
+    assert store.migrate_yaml(str(folder)) == 0
+    assert store.count('alice') == 2
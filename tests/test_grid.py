@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("cv2")
+
+from utils import HandGrid, build_image_grid, grid_shape_for, place_tiles
+
+
+def random_images(count, size=(30, 40), seed=0):
+    rng = np.random.default_rng(seed)
+    return [Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)) for _ in range(count)]
+
+
+def naive_grid(tiles, grid_shape, border):
+    # One tile at a time, the way the grid was built before place_tiles
+    rows, cols = grid_shape
+    height, width = tiles.shape[1:3]
+    grid = np.zeros((rows * (height + border) - border, cols * (width + border) - border, 3), dtype=np.uint8)
+    for idx, tile in enumerate(tiles):
+        row, col = divmod(idx, cols)
+        grid[row * (height + border):row * (height + border) + height, col * (width + border):col * (width + border) + width] = tile
+    return grid
+
+
+def cards(names, images):
+    return {name: {'image_path': image} for name, image in zip(names, images)}
+
+
+@pytest.mark.parametrize("num_tiles,grid_shape,border", [
+    (6, (2, 3), 0), (5, (2, 3), 0), (7, (2, 4), 5), (12, (3, 4), 3), (1, (2, 3), 2), (13, (4, 4), 0)])
+def test_place_tiles_matches_tile_by_tile_placement(num_tiles, grid_shape, border):
+    tiles = np.stack([np.asarray(image) for image in random_images(num_tiles)])
+    np.testing.assert_array_equal(place_tiles(tiles, grid_shape, border), naive_grid(tiles, grid_shape, border))
+
+
+def test_grid_shape_for():
+    assert [grid_shape_for(num_images) for num_images in (1, 6, 7, 8, 9, 12, 13, 17)] == [
+        (2, 3), (2, 3), (2, 4), (2, 4), (3, 4), (3, 4), (4, 4), (5, 4)]
+
+
+def test_build_image_grid():
+    images = random_images(7)
+    # Smaller cards are resized to the size of the first one
+    images[3] = images[3].resize((15, 20))
+    grid = build_image_grid(images, border=4)
+    assert grid.size == (4 * 30 + 3 * 4, 2 * 40 + 4)
+    assert build_image_grid([]) is None
+
+
+def test_hand_grid_from_cards_matches_build_image_grid():
+    images = random_images(8)
+    images[2] = images[2].resize((60, 80))
+    hand_grid = HandGrid.from_cards(cards("abcdefgh", images))
+    np.testing.assert_array_equal(np.asarray(hand_grid.image), np.asarray(build_image_grid(images)))
+    assert HandGrid.from_cards(dict()).image is None
+
+
+def test_adding_cards_matches_a_full_rebuild():
+    images = random_images(13)
+    hand_grid = HandGrid()
+    for count, (name, image) in enumerate(zip("abcdefghijklm", images), start=1):
+        hand_grid.add(name, image)
+        # Covers additions within a grid shape and the ones that change it (7, 9 and 13 cards)
+        np.testing.assert_array_equal(hand_grid.grid, np.asarray(build_image_grid(images[:count])))
+    assert len(hand_grid) == 13
+
+
+def test_readding_a_card_keeps_its_slot():
+    images = random_images(5)
+    hand_grid = HandGrid.from_cards(cards("abcd", images[:4]))
+    hand_grid.add('b', images[4])
+    assert hand_grid.card_hashes == ['a', 'b', 'c', 'd']
+    expected = [images[0], images[4], images[2], images[3]]
+    np.testing.assert_array_equal(hand_grid.grid, np.asarray(build_image_grid(expected)))
+
+
+@pytest.mark.parametrize("removed", [
+    ['f'], ['a'], ['c', 'e'], ['h'], ['a', 'b'], ['b', 'g', 'h'], list("abcdefgh"), ['unknown']])
+def test_removing_cards_matches_a_full_rebuild(removed):
+    names = "abcdefgh"
+    images = random_images(len(names))
+    hand_grid = HandGrid.from_cards(cards(names, images))
+    jpeg_before = hand_grid.jpeg_bytes
+    hand_grid.remove(removed)
+
+    kept = [(name, image) for name, image in zip(names, images) if name not in removed]
+    assert hand_grid.card_hashes == [name for name, _ in kept]
+    if len(kept) == 0:
+        assert hand_grid.image is None
+        assert hand_grid.jpeg_bytes is None
+        return
+    expected = np.asarray(build_image_grid([image for _, image in kept]))
+    np.testing.assert_array_equal(hand_grid.grid, expected)
+    np.testing.assert_array_equal(hand_grid.grid, HandGrid.from_cards(cards(*zip(*kept))).grid)
+    # The JPEG is encoded again only when the grid changed
+    assert (hand_grid.jpeg_bytes == jpeg_before) == (removed == ['unknown'])
+
+
+def test_jpeg_bytes_are_encoded_once_per_change():
+    hand_grid = HandGrid.from_cards(cards("abc", random_images(3)))
+    jpeg = hand_grid.jpeg_bytes
+    assert jpeg is hand_grid.jpeg_bytes
+    hand_grid.add('d', random_images(1, seed=1)[0])
+    assert hand_grid.jpeg_bytes != jpeg
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+from PIL import Image
+
+pytest.importorskip("langchain")
+
+from image_store import ImageStore
+
+
+def make_store(tmp_path, **kwargs):
+    return ImageStore(str(tmp_path / "images"), str(tmp_path / "image_store.db"), **kwargs)
+
+
+def refcount(store, path):
+    return store.con.execute("SELECT refcount FROM images WHERE path = ?", (path,)).fetchone()[0]
+
+
+def test_nuke_during_add_keeps_pending_crops(tmp_path):
+    store = make_store(tmp_path, min_age_seconds=3600)
+    # User B's /add is waiting for "add_yes" with an unreferenced crop
+    path, saved = store.put_image(Image.new('RGB', (8, 8), (10, 20, 30)))
+    saved.result()
+    # User A runs /nuke_cache
+    store.purge_unreferenced()
+    assert os.path.exists(path)
+    # User B confirms, the hand refers to a file that is still there
+    store.acquire([path])
+    assert refcount(store, path) == 1
+    with Image.open(path) as image:
+        assert image.size == (8, 8)
+
+
+def test_put_after_eviction_keeps_hand_reference(tmp_path):
+    store = make_store(tmp_path, min_age_seconds=0)
+    image = Image.new('RGB', (8, 8), (40, 50, 60))
+    path, saved = store.put_image(image)
+    saved.result()
+    store.purge_unreferenced()
+    assert not os.path.exists(path)
+
+    # A hand took the path anyway, writing the image again keeps the hand's reference
+    store.acquire([path])
+    path_again, saved = store.put_image(image)
+    saved.result()
+    assert path_again == path
+    assert os.path.exists(path)
+    assert refcount(store, path) == 1
+    store.purge_unreferenced()
+    assert os.path.exists(path)
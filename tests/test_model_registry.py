@@ -0,0 +1,149 @@
+import torch
+
+from model_registry import ModelRegistry, model_memory_bytes, parse_model_config
+
+# Weights and bias of a 10x10 float32 linear layer
+LINEAR_BYTES = (10 * 10 + 10) * 4
+
+
+def linear():
+    return torch.nn.Linear(10, 10)
+
+
+def make_registry(budget_models=None, names=('a', 'b', 'c')):
+    registry = ModelRegistry(None if budget_models is None else budget_models * LINEAR_BYTES)
+    for name in names:
+        registry.register(name, linear)
+    return registry
+
+
+def test_models_are_loaded_once():
+    registry = make_registry()
+    model = registry.get('a')
+    assert registry.get('a') is model
+    assert registry.stats()['models']['a']['load_count'] == 1
+
+
+def test_least_recently_used_model_is_unloaded():
+    registry = make_registry(budget_models=2)
+    registry.get('a')
+    registry.get('b')
+    # Using a makes b the least recently used model
+    registry.get('a')
+    registry.get('c')
+    assert list(registry.models) == ['a', 'c']
+    registry.get('b')
+    assert list(registry.models) == ['c', 'b']
+    assert registry.stats()['models']['b']['load_count'] == 2
+
+
+def test_without_budget_nothing_is_unloaded():
+    registry = make_registry()
+    for name in 'abc':
+        registry.get(name)
+    assert list(registry.models) == ['a', 'b', 'c']
+
+
+def test_dependent_model_is_charged_for_its_own_weights_only():
+    registry = make_registry(budget_models=2, names=('base', 'other'))
+    # Like the BLIP-2 variants, the dependent model wraps the weights of the one it depends on
+    registry.register('head', lambda: {'base': registry.get('base'), 'head': linear()}, depends_on='base')
+    head = registry.get('head')
+    assert model_memory_bytes(head) == 2 * LINEAR_BYTES
+    assert registry.memory['head'] == LINEAR_BYTES
+    assert registry.memory['base'] == LINEAR_BYTES
+    assert registry.stats()['loaded_bytes'] == 2 * LINEAR_BYTES
+
+
+def test_unloading_a_model_unloads_its_dependents():
+    registry = make_registry(names=('base', 'other'))
+    registry.register('head', lambda: {'base': registry.get('base'), 'head': linear()}, depends_on='base')
+    registry.register('tail', lambda: {'head': registry.get('head'), 'tail': linear()}, depends_on='head')
+    registry.get('tail')
+    registry.get('other')
+    assert set(registry.models) == {'base', 'head', 'tail', 'other'}
+    registry.unload('base')
+    assert list(registry.models) == ['other']
+
+
+def test_eviction_keeps_the_dependency_of_the_new_model():
+    registry = make_registry(budget_models=2, names=('base', 'other'))
+    registry.register('head', lambda: {'base': registry.get('base'), 'head': linear()}, depends_on='base')
+    registry.get('base')
+    registry.get('other')
+    # base is the least recently used model, but head shares its weights
+    registry.get('head')
+    assert set(registry.models) == {'base', 'head'}
+
+
+def test_stats():
+    registry = make_registry(budget_models=1)
+    registry.get('a')
+    registry.get('b')
+    stats = registry.stats()
+    assert stats['memory_budget_bytes'] == LINEAR_BYTES
+    assert stats['loaded_bytes'] == LINEAR_BYTES
+    assert stats['models']['a'] == {
+        'loaded': False, 'memory_bytes': LINEAR_BYTES,
+        'load_seconds': stats['models']['a']['load_seconds'], 'load_count': 1}
+    assert stats['models']['a']['load_seconds'] >= 0.0
+    assert stats['models']['b']['loaded'] is True
+    assert stats['models']['c'] == {'loaded': False, 'memory_bytes': None, 'load_seconds': None, 'load_count': 0}
+
+
+def test_preload_stops_at_the_budget():
+    registry = make_registry(budget_models=2, names=('a', 'b', 'c', 'd'))
+    assert registry.preload() == ['a', 'b']
+    assert list(registry.models) == ['a', 'b']
+    assert registry.stats()['models']['c']['load_count'] == 0
+
+
+def test_preload_stops_before_unloading_what_it_preloaded():
+    registry = make_registry(budget_models=3, names=('a', 'b', 'c'))
+    registry.register('big', lambda: torch.nn.Linear(10, 30))
+    # The size of big is unknown until it is loaded, which unloads a
+    assert registry.preload(['a', 'big', 'b', 'c']) == ['a', 'big']
+    assert list(registry.models) == ['big']
+    # Once its size is known big is skipped up front
+    registry.unload('big')
+    assert registry.preload(['a', 'b', 'big']) == ['a', 'b']
+    assert list(registry.models) == ['a', 'b']
+
+
+def test_preload_async_with_failing_loader():
+    registry = make_registry(names=('a',))
+
+    def fail():
+        raise RuntimeError("no weights")
+
+    registry.register('broken', fail)
+    registry.preload_async(['broken', 'a']).join(5)
+    assert list(registry.models) == ['a']
+
+
+def test_parse_model_config():
+    assert parse_model_config("blip2=bf16, git_large = int8,") == {'blip2': 'bf16', 'git_large': 'int8'}
+    assert parse_model_config(None) == dict()
+
+
+class OnnxModel:
+    # Stands in for the ONNX Runtime captioners, which hold about the size of their graph files
+    def __init__(self, model_files):
+        self.model_files = model_files
+
+
+def test_onnx_models_are_charged_for_their_graph_files(tmp_path):
+    paths = []
+    for name, size in (("encoder.onnx", 300), ("decoder.onnx", 700), ("detector.onnx", 600)):
+        (tmp_path / name).write_bytes(b"x" * size)
+        paths.append(str(tmp_path / name))
+    # A CaptioningModel keeps the ONNX model in its model dict
+    captioner = {'model': OnnxModel(paths[:2]), 'processor': None}
+    assert model_memory_bytes(captioner) == 1000
+
+    registry = ModelRegistry(memory_budget_bytes=1500)
+    registry.register('onnx', lambda: captioner)
+    registry.register('other', lambda: OnnxModel(paths[2:]))
+    registry.get('onnx')
+    registry.get('other')
+    assert list(registry.models) == ['other']
@@ -0,0 +1,91 @@
+import json
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("onnx")
+
+import onnx_backend
+from onnx_backend import OnnxCaptioner
+
+IMAGE_SIZE = 32
+
+
+def tiny_git():
+    config = transformers.GitConfig(
+        vision_config={'hidden_size': 32, 'intermediate_size': 37, 'num_hidden_layers': 2, 'num_attention_heads': 4,
+                       'image_size': IMAGE_SIZE, 'patch_size': 8},
+        vocab_size=99, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=37,
+        max_position_embeddings=64, bos_token_id=1, eos_token_id=2, pad_token_id=0, initializer_range=0.3)
+    return transformers.GitForCausalLM(config)
+
+
+def tiny_blip():
+    config = transformers.BlipConfig(
+        text_config={'vocab_size': 99, 'hidden_size': 32, 'num_hidden_layers': 2, 'num_attention_heads': 4,
+                     'intermediate_size': 37, 'encoder_hidden_size': 32, 'max_position_embeddings': 64,
+                     'bos_token_id': 1, 'sep_token_id': 2, 'pad_token_id': 0, 'initializer_range': 0.1},
+        vision_config={'hidden_size': 32, 'intermediate_size': 37, 'num_hidden_layers': 2, 'num_attention_heads': 4,
+                       'image_size': IMAGE_SIZE, 'patch_size': 8, 'initializer_range': 0.1},
+        projection_dim=32)
+    return transformers.BlipForConditionalGeneration(config)
+
+
+def tiny_vit_gpt2():
+    encoder = transformers.ViTConfig(
+        hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=37,
+        image_size=IMAGE_SIZE, patch_size=8)
+    decoder = transformers.GPT2Config(
+        vocab_size=99, n_embd=32, n_layer=2, n_head=4, n_positions=64, bos_token_id=1, eos_token_id=2,
+        is_decoder=True, add_cross_attention=True)
+    config = transformers.VisionEncoderDecoderConfig.from_encoder_decoder_configs(encoder, decoder)
+    config.decoder_start_token_id = 1
+    config.pad_token_id = 0
+    return transformers.VisionEncoderDecoderModel(config=config)
+
+
+@pytest.fixture(autouse=True)
+def onnx_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(onnx_backend, 'ONNX_FOLDER', str(tmp_path / "onnx"))
+
+
+@pytest.mark.parametrize("make_model", [tiny_git, tiny_blip, tiny_vit_gpt2])
+def test_cached_decoding_matches_generate(make_model):
+    torch.manual_seed(0)
+    model = make_model().eval()
+    captioner = OnnxCaptioner.load("captioner", model)
+    pixel_values = torch.randn(4, 3, IMAGE_SIZE, IMAGE_SIZE)
+    with torch.no_grad():
+        expected = model.generate(pixel_values=pixel_values, max_length=12, num_beams=1, do_sample=False)
+    # The initializer ranges of the tiny models make the captions depend on the image
+    assert len({tuple(row) for row in expected.tolist()}) > 1
+    np.testing.assert_array_equal(captioner.generate(pixel_values, max_length=12), expected.numpy())
+
+
+def test_older_exports_are_redone(tmp_path):
+    OnnxCaptioner.load("captioner", tiny_vit_gpt2().eval(), precision='int8')
+    assert onnx_backend.is_exported("captioner")
+    folder = tmp_path / "onnx" / "captioner"
+    # An export without past inputs, from before the export version
+    (folder / "meta.json").write_text(json.dumps({'start_token_id': 1, 'eos_token_id': 2, 'pad_token_id': 0}))
+    assert not onnx_backend.is_exported("captioner")
+
+    OnnxCaptioner.load("captioner", tiny_vit_gpt2().eval())
+    # The quantized graphs of the earlier export are gone with it
+    assert not (folder / "decoder.int8.onnx").exists()
+    assert onnx_backend.is_exported("captioner")
+
+
+def test_export_checks_the_transformers_version(monkeypatch):
+    monkeypatch.setattr(onnx_backend.transformers, '__version__', "9.0.0")
+    with pytest.raises(RuntimeError, match="found 9.0.0"):
+        OnnxCaptioner.load("captioner", tiny_git())
+    assert not onnx_backend.is_exported("captioner")
+
+
+def test_captioner_lists_its_model_files():
+    captioner = OnnxCaptioner.load("captioner", tiny_blip().eval())
+    assert [path.rsplit('/', 1)[-1] for path in captioner.model_files] == ["encoder.onnx", "decoder.onnx"]
@@ -0,0 +1,118 @@
+import pytest
+from PIL import Image
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+import preprocessing
+from preprocessing import PreparedImages, variant_key
+
+
+def card(red):
+    return Image.new('RGB', (16, 16), (red, 0, 0))
+
+
+# id of a processor -> number of images of every call, kept outside the processor since its
+# attributes are part of the variant key
+CALLS = dict()
+
+
+class CountingProcessor(transformers.BlipImageProcessor):
+    @property
+    def calls(self):
+        return CALLS.setdefault(id(self), [])
+
+    def __call__(self, images, **kwargs):
+        self.calls.append(len(images))
+        return super().__call__(images, **kwargs)
+
+
+def blip_processor(size=8, **kwargs):
+    processor = CountingProcessor(size={'height': size, 'width': size}, **kwargs)
+    processor.calls.clear()
+    return processor
+
+
+class RedTransform:
+    def __init__(self, scale):
+        self.scale = scale
+
+    def __call__(self, image):
+        return torch.tensor([image.getpixel((0, 0))[0] * self.scale])
+
+    def __repr__(self):
+        return f"RedTransform(scale={self.scale})"
+
+
+class LavisProcessor:
+    # The lavis eval processors wrap a torchvision transform and take one image at a time
+    def __init__(self, scale, calls):
+        self.transform = RedTransform(scale)
+        self.calls = calls
+
+    def __call__(self, image):
+        self.calls.append(image.getpixel((0, 0))[0])
+        return self.transform(image)
+
+
+def test_processors_with_the_same_settings_share_the_tensors():
+    base, large = blip_processor(), blip_processor()
+    assert variant_key(base) == variant_key(large)
+    # A processor bundling a tokenizer is keyed by its image part
+    assert variant_key(transformers.BlipProcessor.__new__(transformers.BlipProcessor)) != variant_key(base)
+
+    images = PreparedImages([card(red) for red in (10, 20, 30)])
+    expected = base.preprocess([card(red) for red in (10, 20, 30)], return_tensors="pt")['pixel_values']
+    torch.testing.assert_close(images.pixel_values(base), expected)
+    torch.testing.assert_close(images.pixel_values(large), expected)
+    assert base.calls == [3]
+    assert large.calls == []
+
+
+def test_other_settings_are_another_variant():
+    images = PreparedImages([card(red) for red in (10, 20)])
+    small, bigger, unnormalized = blip_processor(8), blip_processor(12), blip_processor(8, do_normalize=False)
+    assert len({variant_key(small), variant_key(bigger), variant_key(unnormalized)}) == 3
+    assert images.pixel_values(small).shape[-1] == 8
+    assert images.pixel_values(bigger).shape[-1] == 12
+    images.pixel_values(unnormalized)
+    assert [small.calls, bigger.calls, unnormalized.calls] == [[2], [2], [2]]
+
+
+def test_subsets_share_the_tensors_of_the_request():
+    processor = blip_processor()
+    images = PreparedImages([card(red) for red in (10, 20, 30, 40)])
+    full = images.pixel_values(processor)
+    selected = images.select([3, 1])
+    torch.testing.assert_close(selected.pixel_values(processor), full[[3, 1]])
+    torch.testing.assert_close(images[1:3].pixel_values(processor), full[1:3])
+    torch.testing.assert_close(preprocessing.select(images, [0]).pixel_values(processor), full[:1])
+    assert processor.calls == [4]
+
+    # Only the cards no subset has computed this variant for yet go through the processor
+    bigger = blip_processor(12)
+    images.select([0, 2]).pixel_values(bigger)
+    images.pixel_values(bigger)
+    assert bigger.calls == [2, 2]
+
+
+def test_lavis_processors_are_keyed_by_their_transform():
+    calls = []
+    images = PreparedImages([card(red) for red in (1, 2, 3)])
+    first, second = LavisProcessor(2, calls), LavisProcessor(2, calls)
+    assert variant_key(first) == variant_key(second) == "RedTransform(scale=2)"
+    assert images.pixel_values(first).flatten().tolist() == [2, 4, 6]
+    assert images.pixel_values(second).flatten().tolist() == [2, 4, 6]
+    assert calls == [1, 2, 3]
+    assert images.select([2]).pixel_values(LavisProcessor(3, calls)).flatten().tolist() == [9]
+    assert calls == [1, 2, 3, 3]
+
+
+def test_plain_lists_are_processed_every_time():
+    processor = blip_processor()
+    images = [card(red) for red in (10, 20)]
+    preprocessing.pixel_values(processor, images)
+    preprocessing.pixel_values(processor, preprocessing.select(images, [1]))
+    assert processor.calls == [2, 1]
+    prepared = preprocessing.prepare(images)
+    assert preprocessing.prepare(prepared) is prepared
@@ -0,0 +1,215 @@
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+pytest.importorskip("langchain")
+pytest.importorskip("openai")
+
+from langchain.chains import LLMChain
+from langchain.llms import OpenAIChat
+from langchain.llms.base import BaseLLM
+from langchain.prompts import PromptTemplate
+from langchain.schema import Generation, LLMResult
+
+import prompts
+from cache import CardCache
+
+
+class StubLLM(BaseLLM):
+    # Records the prompts of every call by chain step, answers each prompt with its step name
+    step: str
+    calls: list
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def _generate(self, prompts, stop=None, run_manager=None, **kwargs):
+        self.calls.append((self.step, list(prompts)))
+        return LLMResult(generations=[[Generation(text=f"{self.step} answer Image_0")] for _ in prompts])
+
+    async def _agenerate(self, prompts, stop=None, run_manager=None, **kwargs):
+        return self._generate(prompts, stop)
+
+
+def stub_openai(monkeypatch):
+    calls = []
+
+    def openai(model, step, callbacks=(), **kwargs):
+        return StubLLM(step=step, calls=calls, callbacks=list(callbacks) or None)
+
+    monkeypatch.setattr(prompts, '_openai', openai)
+    return calls
+
+
+class StubModels:
+    model_names = ['Git-Large']
+
+    def blip2(self, image, question):
+        return "a lantern"
+
+
+def stub_captions(images, models):
+    return [{'captions': f"Git-Large: card {idx}", 'models': ['Git-Large']} for idx in range(len(images))]
+
+
+def batch_sizes(calls, step):
+    return [len(call_prompts) for called, call_prompts in calls if called == step]
+
+
+def test_completion_model_is_not_turned_into_a_chat_model(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    llm = prompts._openai('gpt-3.5-turbo-instruct', "interpretation_test", max_tokens=16)
+    assert isinstance(llm, prompts.CompletionOpenAI)
+    assert not isinstance(llm, OpenAIChat)
+    assert llm.model_name == 'gpt-3.5-turbo-instruct'
+    assert isinstance(prompts._openai('gpt-4', "interpretation_test"), OpenAIChat)
+    assert prompts.is_chat_model('gpt-3.5-turbo')
+    assert not prompts.is_chat_model('text-davinci-003')
+
+
+def test_guess_sends_the_prompts_of_all_shortlisted_cards_at_once(monkeypatch):
+    calls = stub_openai(monkeypatch)
+    images = [Image.new('RGB', (8, 8), (idx, 0, 0)) for idx in range(5)]
+    result = prompts.guess_image_by_clue(
+        images, "lost at sea", stub_captions, StubModels(), similarities=[0.1, 0.5, 0.3, 0.4, 0.2], top_k=3,
+        num_blip2_questions=1, max_concurrency=1, verbose=False)
+
+    assert result['shortlist'] == [1, 2, 3]
+    assert batch_sizes(calls, "interpretation") == [3]
+    assert batch_sizes(calls, "post_qna_interpretation") == [3]
+    assert batch_sizes(calls, "clue_relation") == [3]
+    # The QnA sessions are dialogues, one prompt per call and card
+    assert batch_sizes(calls, "qna_plan") == [1, 1, 1]
+    assert batch_sizes(calls, "answer") == [1]
+    assert result['per_image_reasoning'][1]['clue_relation'] == "clue_relation answer Image_0"
+    assert result['per_image_reasoning'][0]['clue_relation'] == ""
+
+
+def test_chat_models_get_one_prompt_per_call(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    sizes = []
+
+    def generate(self, prompts, stop=None, run_manager=None, **kwargs):
+        sizes.append(len(prompts))
+        return LLMResult(generations=[[Generation(text=f"answer to {prompts[0]}")]])
+
+    monkeypatch.setattr(OpenAIChat, '_generate', generate)
+    chain = LLMChain(
+        llm=OpenAIChat(model_name='gpt-4'), prompt=PromptTemplate(input_variables=["card"], template="card {card}"))
+    outputs = prompts._apply(chain, [{'card': idx} for idx in range(3)])
+    assert sizes == [1, 1, 1]
+    assert [output['text'] for output in outputs] == ["answer to card 0", "answer to card 1", "answer to card 2"]
+
+
+def test_cached_batch_computes_only_the_missing_cards(tmp_path):
+    card_cache = CardCache(str(tmp_path / "card_cache.db"))
+    card_cache.put('b', 'interpretation', {}, "cached b")
+    card_cache.put('d', 'interpretation', {}, "cached d")
+    asked = []
+
+    def compute(missing):
+        asked.append(missing)
+        return [f"computed {idx}" for idx in missing]
+
+    values = prompts._cached_batch(card_cache, ['a', 'b', 'c', 'd'], 'interpretation', {}, compute)
+    assert values == ["computed 0", "cached b", "computed 2", "cached d"]
+    # All misses in one call, in card order
+    assert asked == [[0, 2]]
+    assert card_cache.get('c', 'interpretation', {}) == "computed 2"
+
+    assert prompts._cached_batch(card_cache, ['c', 'a'], 'interpretation', {}, compute) == ["computed 2", "computed 0"]
+    assert asked == [[0, 2]]
+    # Without a cache every card is computed
+    assert prompts._cached_batch(None, ['a', 'b'], 'interpretation', {}, compute) == ["computed 0", "computed 1"]
+
+
+def test_a_second_guess_reads_the_interpretations_from_the_cache(tmp_path, monkeypatch):
+    calls = stub_openai(monkeypatch)
+    card_cache = CardCache(str(tmp_path / "card_cache.db"))
+    images = [Image.new('RGB', (8, 8), (idx, 0, 0)) for idx in range(3)]
+
+    def guess(clue, images):
+        return prompts.guess_image_by_clue(
+            images, clue, stub_captions, StubModels(), cache=card_cache, num_blip2_questions=0,
+            max_concurrency=1, verbose=False)
+
+    guess("lost at sea", images)
+    assert batch_sizes(calls, "interpretation") == [3]
+    calls.clear()
+    # Interpretations don't depend on the clue, only the new card is interpreted
+    guess("a long way home", images + [Image.new('RGB', (8, 8), (9, 0, 0))])
+    assert batch_sizes(calls, "interpretation") == [1]
+    assert batch_sizes(calls, "clue_relation") == [4]
+
+
+class ConcurrentBlip2:
+    # Counts the QnA sessions talking to BLIP-2 at the same time
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most_active = 0
+
+    def blip2(self, image, question):
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        return "a lantern"
+
+
+@pytest.mark.parametrize("max_concurrency,most_active", [(1, 1), (2, 2), (8, 4)])
+def test_qna_sessions_run_concurrently_up_to_the_limit(monkeypatch, max_concurrency, most_active):
+    calls = stub_openai(monkeypatch)
+    models = ConcurrentBlip2()
+    models.model_names = StubModels.model_names
+    images = [Image.new('RGB', (8, 8), (idx, 0, 0)) for idx in range(4)]
+    result = prompts.guess_image_by_clue(
+        images, "lost at sea", stub_captions, models, num_blip2_questions=1, max_concurrency=max_concurrency,
+        verbose=False)
+    assert models.most_active == most_active
+    assert batch_sizes(calls, "qna_plan") == [1] * 4
+    assert len(result['per_image_reasoning']) == 4
+
+
+def test_streaming_text_follows_the_previous_step():
+    shown = []
+    association = prompts.StreamingText(shown.append, "Association")
+    clue = prompts.StreamingText(shown.append, "Clue", previous=association)
+    # The clue step alone while the association is still empty
+    clue.on_llm_new_token(" sea")
+    assert shown == ["Clue: sea"]
+
+    clue.text = ""
+    for token in ["A", " lighthouse", " "]:
+        association.on_llm_new_token(token)
+    clue.on_llm_new_token("Home")
+    assert shown[1:] == ["Association: A", "Association: A lighthouse", "Association: A lighthouse",
+                         "Association: A lighthouse\n\nClue: Home"]
+
+
+def test_streaming_text_aborts_the_call_when_stream_raises():
+    def cancelled(text):
+        raise RuntimeError("cancelled")
+
+    handler = prompts.StreamingText(cancelled, "Answer")
+    assert handler.raise_error
+    with pytest.raises(RuntimeError, match="cancelled"):
+        handler.on_llm_new_token("Card")
+
+
+@pytest.mark.parametrize("top_k", [0, 1])
+def test_a_shortlist_of_one_card_answers_without_the_llm(monkeypatch, top_k):
+    calls = stub_openai(monkeypatch)
+    images = [Image.new('RGB', (8, 8), (idx, 0, 0)) for idx in range(3)]
+    descriptions = [{'interpretation': f"card {idx}", 'captions': f"card {idx}"} for idx in range(3)]
+    result = prompts.guess_image_by_clue(
+        images, "lost at sea", stub_captions, StubModels(), descriptions, similarities=[0.2, 0.31, 0.3],
+        top_k=top_k, verbose=False)
+    assert calls == []
+    assert result['shortlist'] == [1]
+    assert result['final_answer'].startswith("Image_1 is the closest card to the clue")
@@ -0,0 +1,180 @@
+import json
+import os
+import sqlite3
+import threading
+
+import pytest
+
+import tracing
+from results import ResultsStore, grid_hash
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "schema.sql")
+
+# dixit_results.db as it was before the image_grids table
+OLD_SCHEMA = """
+CREATE TABLE generated_clues(
+    image_hash TEXT PRIMARY KEY, captions TEXT, interpretation TEXT, association TEXT,
+    clue TEXT, score INTEGER, qna_session TEXT, pre_qna_interpretation TEXT);
+CREATE TABLE guesses(
+    image_grid BLOB, guessed_image TEXT, true_image TEXT, final_answer TEXT,
+    score INTEGER, clue TEXT, clue_relations TEXT);
+CREATE TABLE guesses_from_hand(
+    image_grid BLOB, guessed_image TEXT, final_answer TEXT,
+    score INTEGER, clue TEXT, clue_relations TEXT);
+"""
+
+
+def make_store(tmp_path, **kwargs):
+    return ResultsStore(str(tmp_path / "dixit_results.db"), schema_path=SCHEMA_PATH, **kwargs)
+
+
+def test_migration_moves_grids_into_image_grids(tmp_path):
+    path = str(tmp_path / "dixit_results.db")
+    con = sqlite3.connect(path)
+    con.executescript(OLD_SCHEMA)
+    con.executemany("INSERT INTO guesses VALUES(?, ?, ?, ?, ?, ?, ?)", [
+        (b"grid one", "1", "2", "answer one", 1, "a clue", "relations"),
+        (b"grid one", "3", "3", "answer two", 5, "another clue", "relations"),
+        (None, "4", "1", "answer three", 0, "no grid", "relations"),
+    ])
+    con.execute("INSERT INTO guesses_from_hand VALUES(?, ?, ?, ?, ?, ?)",
+                (b"grid two", "2", "hand answer", 4, "a hand clue", "relations"))
+    con.execute("INSERT INTO generated_clues(image_hash, clue, score) VALUES('abc', 'kept', 3)")
+    con.commit()
+    con.close()
+
+    store = make_store(tmp_path)
+    rows = store.query(
+        "SELECT clue, guessed_image, shortlist, image_grid FROM guesses LEFT JOIN image_grids USING(grid_hash) ORDER BY guesses.rowid")
+    assert rows == [
+        ("a clue", "1", None, b"grid one"),
+        ("another clue", "3", None, b"grid one"),
+        ("no grid", "4", None, None),
+    ]
+    assert store.query("SELECT grid_hash FROM guesses ORDER BY rowid") == [
+        (grid_hash(b"grid one"),), (grid_hash(b"grid one"),), (None,)]
+    assert store.query("SELECT clue, image_grid FROM guesses_from_hand JOIN image_grids USING(grid_hash)") == [
+        ("a hand clue", b"grid two")]
+    # Every distinct grid is stored once
+    assert store.query("SELECT COUNT(*) FROM image_grids") == [(2,)]
+    assert store.query("SELECT clue, score FROM generated_clues") == [("kept", 3)]
+    columns = [row[1] for row in store.query("PRAGMA table_info(guesses)")]
+    assert 'image_grid' not in columns
+    store.close()
+
+    # The migrated database opens without migrating again
+    store = make_store(tmp_path)
+    assert store.query("SELECT COUNT(*) FROM guesses") == [(3,)]
+    store.close()
+
+
+def test_put_stores_each_grid_once(tmp_path):
+    store = make_store(tmp_path)
+    row = {'guessed_image': "1", 'true_image': "2", 'final_answer': "answer", 'score': 3, 'clue': "a clue"}
+    futures = [store.put('guesses', row, b"the grid") for _ in range(3)]
+    futures.append(store.put('guesses_from_hand', row, b"the grid"))
+    for future in futures:
+        assert future.result(5) is None
+    assert store.query("SELECT grid_hash FROM image_grids") == [(grid_hash(b"the grid"),)]
+    assert store.query("SELECT COUNT(*) FROM guesses WHERE grid_hash = ?", (grid_hash(b"the grid"),)) == [(3,)]
+    store.close()
+
+
+def test_failing_row_only_loses_itself(tmp_path):
+    store = make_store(tmp_path)
+    first = store.put('generated_clues', {'image_hash': 'abc', 'clue': "first"})
+    duplicate = store.put('generated_clues', {'image_hash': 'abc', 'clue': "duplicate"})
+    other = store.put('generated_clues', {'image_hash': 'def', 'clue': "other"})
+    assert first.result(5) is None
+    with pytest.raises(sqlite3.IntegrityError):
+        duplicate.result(5)
+    assert other.result(5) is None
+    assert store.query("SELECT image_hash, clue FROM generated_clues ORDER BY image_hash") == [
+        ('abc', "first"), ('def', "other")]
+    store.close()
+
+
+def test_close_commits_everything_queued(tmp_path):
+    store = make_store(tmp_path, max_batch=7)
+    futures = [store.put('generated_clues', {'image_hash': str(i), 'score': i}) for i in range(100)]
+    store.close()
+    assert all(future.done() and future.exception() is None for future in futures)
+    assert not store.thread.is_alive()
+
+    con = sqlite3.connect(str(tmp_path / "dixit_results.db"))
+    assert con.execute("SELECT COUNT(*), SUM(score) FROM generated_clues").fetchone() == (100, sum(range(100)))
+    con.close()
+
+
+def test_flush_waits_for_the_writer(tmp_path):
+    store = make_store(tmp_path)
+    for i in range(20):
+        store.put('generated_clues', {'image_hash': str(i)})
+    store.flush()
+    assert store.query("SELECT COUNT(*) FROM generated_clues") == [(20,)]
+    store.close()
+
+
+def db_writes(root):
+    return [item for item in root.finished if item['name'] == "db_write/results"]
+
+
+def test_write_is_traced_under_the_request_that_queued_the_row(tmp_path):
+    store = make_store(tmp_path)
+    with tracing.span("request/persist_clue") as root:
+        store.put('generated_clues', {'image_hash': 'abc'})
+        store.flush()
+    with tracing.span("request/persist_guess") as other:
+        with tracing.span("persist") as parent:
+            store.put('generated_clues', {'image_hash': 'def'})
+    store.flush()
+    store.close()
+
+    (write,) = db_writes(root)
+    assert (write['trace_id'], write['parent_id'], write['size']) == (root.trace_id, root.span_id, 1)
+    (write,) = db_writes(other)
+    assert (write['trace_id'], write['parent_id']) == (other.trace_id, parent.span_id)
+
+
+def test_a_batch_gets_a_span_per_request(tmp_path):
+    store = make_store(tmp_path)
+    # Hold the writer on a first row until the rows of both requests are queued
+    writing, release = threading.Event(), threading.Event()
+    write_batch = store._write_batch
+
+    def held_write_batch(con, batch):
+        writing.set()
+        assert release.wait(5)
+        write_batch(con, batch)
+
+    store._write_batch = held_write_batch
+    store.put('generated_clues', {'image_hash': "first"})
+    assert writing.wait(5)
+    with tracing.span("request/a") as first:
+        for idx in range(2):
+            store.put('generated_clues', {'image_hash': f"a{idx}"})
+    with tracing.span("request/b") as second:
+        store.put('generated_clues', {'image_hash': "b"})
+    store.put('generated_clues', {'image_hash': "no request"})
+    release.set()
+    store.close()
+
+    assert [(write['size'], write['batch_size']) for write in db_writes(first)] == [(2, 4)]
+    assert [(write['size'], write['batch_size']) for write in db_writes(second)] == [(1, 4)]
+
+
+def test_late_writes_are_added_to_the_written_trace(tmp_path):
+    tracing.configure(str(tmp_path / "traces"))
+    try:
+        store = make_store(tmp_path)
+        with tracing.span("request/persist_clue") as root:
+            store.put('generated_clues', {'image_hash': 'abc'})
+        store.close()
+    finally:
+        tracing.configure(None)
+
+    (path,) = (tmp_path / "traces").iterdir()
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert all(line['trace_id'] == root.trace_id for line in lines)
+    names = [item['name'] for line in lines for item in line['spans']]
+    assert sorted(names) == ["db_write/results", "request/persist_clue"]
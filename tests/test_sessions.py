@@ -0,0 +1,79 @@
+import sessions
+from sessions import ExpiringStore, SessionStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_store(monkeypatch, ttl_seconds=60):
+    clock = FakeClock()
+    monkeypatch.setattr(sessions.time, 'monotonic', clock)
+    return SessionStore(ttl_seconds=ttl_seconds), clock
+
+
+def test_sessions_are_keyed_by_chat_and_user(monkeypatch):
+    store, _ = make_store(monkeypatch)
+    session = store.get(1, 10)
+    session.clue = "a lonely tree"
+    assert store.get(1, 10) is session
+    # The same user in another chat and another user in the same chat get their own state
+    assert store.get(2, 10) is not session
+    assert store.get(1, 11) is not session
+    assert store.get(2, 10).clue is None
+    assert len(store) == 3
+
+
+def test_unused_sessions_expire(monkeypatch):
+    store, clock = make_store(monkeypatch, ttl_seconds=60)
+    old = store.get(1, 10)
+    clock.now += 30
+    kept = store.get(1, 11)
+    clock.now += 31
+    # The first session is 61 seconds old, the second one 31
+    assert store.get(1, 11) is kept
+    assert len(store) == 1
+    assert store.evicted == 1
+    assert store.get(1, 10) is not old
+
+
+def test_access_refreshes_a_session(monkeypatch):
+    store, clock = make_store(monkeypatch, ttl_seconds=60)
+    session = store.get(1, 10)
+    for _ in range(3):
+        clock.now += 50
+        assert store.get(1, 10) is session
+    assert store.evicted == 0
+
+
+def test_pop(monkeypatch):
+    store, _ = make_store(monkeypatch)
+    session = store.get(1, 10)
+    assert store.pop(1, 10) is session
+    assert store.pop(1, 10) is None
+    assert len(store) == 0
+
+
+def test_unused_hand_values_expire(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(sessions.time, 'monotonic', clock)
+    store = ExpiringStore(ttl_seconds=60)
+    store.put('alice', "alice's index")
+    clock.now += 30
+    store.put('bob', "bob's index")
+    clock.now += 20
+    # Reading alice's value refreshes it, bob's is not read again
+    assert store.get('alice') == "alice's index"
+    clock.now += 45
+    assert store.get('bob') is None
+    assert store.get('alice') == "alice's index"
+    assert len(store) == 1
+    assert store.evicted == 1
+
+    assert store.pop('alice') == "alice's index"
+    assert store.pop('alice') is None
+    assert len(store) == 0
@@ -0,0 +1,90 @@
+import types
+
+import status
+from status import StatusMessage
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.edits = []
+
+    def send_message(self, chat_id, text):
+        self.sent.append(text)
+        return types.SimpleNamespace(message_id=len(self.sent))
+
+    def edit_message_text(self, text, chat_id, message_id):
+        self.edits.append(text)
+
+
+class SettableClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_status(monkeypatch, **kwargs):
+    clock = SettableClock()
+    monkeypatch.setattr(status.time, 'monotonic', clock)
+    bot = FakeBot()
+    return StatusMessage(bot, 1, "Guessing", **kwargs), bot, clock
+
+
+def test_edits_closer_than_the_interval_are_coalesced(monkeypatch):
+    message, bot, clock = make_status(monkeypatch, min_interval=1.0)
+    assert bot.sent == ["Guessing"]
+    message.progress("Captioning the cards")
+    message.stream("Card 1: a")
+    message.stream("Card 1: a lantern")
+    assert bot.edits == ["Guessing\nCaptioning the cards"]
+
+    clock.now += 1.0
+    message.stream("Card 1: a lantern at sea")
+    assert bot.edits[-1] == "Guessing\nCaptioning the cards\n\nCard 1: a lantern at sea"
+    assert len(bot.edits) == 2
+
+
+def test_flush_shows_the_latest_state_once(monkeypatch):
+    message, bot, clock = make_status(monkeypatch, min_interval=1.0)
+    message.stream("Card 1: a")
+    message.stream("Card 1: a lantern")
+    message.flush()
+    assert bot.edits == ["Guessing\n\nCard 1: a", "Guessing\n\nCard 1: a lantern"]
+    # Telegram refuses edits that don't change the text
+    clock.now += 1.0
+    message.flush()
+    message.stream("Card 1: a lantern")
+    assert len(bot.edits) == 2
+
+
+def test_long_answers_keep_their_beginning_and_end(monkeypatch):
+    message, bot, clock = make_status(monkeypatch)
+    message.stream("start " + "x" * 5000 + " end")
+    text = bot.edits[-1]
+    assert len(text) <= StatusMessage.MAX_LENGTH + len("\n...\n")
+    assert text.startswith("Guessing\n\nstart ")
+    assert text.endswith(" end")
+
+
+class StubJob:
+    def __init__(self):
+        self.on_progress = None
+        self.checked = 0
+
+    def progress(self, text):
+        self.on_progress(text)
+
+    def check_cancelled(self):
+        self.checked += 1
+
+
+def test_progress_and_stream_go_through_the_job(monkeypatch):
+    job = StubJob()
+    message, bot, clock = make_status(monkeypatch, job=job)
+    message.progress("Detecting the cards")
+    assert bot.edits == ["Guessing\nDetecting the cards"]
+    message.stream("Clue: a")
+    assert job.checked == 1
+    assert message.timing_text().startswith(" (first output after ")
@@ -0,0 +1,133 @@
+import threading
+import time
+
+import pytest
+
+from workers import JobCancelled, JobScheduler, current_job
+
+
+def blocking_job(started, release):
+    # Holds its worker until released, then reports progress, which is where a cancel lands
+    def run():
+        started.set()
+        assert release.wait(5)
+        current_job().progress("released")
+        return "done"
+    return run
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_lowest_priority_value_runs_first():
+    scheduler = JobScheduler(num_workers=1)
+    started, release = threading.Event(), threading.Event()
+    blocker = scheduler.submit('a', blocking_job(started, release))
+    assert started.wait(5)
+
+    order = []
+    jobs = [
+        scheduler.submit(key, lambda key=key: order.append(key), priority=priority)
+        for key, priority in [('slow', 2), ('quick', 0), ('middle', 1)]
+    ]
+    release.set()
+    for job in [blocker] + jobs:
+        job.future.result(5)
+    assert order == ['quick', 'middle', 'slow']
+
+
+def test_jobs_of_one_key_run_in_arrival_order():
+    scheduler = JobScheduler(num_workers=3)
+    started, release = threading.Event(), threading.Event()
+    first = scheduler.submit('alice', blocking_job(started, release))
+    assert started.wait(5)
+    # A better priority doesn't let the second job of the key overtake the first one
+    second = scheduler.submit('alice', lambda: "second", priority=-1)
+    other = scheduler.submit('bob', lambda: "other")
+
+    # Other keys run while the first job of alice is still busy
+    assert other.future.result(5) == "other"
+    assert not second.future.done()
+    assert scheduler.position(second) == 0
+
+    release.set()
+    assert first.future.result(5) == "done"
+    assert second.future.result(5) == "second"
+    assert second.started_at >= first.finished_at
+
+
+def test_cancel_drops_queued_jobs_and_stops_the_running_one():
+    scheduler = JobScheduler(num_workers=1)
+    started, release = threading.Event(), threading.Event()
+    running = scheduler.submit('alice', blocking_job(started, release), name='add')
+    assert started.wait(5)
+    queued = scheduler.submit('alice', lambda: "never", name='guess')
+    other = scheduler.submit('bob', lambda: "kept", name='guess')
+
+    dropped, cancelled_running = scheduler.cancel('alice')
+    assert dropped == 1
+    assert cancelled_running is running
+    assert queued.future.cancelled()
+
+    release.set()
+    with pytest.raises(JobCancelled):
+        running.future.result(5)
+    assert other.future.result(5) == "kept"
+    wait_until(lambda: scheduler.stats()['jobs']['guess']['done'] == 1)
+
+    jobs = scheduler.stats()['jobs']
+    assert jobs['add']['cancelled'] == 1
+    assert (jobs['guess']['done'], jobs['guess']['cancelled'], jobs['guess']['failed']) == (1, 1, 0)
+
+
+def test_cancel_without_jobs():
+    scheduler = JobScheduler(num_workers=1)
+    assert scheduler.cancel('nobody') == (0, None)
+
+
+def test_position_and_stats():
+    scheduler = JobScheduler(num_workers=1)
+    started, release = threading.Event(), threading.Event()
+    blocker = scheduler.submit('a', blocking_job(started, release), name='add', priority=3)
+    assert started.wait(5)
+
+    later = scheduler.submit('b', lambda: None, name='clue', priority=1)
+    sooner = scheduler.submit('c', lambda: None, name='hand', priority=0)
+    last = scheduler.submit('d', lambda: None, name='clue', priority=1)
+    assert scheduler.position(blocker) == 0
+    assert scheduler.position(sooner) == 0
+    assert scheduler.position(later) == 1
+    assert scheduler.position(last) == 2
+
+    stats = scheduler.stats()
+    assert stats['workers'] == 1
+    assert stats['pending'] == 3
+    assert stats['pending_by_priority'] == {0: 1, 1: 2}
+    assert [name for name, _ in stats['running']] == ['add']
+    assert stats['oldest_pending_seconds'] >= 0.0
+
+    release.set()
+    for job in (blocker, later, sooner, last):
+        job.future.result(5)
+    wait_until(lambda: scheduler.stats()['pending'] == 0 and scheduler.stats()['running'] == [])
+    stats = scheduler.stats()
+    assert stats['jobs']['clue']['done'] == 2
+    assert stats['jobs']['clue']['run_p50'] is not None
+    assert stats['jobs']['add']['wait_p95'] is not None
+
+
+def test_failed_job_is_counted_and_raised():
+    scheduler = JobScheduler(num_workers=1)
+
+    def fail():
+        raise ValueError("broken")
+
+    job = scheduler.submit('a', fail, name='guess')
+    with pytest.raises(ValueError):
+        job.future.result(5)
+    wait_until(lambda: 'guess' in scheduler.stats()['jobs'])
+    assert scheduler.stats()['jobs']['guess']['failed'] == 1
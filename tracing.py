@@ -0,0 +1,228 @@
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the duration histogram buckets in seconds, LLM calls and BLIP-2 run for seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_local = threading.local()
+_span_ids = itertools.count(1)
+
+
+class Span:
+    """A timed step of a request. Attributes with a meaning for the metrics: size (input size,
+    e.g. images or bytes), cache ('hit' or 'miss'), prompt_tokens and completion_tokens."""
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = next(_span_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.root = parent.root if parent is not None else self
+        self.attributes = dict(attributes)
+        self.start = time.time()
+        self.duration = None
+        # Finished spans of the whole trace, kept by the root span
+        self.finished = [] if parent is None else None
+        self.lock = threading.Lock() if parent is None else None
+        # Set once the root has ended and the trace was written
+        self.closed = False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            **self.attributes,
+        }
+
+
+class Metrics:
+    """Aggregates of the finished spans by name, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = dict()
+
+    def observe(self, span):
+        with self.lock:
+            metric = self.spans.get(span.name)
+            if metric is None:
+                metric = {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0, 'errors': 0, 'size': 0,
+                          'cache_hit': 0, 'cache_miss': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+                self.spans[span.name] = metric
+            metric['count'] += 1
+            metric['sum'] += span.duration
+            for idx, bound in enumerate(BUCKETS):
+                if span.duration <= bound:
+                    metric['buckets'][idx] += 1
+            attributes = span.attributes
+            metric['errors'] += 'error' in attributes
+            metric['size'] += attributes.get('size') or 0
+            if attributes.get('cache') in ('hit', 'miss'):
+                metric['cache_' + attributes['cache']] += 1
+            metric['prompt_tokens'] += attributes.get('prompt_tokens') or 0
+            metric['completion_tokens'] += attributes.get('completion_tokens') or 0
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        with self.lock:
+            spans = sorted(self.spans.items())
+            histogram = []
+            for name, metric in spans:
+                for bound, count in zip(BUCKETS, metric['buckets']):
+                    histogram.append(f'dixitai_span_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+                histogram.append(f'dixitai_span_seconds_bucket{{span="{name}",le="+Inf"}} {metric["count"]}')
+                histogram.append(f'dixitai_span_seconds_sum{{span="{name}"}} {metric["sum"]}')
+                histogram.append(f'dixitai_span_seconds_count{{span="{name}"}} {metric["count"]}')
+            family("dixitai_span_seconds", "histogram", "Duration of the pipeline steps.", histogram)
+            family("dixitai_span_errors_total", "counter", "Steps that raised.", [
+                f'dixitai_span_errors_total{{span="{name}"}} {metric["errors"]}' for name, metric in spans])
+            family("dixitai_span_input_size_total", "counter", "Input size of the steps (images, bytes or rows).", [
+                f'dixitai_span_input_size_total{{span="{name}"}} {metric["size"]}' for name, metric in spans])
+            family("dixitai_span_cache_total", "counter", "Cache lookups of the steps.", [
+                f'dixitai_span_cache_total{{span="{name}",result="{result}"}} {metric["cache_" + result]}'
+                for name, metric in spans for result in ('hit', 'miss')
+                if metric['cache_hit'] + metric['cache_miss'] > 0])
+            family("dixitai_llm_tokens_total", "counter", "Tokens of the LLM calls.", [
+                f'dixitai_llm_tokens_total{{span="{name}",kind="{kind}"}} {metric[kind + "_tokens"]}'
+                for name, metric in spans for kind in ('prompt', 'completion')
+                if metric['prompt_tokens'] + metric['completion_tokens'] > 0])
+        return "\n".join(lines) + "\n"
+
+
+class TraceWriter:
+    # One JSON line per finished trace, in a file per day
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.lock = threading.Lock()
+
+    def write(self, spans):
+        path = os.path.join(self.folder, f"traces-{datetime.now().strftime('%Y-%m-%d')}.jsonl")
+        line = json.dumps({'trace_id': spans[0]['trace_id'], 'spans': spans}, default=str)
+        with self.lock:
+            with open(path, 'a') as fd:
+                fd.write(line + "\n")
+
+
+metrics = Metrics()
+trace_writer = None
+
+
+def configure(trace_folder=None):
+    # Without a folder traces are only aggregated into the metrics
+    global trace_writer
+    trace_writer = TraceWriter(trace_folder) if trace_folder else None
+
+
+def current_span():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def start_span(name, parent=None, **attributes):
+    # For steps that start and end in different callbacks, the span doesn't become current.
+    # parent defaults to the current span of this thread, a step done on behalf of a request on
+    # another thread (e.g. the results writer) passes the span that was current in the request.
+    return Span(name, parent if parent is not None else current_span(), attributes)
+
+
+def end_span(current):
+    current.duration = time.time() - current.start
+    metrics.observe(current)
+    root = current.root
+    with root.lock:
+        root.finished.append(current.to_dict())
+        if current is root:
+            root.closed = True
+            spans = list(root.finished)
+        elif root.closed:
+            # The span outlived its request, it is written as another line of the same trace
+            spans = [current.to_dict()]
+        else:
+            spans = None
+    if spans is not None and trace_writer is not None:
+        try:
+            trace_writer.write(sorted(spans, key=lambda item: item['start']))
+        except OSError as e:
+            logging.log(logging.WARNING, f"Couldn't write trace {current.trace_id}: {e!r}")
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the block as a child of the current span of this thread. A span without a parent
+    is the root of a trace, the trace is written when it ends."""
+    current = start_span(name, **attributes)
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        _local.stack.pop()
+        end_span(current)
+
+
+def propagate(fn):
+    # Runs fn on another thread (executor, pipeline stage) as a child of the caller's current span
+    parent = current_span()
+    if parent is None:
+        return fn
+
+    def run(*args, **kwargs):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.stack.pop()
+
+    return run
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    # /metrics in the Prometheus text format, served from a daemon thread
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="dixit-metrics", daemon=True).start()
+    logging.log(logging.INFO, f"Serving metrics on http://{host}:{port}/metrics")
+    return server
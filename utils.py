@@ -1,87 +1,193 @@
 import cv2
 import numpy as np
 from PIL import Image
-import os
-from datetime import datetime
+import io
+import math
 
-def build_image_grid(image_paths, border=0):
-    images = [Image.open(p) for p in image_paths]
-    """Builds a grid of images from a list of image paths."""
-    # Choose the grid shape that can contain all images
-    if len(images) == 0:
-        print("No images found")
-        return None
-
-    grid_shapes = [(2, 3), (2, 4), (3, 4)]
-    for grid_shape in grid_shapes:
-        if grid_shape[0] * grid_shape[1] >= len(images):
-            break
+import tracing
 
-    # Resize all images to the size of image[0]
-    images = [img.resize(images[0].size) for img in images]
-
-    # In the center of each image, assign the image number using OpenCV
-    for i, img in enumerate(images):
-        img_copy = np.array(img).copy()
-        # Explanation of cv2.putText parameters:
-        # https://www.geeksforgeeks.org/python-opencv-cv2-puttext-method/
-        cv2.putText(img_copy, str(i), (img.size[0] // 2, img.size[1] // 2),
-                    cv2.FONT_HERSHEY_DUPLEX, 3, (0, 0, 255), 5)
-        images[i] = Image.fromarray(img_copy)
-
-    # Build grid
-    grid = Image.new('RGB', (
-        grid_shape[1] * images[0].size[0] + (grid_shape[1] - 1) * border,
-        grid_shape[0] * images[0].size[1] + (grid_shape[0] - 1) * border,
-    ))
-    for i, img in enumerate(images):
-        grid.paste(img, (
-            (i % grid_shape[1]) * (img.size[0] + border),
-            (i // grid_shape[1]) * (img.size[1] + border),
-        ))
-    return grid
 
+def grid_shape_for(num_images):
+    for grid_shape in [(2, 3), (2, 4), (3, 4)]:
+        if grid_shape[0] * grid_shape[1] >= num_images:
+            return grid_shape
+    return (math.ceil(num_images / 4), 4)
 
-def download_image_from_message_to_cache(bot, message, image_folder):
-    downloaded_file = bot.download_file(bot.get_file(message.photo[-1].file_id).file_path)
-    cache_path = os.path.join(image_folder, datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".jpg")
-    with open(cache_path, 'wb') as new_file:
-        new_file.write(downloaded_file)
-    return cache_path
 
+def label_tile(tile, i):
+    # In the center of each image, assign the image number using OpenCV
+    height, width = tile.shape[:2]
+    cv2.putText(tile, str(i), (width // 2, height // 2), cv2.FONT_HERSHEY_DUPLEX, 3, (0, 0, 255), 5)
+    return tile
+
+
+def place_tiles(tiles, grid_shape, border=0):
+    # Place all tiles at once: (rows, cols, h, w) -> (rows, h, cols, w), the border is the padding
+    # after each tile, cut off again after the last row and column
+    rows, cols = grid_shape
+    height, width = tiles.shape[1:3]
+    if len(tiles) < rows * cols:
+        tiles = np.concatenate([tiles, np.zeros((rows * cols - len(tiles), height, width, 3), dtype=np.uint8)])
+    grid = np.zeros((rows, height + border, cols, width + border, 3), dtype=np.uint8)
+    grid[:, :height, :, :width] = tiles.reshape(rows, cols, height, width, 3).transpose(0, 2, 1, 3, 4)
+    grid = grid.reshape(rows * (height + border), cols * (width + border), 3)
+    return grid[:rows * (height + border) - border, :cols * (width + border) - border]
+
+
+def build_image_grid(images, border=0):
+    """Builds a grid of images from a list of PIL images or image paths."""
+    if len(images) == 0:
+        print("No images found")
+        return None
+    images = [Image.open(img) if isinstance(img, str) else img for img in images]
+    grid_shape = grid_shape_for(len(images))
 
-def get_cards_from_image(prediction, image_path):
+    # All tiles take the size of images[0], stacked into one (rows * cols, h, w, 3) buffer
+    width, height = images[0].size
+    tiles = np.zeros((grid_shape[0] * grid_shape[1], height, width, 3), dtype=np.uint8)
+    for i, img in enumerate(images):
+        img = img.convert('RGB')
+        tiles[i] = np.asarray(img if img.size == (width, height) else img.resize((width, height)))
+        label_tile(tiles[i], i)
+    return Image.fromarray(place_tiles(tiles, grid_shape, border))
+
+
+class HandGrid:
+    """Grid of the cards in one hand, same layout as build_image_grid. Adding or removing a card
+    only redraws the tiles whose slot or number changed, the JPEG is encoded once per change."""
+
+    def __init__(self):
+        self.card_hashes = []
+        self.tiles = []
+        self.labelled_tiles = []
+        self.tile_size = None
+        self.grid = None
+        self.grid_shape = None
+        self._jpeg_bytes = None
+
+    @staticmethod
+    def from_cards(cards):
+        # cards is the "my_cards" dict of a game state
+        hand_grid = HandGrid()
+        for card_hash, card_info in cards.items():
+            hand_grid.card_hashes.append(card_hash)
+            hand_grid.tiles.append(hand_grid.make_tile(card_info['image_path']))
+            hand_grid.labelled_tiles.append(label_tile(hand_grid.tiles[-1].copy(), len(hand_grid.tiles) - 1))
+        hand_grid.rebuild()
+        return hand_grid
+
+    def __len__(self):
+        return len(self.card_hashes)
+
+    def make_tile(self, image):
+        image = (Image.open(image) if isinstance(image, str) else image).convert('RGB')
+        if self.tile_size is None:
+            self.tile_size = image.size
+        if image.size != self.tile_size:
+            image = image.resize(self.tile_size)
+        return np.array(image)
+
+    def rebuild(self):
+        self._jpeg_bytes = None
+        if len(self.tiles) == 0:
+            self.grid, self.grid_shape = None, None
+            return
+        self.grid_shape = grid_shape_for(len(self.tiles))
+        self.grid = np.ascontiguousarray(place_tiles(np.stack(self.labelled_tiles), self.grid_shape))
+
+    def write_slot(self, idx, tile=None):
+        width, height = self.tile_size
+        row, col = divmod(idx, self.grid_shape[1])
+        self.grid[row * height:(row + 1) * height, col * width:(col + 1) * width] = (
+            self.labelled_tiles[idx] if tile is None else tile)
+
+    def add(self, card_hash, image):
+        tile = self.make_tile(image)
+        if card_hash in self.card_hashes:
+            # Re-adding a card keeps its position, like dict.update on the game state
+            idx = self.card_hashes.index(card_hash)
+            self.tiles[idx] = tile
+            self.labelled_tiles[idx] = label_tile(tile.copy(), idx)
+        else:
+            idx = len(self.card_hashes)
+            self.card_hashes.append(card_hash)
+            self.tiles.append(tile)
+            self.labelled_tiles.append(label_tile(tile.copy(), idx))
+
+        if self.grid is None or grid_shape_for(len(self.tiles)) != self.grid_shape:
+            self.rebuild()
+        else:
+            self.write_slot(idx)
+            self._jpeg_bytes = None
+
+    def remove(self, card_hashes):
+        removed = [idx for idx, card_hash in enumerate(self.card_hashes) if card_hash in card_hashes]
+        if len(removed) == 0:
+            return
+        num_slots_before = len(self.card_hashes)
+        keep = [idx for idx in range(num_slots_before) if idx not in removed]
+        self.card_hashes = [self.card_hashes[idx] for idx in keep]
+        self.tiles = [self.tiles[idx] for idx in keep]
+        # Cards after the first removed one move up and get a new number
+        first = removed[0]
+        self.labelled_tiles = self.labelled_tiles[:first] + [
+            label_tile(self.tiles[idx].copy(), idx) for idx in range(first, len(self.tiles))]
+
+        if len(self.tiles) == 0 or grid_shape_for(len(self.tiles)) != self.grid_shape:
+            self.rebuild()
+            return
+        for idx in range(first, len(self.tiles)):
+            self.write_slot(idx)
+        empty = np.zeros_like(self.tiles[0])
+        for idx in range(len(self.tiles), num_slots_before):
+            self.write_slot(idx, empty)
+        self._jpeg_bytes = None
+
+    @property
+    def image(self):
+        return None if self.grid is None else Image.fromarray(self.grid)
+
+    @property
+    def jpeg_bytes(self):
+        if self._jpeg_bytes is None and self.grid is not None:
+            stream = io.BytesIO()
+            self.image.save(stream, format="JPEG")
+            self._jpeg_bytes = stream.getvalue()
+        return self._jpeg_bytes
+
+
+def download_image_from_message_to_cache(bot, message, image_store):
+    with tracing.span("download") as download_span:
+        downloaded_file = bot.download_file(bot.get_file(message.photo[-1].file_id).file_path)
+        download_span.set(size=len(downloaded_file))
+    with tracing.span("store_image", size=len(downloaded_file)):
+        return image_store.put_bytes(downloaded_file)
+
+
+def get_cards_from_image(prediction, image, image_store):
     images = []
-    image = Image.open(image_path)
-
-    prefix, ext = os.path.splitext(image_path)
-    detected_cards_paths = []
     for pred in prediction:
         box = pred["box"]
         xmin, ymin, xmax, ymax = box.values()
-        im = image.crop((xmin, ymin, xmax, ymax))
-        images.append(im)
+        images.append(image.crop((xmin, ymin, xmax, ymax)))
 
-    for i, image in enumerate(images):
-        detected_cards_paths.append(f"{prefix}_card-{i}-of-{len(images)}{ext}")
-        image.save(detected_cards_paths[-1])
+    detected_cards_paths, saved = [], []
+    for im in images:
+        path, future = image_store.put_image(im)
+        detected_cards_paths.append(path)
+        saved.append(future)
 
-    grid = build_image_grid(detected_cards_paths)
+    grid = build_image_grid(images)
 
     return {
         'images' : images,
         'grid': grid,
-        'card_paths': detected_cards_paths
+        'card_paths': detected_cards_paths,
+        'saved': saved,
     }
 
 
-def reset_game_state(game_state_path):
-    with open(game_state_path, "w") as f:
-        f.write("my_cards: {}\n")
-
+def wait_for_card_files(cards_dict):
+    for future in cards_dict['saved']:
+        future.result()
 
-def get_game_state_path(bot, message, game_state_folder):
-    game_state_path = os.path.join(game_state_folder, f"{message.from_user.username}.yaml")
-    if not os.path.exists(game_state_path):
-        reset_game_state(game_state_path)
-    return game_state_path
\ No newline at end of file
@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+_current = threading.local()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def current_job():
+    # The job running on this worker thread, None outside the scheduler
+    return getattr(_current, 'job', None)
+
+
+class Job:
+    def __init__(self, key, name, fn, priority):
+        self.key = key
+        self.name = name
+        self.fn = fn
+        self.priority = priority
+        self.future = Future()
+        self.cancel_requested = threading.Event()
+        self.on_progress = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+    def check_cancelled(self):
+        if self.cancel_requested.is_set():
+            raise JobCancelled(f"Job [{self.name}] was cancelled.")
+
+    def progress(self, text):
+        # Called by the job between its steps, which makes every progress report a cancellation point
+        self.check_cancelled()
+        if self.on_progress is not None:
+            self.on_progress(text)
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class JobScheduler:
+    """Runs jobs on a pool of worker threads, the lowest priority value first. Jobs with the same
+    key (a user) run one after another in arrival order, jobs of different users run concurrently."""
+
+    def __init__(self, num_workers=4, history_size=500):
+        self.num_workers = num_workers
+        self.pending = []
+        self.running = dict()
+        self.condition = threading.Condition()
+        self.history = dict()
+        self.history_size = history_size
+        self.counts = dict()
+        self.threads = []
+        for idx in range(num_workers):
+            thread = threading.Thread(target=self._worker, name=f"dixit-worker-{idx}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, fn, name=None, priority=0):
+        job = Job(key, name or getattr(fn, '__name__', 'job'), fn, priority)
+        with self.condition:
+            self.pending.append(job)
+            self.condition.notify()
+        return job
+
+    def _next_job(self):
+        # Only the oldest pending job of every idle key is eligible, the best priority among them wins
+        seen, best = set(), None
+        for job in self.pending:
+            if job.key in seen or job.key in self.running:
+                continue
+            seen.add(job.key)
+            if best is None or job.priority < best.priority:
+                best = job
+        return best
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None:
+                    self.condition.wait()
+                    job = self._next_job()
+                self.pending.remove(job)
+                self.running[job.key] = job
+
+            job.started_at = time.monotonic()
+            status = 'done'
+            _current.job = job
+            try:
+                job.future.set_result(job.fn())
+            except JobCancelled as e:
+                status = 'cancelled'
+                job.future.set_exception(e)
+            except Exception as e:
+                status = 'failed'
+                logging.log(logging.ERROR, f"Job [{job.name}] of [{job.key}] failed: {e!r}")
+                job.future.set_exception(e)
+            finally:
+                _current.job = None
+            job.finished_at = time.monotonic()
+
+            with self.condition:
+                del self.running[job.key]
+                self._record(job, status)
+                self.condition.notify_all()
+
+    def _record(self, job, status):
+        history = self.history.setdefault(job.name, deque(maxlen=self.history_size))
+        history.append((job.started_at - job.submitted_at, job.finished_at - job.started_at))
+        counts = self.counts.setdefault(job.name, {'done': 0, 'failed': 0, 'cancelled': 0})
+        counts[status] += 1
+
+    def cancel(self, key):
+        """Drops the queued jobs of key and asks its running job to stop at its next progress report.
+        Returns the number of dropped jobs and the running job, if any."""
+        with self.condition:
+            dropped = [job for job in self.pending if job.key == key]
+            self.pending = [job for job in self.pending if job.key != key]
+            for job in dropped:
+                job.future.cancel()
+                self.counts.setdefault(job.name, {'done': 0, 'failed': 0, 'cancelled': 0})['cancelled'] += 1
+            running = self.running.get(key)
+            if running is not None:
+                running.cancel_requested.set()
+        return len(dropped), running
+
+    def position(self, job):
+        # Number of jobs that will start before this one, assuming no new ones arrive
+        with self.condition:
+            if job not in self.pending:
+                return 0
+            own_idx = self.pending.index(job)
+            return sum(
+                1 for idx, other in enumerate(self.pending)
+                if other.priority < job.priority or (other.priority == job.priority and idx < own_idx))
+
+    def stats(self):
+        now = time.monotonic()
+        with self.condition:
+            pending_by_priority = dict()
+            for job in self.pending:
+                pending_by_priority[job.priority] = pending_by_priority.get(job.priority, 0) + 1
+            return {
+                'workers': self.num_workers,
+                'pending': len(self.pending),
+                'pending_by_priority': dict(sorted(pending_by_priority.items())),
+                'oldest_pending_seconds': max([now - job.submitted_at for job in self.pending], default=0.0),
+                'running': [(job.name, now - job.started_at) for job in self.running.values()],
+                'jobs': {
+                    name: dict(
+                        counts,
+                        wait_p50=percentile([wait for wait, _ in self.history.get(name, [])], 0.5),
+                        wait_p95=percentile([wait for wait, _ in self.history.get(name, [])], 0.95),
+                        run_p50=percentile([run for _, run in self.history.get(name, [])], 0.5),
+                        run_p95=percentile([run for _, run in self.history.get(name, [])], 0.95),
+                    )
+                    for name, counts in self.counts.items()
+                },
+            }